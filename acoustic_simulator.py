@@ -1,7 +1,7 @@
 import numpy as np
-from webgpu_handler import WebGpuHandler
-import matplotlib.pyplot as plt
+from backends import create_handler, create_step_pipelines, batch_steps, active_region_box, active_region_pipelines, read_wavefield
 from simulation_handler import SimulationHandler
+from snapshot_renderer import SnapshotRenderer
 import os
 from pathlib import Path
 from scipy.signal.windows import gaussian
@@ -12,23 +12,27 @@ class AcousticSimulator(SimulationHandler):
         super().__init__(**kwargs)
 
         self.plots_folder = Path("./plots_ac")
-        self.plots_folder.mkdir(parents=True, exist_ok=True)
+        if not self.headless:
+            self.plots_folder.mkdir(parents=True, exist_ok=True)
 
-        for item in self.plots_folder.iterdir():
-            item.unlink()
+            for item in self.plots_folder.iterdir():
+                item.unlink()
 
-        self.folder = Path("./AcousticSim")
+        self.folder = Path(kwargs.get("output_folder", "./AcousticSim"))
         self.folder.mkdir(parents=True, exist_ok=True)
 
         for item in self.folder.iterdir():
             item.unlink()
 
-        self.recordings = np.asarray([[0 for _ in range(self.total_time)] for _ in range(self.num_transducers)], dtype=np.float32)
-
-        self.source_z = kwargs["source_z"]
-        self.source_x = kwargs["source_x"]
+        # Independent shots propagated together, one (source_z, source_x) each. Defaults to the single source_z/source_x
+        shots = kwargs["shots"] if "shots" in kwargs else [(kwargs["source_z"], kwargs["source_x"])]
+        self.shots = np.array(shots, dtype=np.int32).reshape(-1, 2)
+        self.num_shots = self.shots.shape[0]
+        self.source_z = self.shots[:, 0]
+        self.source_x = self.shots[:, 1]
 
-        self.source = np.load('./source.npy').astype(np.float32)
+        # Source wavelet, loaded from ./source.npy unless given
+        self.source = np.asarray(kwargs["source"] if "source" in kwargs else np.load('./source.npy')).astype(np.float32)
         if len(self.source) < self.total_time:
             self.source = np.pad(self.source, (0, self.total_time - len(self.source)), 'constant').astype(np.float32)
         elif len(self.source) > self.total_time:
@@ -41,88 +45,118 @@ class AcousticSimulator(SimulationHandler):
         # self.source = gaussian(self.total_time, 1.5)
         # self.source = np.roll(self.source, -1 * int(self.total_time / 2 - 20)).astype(np.float32)
 
+        # Timesteps kept in the GPU recordings ring, they are written to disk every time the ring fills up
+        self.record_chunk = int(min(kwargs.get("record_chunk", 1024), self.total_time))
+
         self.info_i32 = np.array(
             [
                 self.grid_size_z,
                 self.grid_size_x,
-                self.source_z,
-                self.source_x,
+                self.absorption_layer_size,
+                self.num_transducers,
+                self.record_chunk,
+                self.num_shots,
             ],
             dtype=np.int32
         )
 
-        self.wgpu_handler = WebGpuHandler()
-        self.wgpu_handler.create_shader_module("./synthetic_acou_sim.wgsl", self.grid_size_shape, (8, 8))
+        self.renderer = SnapshotRenderer(headless=self.headless, num_workers=self.render_workers)
+        self.handler = create_handler(self.backend, self.device)
+        shader_path = "./synthetic_acou_sim_fused.wgsl" if self.kernel_mode == "fused" else "./synthetic_acou_sim.wgsl"
+        # The active region of the grid kernels grows from the box around the sources
+        constants = {"stencil_radius": self.stencil_radius}
+        if self.active_region != "off":
+            self.active_box = active_region_box(self.source_z, self.source_x)
+            constants.update(self.active_box)
+        self.handler.create_shader_module(shader_path, (*self.grid_size_shape, self.num_shots), self.workgroup_size, constants=constants,
+                                          wavefield_precision=self.wavefield_precision)
 
         # Data passed to gpu buffers
         wgsl_data = {
-            'p_next': (self.roi_nbytes, True),
-            'p_current': (self.roi_nbytes, True),
-            'p_previous': (self.roi_nbytes, True),
-            'dp_1_z': (self.roi_nbytes, True),
-            'dp_1_x': (self.roi_nbytes, True),
-            'dp_2_z': (self.roi_nbytes, True),
-            'dp_2_x': (self.roi_nbytes, True),
-            'phi_z': (self.roi_nbytes, True),
-            'phi_x': (self.roi_nbytes, True),
-            'psi_z': (self.roi_nbytes, True),
-            'psi_x': (self.roi_nbytes, True),
+            'p_next': (self.roi_nbytes * self.num_shots, True),
+            'p_current': (self.roi_nbytes * self.num_shots, True),
+            'p_previous': (self.roi_nbytes * self.num_shots, True),
+            'dp_1_z': (self.roi_nbytes * self.num_shots, True),
+            'dp_1_x': (self.roi_nbytes * self.num_shots, True),
+            'dp_2_z': (self.roi_nbytes * self.num_shots, True),
+            'dp_2_x': (self.roi_nbytes * self.num_shots, True),
+            'phi_z': (self.z_strips_nbytes * self.num_shots, True),
+            'phi_x': (self.x_strips_nbytes * self.num_shots, True),
+            'psi_z': (self.z_strips_nbytes * self.num_shots, True),
+            'psi_x': (self.x_strips_nbytes * self.num_shots, True),
             'infoI32': (self.info_i32, False),
             'infoF32': (self.info_f32, False),
             'c': (self.c_with_reflectors, False),
             'source': (self.source, False),
+            'source_zx': (np.ascontiguousarray(self.shots), False),
             'absorption_z': (self.absorption_z, False),
             'absorption_x': (self.absorption_x, False),
-            'is_z_absorption': (self.is_z_absorption_int, False),
-            'is_x_absorption': (self.is_x_absorption_int, False),
+            'transducer_z': (np.ascontiguousarray(self.transducer_z, dtype=np.int32), False),
+            'transducer_x': (np.ascontiguousarray(self.transducer_x, dtype=np.int32), False),
             'i': (np.int32(0), False),
+            'recordings': (int(self.num_shots * self.num_transducers * self.record_chunk * np.dtype(np.float32).itemsize), True),
         }
 
-        self.wgpu_handler.set_buffers(wgsl_data, "p_next")
-        self.wgpu_handler.create_buffers(debug=False)
-        self.wgpu_handler.create_bind_group_layouts()
-        self.wgpu_handler.create_pipeline_layout()
-        self.wgpu_handler.create_bind_groups()
-
-        forward_diff = self.wgpu_handler.create_compute_pipeline("forward_diff")
-        apply_cpml_to_first_order_diff = self.wgpu_handler.create_compute_pipeline("apply_cpml_to_first_order_diff")
-        backward_diff = self.wgpu_handler.create_compute_pipeline("backward_diff")
-        apply_cpml_to_second_order_diff = self.wgpu_handler.create_compute_pipeline("apply_cpml_to_second_order_diff")
-        simulate = self.wgpu_handler.create_compute_pipeline("simulate")
-        increment_time = self.wgpu_handler.create_compute_pipeline("increment_time")
-
-        for i in range(self.total_time):
-            command_encoder = self.wgpu_handler.device.create_command_encoder()
-            compute_pass = command_encoder.begin_compute_pass()
-
-            for index, bind_group in enumerate(self.wgpu_handler.bind_groups):
-                compute_pass.set_bind_group(index, bind_group, [])
-
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, forward_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, apply_cpml_to_first_order_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, backward_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, apply_cpml_to_second_order_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, simulate)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, increment_time, [1])
-
-            compute_pass.end()
-            self.wgpu_handler.device.queue.submit([command_encoder.finish()])
-
-            self.p_next = self.wgpu_handler.read_buffer(group=0, binding=0)
-            self.p_next = np.frombuffer(self.p_next, dtype=np.float32).reshape(self.grid_size_shape)
-
-            self.recordings[:, i] = self.p_next[self.transducer_z[:], self.transducer_x[:]]
-
-            if i == 0 or (i + 1) % 50 == 0:
-                print(f"Simulated {i + 1}/{self.total_time}")
-                plt.figure()
-                plt.scatter(self.transducer_x, self.transducer_z, 0.1)
-                plt.scatter(self.source_x, self.source_z, 0.1)
-                plt.scatter(self.reflector_x, self.reflector_z, 0.1)
-                plt.imshow(self.p_next, cmap='coolwarm')
-                plt.savefig(f'{self.plots_folder}/pf_{i}.png', dpi=300)
-                plt.close()
-
-        np.save(f"{self.folder}/recordings.npy", self.recordings)
+        self.handler.set_buffers(wgsl_data, "p_next", "recordings")
+        self.handler.create_buffers(debug=False)
+        self.handler.create_bind_group_layouts()
+        self.handler.create_pipeline_layout()
+        self.handler.create_bind_groups()
+
+        if self.profile:
+            self.handler.enable_profiling()
+
+        # The transducers are sampled on the GPU every step into the recordings buffer
+        record_transducers = ("record_transducers", [(self.num_transducers + 63) // 64, 1, self.num_shots])
+        step_pipelines = create_step_pipelines(
+            self.handler, self.kernel_mode, self.grid_size_shape, self.absorption_layer_size, after_step=[record_transducers],
+            num_shots=self.num_shots
+        )
+        if self.active_region != "off":
+            step_pipelines = active_region_pipelines(
+                self.handler, step_pipelines, self.grid_size_shape, self.active_box, self.active_region_reach, num_shots=self.num_shots
+            )
+
+        snapshot_step = lambda i: not self.headless and (i == 0 or (i + 1) % 50 == 0)
+        record_step = lambda i: (i + 1) % self.record_chunk == 0 or i == self.total_time - 1
+
+        # Preallocated .npy on disk per shot (recordings.npy for a single shot, recordings_{shot}.npy otherwise),
+        # filled one chunk at a time so a crash keeps everything recorded so far
+        self.recordings = [
+            np.lib.format.open_memmap(
+                f"{self.folder}/recordings.npy" if self.num_shots == 1 else f"{self.folder}/recordings_{shot}.npy",
+                mode='w+', dtype=np.float32, shape=(int(self.num_transducers), int(self.total_time))
+            )
+            for shot in range(self.num_shots)
+        ]
+
+        # The host only needs the wavefield for the snapshots and the recordings chunks, the steps in between are batched
+        for start, end in batch_steps(self.total_time, self.batch_size, lambda i: snapshot_step(i) or record_step(i)):
+            self.handler.dispatch_pipelines(step_pipelines, end - start, start)
+            i = end - 1
+            print(f"Simulated {i + 1}/{self.total_time}")
+
+            if record_step(i):
+                chunk_start = i - i % self.record_chunk
+                chunk = self.handler.read_buffer(group=2, binding=0)
+                chunk = np.frombuffer(chunk, dtype=np.float32).reshape(self.num_shots, self.record_chunk, self.num_transducers)
+                for shot, recordings in enumerate(self.recordings):
+                    recordings[:, chunk_start:i + 1] = chunk[shot, :i + 1 - chunk_start].T
+                    recordings.flush()
+
+            if snapshot_step(i):
+                # Snapshots show the first shot
+                self.p_next = read_wavefield(self.handler, 0, 0, self.grid_size_shape)
+                self.renderer.submit(
+                    f'{self.plots_folder}/pf_{i}.png',
+                    self.p_next,
+                    scatters=[(self.transducer_x, self.transducer_z), (self.source_x[:1], self.source_z[:1]), (self.reflector_x, self.reflector_z)],
+                    cmap='coolwarm',
+                )
+
+        self.renderer.close()
+
+        if self.profile:
+            self.handler.write_profile(f"{self.folder}/profile.json")
 
         print('Acoustic Simulation finished.')
@@ -0,0 +1,156 @@
+import numpy as np
+
+
+# Entry points dispatched every timestep for each kernel mode, with the region they are dispatched over.
+# The fused mode folds the derivative, CPML and leapfrog kernels into two dispatches and doesn't allocate the
+# dp_1/dp_2 grids. In the split mode the CPML kernels only run over the absorbing strips
+STEP_ENTRY_POINTS = {
+    "split": [
+        ("forward_diff", "grid"),
+        ("apply_cpml_to_first_order_diff_z", "z_strips"),
+        ("apply_cpml_to_first_order_diff_x", "x_strips"),
+        ("backward_diff", "grid"),
+        ("apply_cpml_to_second_order_diff_z", "z_strips"),
+        ("apply_cpml_to_second_order_diff_x", "x_strips"),
+        ("simulate", "grid"),
+    ],
+    "fused": [
+        ("fused_first_order_diff", "grid"),
+        ("fused_simulate", "grid"),
+    ],
+}
+
+# Staggered-grid coefficients of the first derivative by stencil radius, as stencil_coefficients in the shaders
+STENCIL_COEFFICIENTS = {
+    1: np.array([1.], dtype=np.float32),
+    2: np.array([9. / 8., -1. / 24.], dtype=np.float32),
+    4: np.array([1225. / 1024., -245. / 3072., 49. / 5120., -5. / 7168.], dtype=np.float32),
+}
+
+# Roles of the three wavefield buffers. The handlers rotate them at the start of every step instead of copying the
+# fields: the buffer written as p_next becomes p_current, p_current becomes p_previous and the oldest one is
+# overwritten as the new p_next. The host always addresses them by role, between the steps p_next is the newest field
+WAVEFIELD_ROLES = ["p_next", "p_current", "p_previous"]
+
+# Imaging conditions accumulated on the GPU by the time reversal shaders
+IMAGING_CONDITIONS = {
+    "l2_norm": 0,
+    "max_amplitude": 1,
+    "windowed_energy": 2,
+    "cross_correlation": 3,
+}
+
+
+def create_handler(backend="webgpu", device=None):
+    # Handlers are imported lazily so GPU-less nodes don't need a working wgpu install. device is a WebGPU device, the
+    # shared one of the process by default
+    if backend == "webgpu":
+        from webgpu_handler import WebGpuHandler
+        return WebGpuHandler(device)
+    elif backend == "numpy":
+        from numpy_handler import NumpyHandler
+        return NumpyHandler()
+
+    raise ValueError(f"Unknown backend '{backend}', expected 'webgpu' or 'numpy'")
+
+
+def create_step_pipelines(handler, kernel_mode, grid_size_shape, absorption_layer_size, after_step=(), num_shots=1):
+    # after_step: (entry point, workgroups to dispatch) run after the wavefield update and before increment_time.
+    # Independent shots are laid along the third dispatch dimension
+    workgroups_to_dispatch = {
+        "grid": None,
+        "z_strips": handler.get_num_workgroups((2 * absorption_layer_size, grid_size_shape[1], num_shots)),
+        "x_strips": handler.get_num_workgroups((grid_size_shape[0], 2 * absorption_layer_size, num_shots)),
+    }
+
+    step_pipelines = [
+        (handler.create_compute_pipeline(entry_point), workgroups_to_dispatch[roi])
+        for entry_point, roi in STEP_ENTRY_POINTS[kernel_mode]
+    ]
+    step_pipelines += [(handler.create_compute_pipeline(entry_point), workgroups) for entry_point, workgroups in after_step]
+    step_pipelines.append((handler.create_compute_pipeline("increment_time"), [1]))
+
+    return step_pipelines
+
+
+def active_region_box(cells_z, cells_x):
+    # Bounding box of the cells the wavefield starts from, as the active_box_* constants of the shaders
+    cells_z, cells_x = np.asarray(cells_z), np.asarray(cells_x)
+
+    return {
+        "active_box_z": int(cells_z.min()),
+        "active_box_x": int(cells_x.min()),
+        "active_box_size_z": int(cells_z.max() - cells_z.min()) + 1,
+        "active_box_size_x": int(cells_x.max() - cells_x.min()) + 1,
+    }
+
+
+def active_region_pipelines(handler, step_pipelines, grid_size_shape, box, reach, num_shots=1):
+    # Returns step -> pipelines of the step. The grid kernels (dispatched with None) only cover the box grown by
+    # reach(step) cells on each side, the full grid is dispatched once it covers it
+    grid_size_shape = tuple(int(n) for n in grid_size_shape)
+    pipelines_by_size = {}
+
+    def pipelines(step):
+        size = (
+            min(box["active_box_size_z"] + 2 * reach(step), grid_size_shape[0]),
+            min(box["active_box_size_x"] + 2 * reach(step), grid_size_shape[1]),
+        )
+        if size == grid_size_shape:
+            return step_pipelines
+
+        if size not in pipelines_by_size:
+            pipelines_by_size[size] = [
+                (pipeline, handler.get_num_workgroups((*size, num_shots)) if workgroups is None else workgroups)
+                for pipeline, workgroups in step_pipelines
+            ]
+
+        return pipelines_by_size[size]
+
+    return pipelines
+
+
+def step_dispatches(pipelines, step):
+    # Pipelines are either the same (pipeline, workgroups) list every step or a function of the step
+    return pipelines(step) if callable(pipelines) else pipelines
+
+
+def read_wavefield(handler, group, binding, shape):
+    # Wavefield buffer as float32, the leading cells when it holds several shots. The half precision mode stores it as
+    # float16 (followed by a padding half on the GPU when the amount of cells is odd). The handlers resolve the binding
+    # to the buffer holding its role in the current rotation phase, (0, 0) is always the newest field
+    data = np.frombuffer(handler.read_buffer(group=group, binding=binding), dtype=handler.wavefield_dtype)
+    return data[:int(np.prod(shape))].reshape(shape).astype(np.float32)
+
+
+def batch_steps(total_time, batch_size, sync_step):
+    # Splits the run in chunks of at most batch_size timesteps. A chunk ends at every step i for which
+    # sync_step(i) is True, so the host can read the results of that step back
+    start = 0
+    while start < total_time:
+        end = start
+        while end < total_time and end - start < batch_size:
+            end += 1
+            if sync_step(end - 1):
+                break
+
+        yield start, end
+        start = end
+
+
+def injection_cells(transducer_z, transducer_x):
+    # Distinct cells of the transducers and the cell of each transducer
+    cells, inverse = np.unique(np.stack([transducer_z, transducer_x], axis=1), axis=0, return_inverse=True)
+
+    return np.ascontiguousarray(cells[:, 0], dtype=np.int32), np.ascontiguousarray(cells[:, 1], dtype=np.int32), inverse.ravel()
+
+
+def pack_injection_points(transducer_z, transducer_x, traces):
+    # Transducers sharing a grid cell are merged (their traces summed), so the injection kernel never has two
+    # threads writing the same cell. traces is (channel x time), returns the cells and a contiguous (time x channel)
+    # float32 buffer, so consecutive threads of the injection kernel read consecutive samples
+    cell_z, cell_x, inverse = injection_cells(transducer_z, transducer_x)
+    packed = np.zeros((traces.shape[1], cell_z.size), dtype=np.float32)
+    np.add.at(packed.T, inverse, traces)
+
+    return cell_z, cell_x, packed
@@ -0,0 +1,261 @@
+import numpy as np
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+WORKLOADS = ["acoustic_simulator", "time_reversal", "das_time_reversal"]
+
+# Metrics compared against the baseline, with the direction that counts as a regression
+COMPARED_METRICS = {
+    "steps_per_second": "lower",
+    "host_device_bytes": "higher",
+    "device_memory_bytes": "higher",
+}
+
+
+def benchmark_params(case):
+    # Homogeneous medium with a single reflector, a line of transducers and a source above it, as in main.py
+    grid_size_z, grid_size_x = case["grid_size"]
+    num_transducers = case["num_transducers"]
+
+    transducer_z = np.full(num_transducers, grid_size_z // 4, dtype=np.int32)
+    transducer_x = np.linspace(grid_size_x // 4, 3 * grid_size_x // 4, num_transducers).astype(np.int32)
+
+    c = np.full((grid_size_z, grid_size_x), 1500, dtype=np.float32)
+    c_with_reflectors = c.copy()
+    c_with_reflectors[3 * grid_size_z // 4, grid_size_x // 2] = np.float32(0)
+
+    dx = 1.5e-3
+    cpml_absorption_layer_size = min(50, grid_size_z // 8, grid_size_x // 8)
+    d0 = -(3 * 1500) / (2 * (cpml_absorption_layer_size * dx)) * np.log(0.001)
+
+    return {
+        'total_time': case["total_time"],
+        'grid_size_z': grid_size_z,
+        'grid_size_x': grid_size_x,
+        'num_transducers': num_transducers,
+        'transducer_z': transducer_z,
+        'transducer_x': transducer_x,
+        'dt': 5e-7,
+        'dz': dx,
+        'dx': dx,
+        'cpml_absorption_layer_size': cpml_absorption_layer_size,
+        'damping_coefficient': d0,
+        'c': c,
+        'c_with_reflectors': c_with_reflectors,
+        'backend': case["backend"],
+        'kernel_mode': case["kernel_mode"],
+        'headless': True,
+        'render_workers': 0,
+    }
+
+
+def run_case(case, shader_folder):
+    # Runs in a fresh process, so the peak host memory is the one of the case alone
+    from acoustic_simulator import AcousticSimulator
+    from time_reversal import TimeReversal
+    from das_tr import DAS_TimeReversal
+
+    params = benchmark_params(case)
+    if case["backend"] == "webgpu" and case["fallback_adapter"]:
+        # Software adapter, the simulators run on its device instead of the shared default one
+        from webgpu_handler import request_device
+        params['device'] = request_device(force_fallback_adapter=True)
+    source_z, source_x = params['grid_size_z'] // 8, params['grid_size_x'] // 2
+
+    t = np.arange(params['total_time'])
+    source = (np.exp(-((t - 40) / 8.0) ** 2) * np.sin(2 * np.pi * t / 25)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as folder:
+        # The simulators read their shaders and write their outputs relative to the working directory
+        for shader in Path(shader_folder).glob("*.wgsl"):
+            shutil.copy(shader, folder)
+        os.chdir(folder)
+
+        if case["workload"] == "time_reversal":
+            # The recordings to time reverse, not timed
+            AcousticSimulator(mode=0, source_z=source_z, source_x=source_x, source=source, **params)
+
+        start = time.perf_counter()
+        if case["workload"] == "acoustic_simulator":
+            simulation = AcousticSimulator(mode=0, source_z=source_z, source_x=source_x, source=source, **params)
+        elif case["workload"] == "time_reversal":
+            simulation = TimeReversal(mode=1, recordings_folder="./AcousticSim", **params)
+        else:
+            params.pop('c_with_reflectors')
+            bscan = np.random.default_rng(0).standard_normal((case["num_transducers"], case["total_time"])).astype(np.float32)
+            simulation = DAS_TimeReversal(
+                bscan=bscan, muted_samples=case["total_time"] // 10, stream_window=max(case["total_time"] // 4, 1), **params
+            )
+        seconds = time.perf_counter() - start
+
+        os.chdir(shader_folder)
+
+    handler = simulation.handler
+    if case["backend"] == "webgpu":
+        info = handler.device.adapter.info
+        adapter = f"{info['device']} ({info['adapter_type']}, {info['backend_type']})"
+    else:
+        adapter = "numpy"
+
+    cells = case["grid_size"][0] * case["grid_size"][1]
+
+    return {
+        "seconds": seconds,
+        "steps_per_second": case["total_time"] / seconds,
+        "mcells_per_second": cells * case["total_time"] / seconds / 1e6,
+        "bytes_uploaded": handler.bytes_uploaded,
+        "bytes_downloaded": handler.bytes_downloaded,
+        "host_device_bytes": handler.bytes_uploaded + handler.bytes_downloaded,
+        "device_memory_bytes": handler.allocated_bytes,
+        # Kilobytes on Linux, bytes on macOS
+        "peak_host_memory_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "adapter": adapter,
+    }
+
+
+def case_name(case):
+    grid_size_z, grid_size_x = case["grid_size"]
+    return f'{case["workload"]}-{case["backend"]}-{case["kernel_mode"]}-{grid_size_z}x{grid_size_x}-{case["num_transducers"]}tr-{case["total_time"]}steps'
+
+
+class Benchmark:
+    def __init__(self, **kwargs):
+        self.workloads = kwargs.get("workloads", WORKLOADS)
+        self.grid_sizes = [tuple(g) for g in kwargs.get("grid_sizes", [(128, 128), (256, 256)])]
+        self.transducer_counts = kwargs.get("transducer_counts", [16, 64])
+        self.step_counts = kwargs.get("step_counts", [200])
+
+        # "numpy" or "webgpu", fallback_adapter forces the software (CPU) WebGPU adapter on GPU-less machines
+        self.backend = kwargs.get("backend", "numpy")
+        self.kernel_mode = kwargs.get("kernel_mode", "split")
+        self.fallback_adapter = kwargs.get("fallback_adapter", False)
+
+        # Each case runs this many times (in a new process every time), the fastest run is kept
+        self.repetitions = int(kwargs.get("repetitions", 3))
+
+        self.output = Path(kwargs.get("output", "./benchmark.json"))
+
+        # Relative change of a compared metric flagged as a regression
+        self.tolerance = float(kwargs.get("tolerance", 0.1))
+
+        shader_folder = Path(kwargs.get("shader_folder", Path(__file__).resolve().parent))
+
+        cases = [
+            {
+                "workload": workload,
+                "grid_size": grid_size,
+                "num_transducers": int(num_transducers),
+                "total_time": int(total_time),
+                "backend": self.backend,
+                "kernel_mode": self.kernel_mode,
+                "fallback_adapter": self.fallback_adapter,
+            }
+            for workload, grid_size, num_transducers, total_time in itertools.product(
+                self.workloads, self.grid_sizes, self.transducer_counts, self.step_counts
+            )
+        ]
+
+        self.results = {
+            "environment": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "cpu_count": os.cpu_count(),
+            },
+            "cases": {},
+        }
+
+        # spawn, a forked process would carry over the GPU device and the memory of the previous cases
+        context = multiprocessing.get_context("spawn")
+
+        for case in cases:
+            runs = []
+            for _ in range(self.repetitions):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    runs.append(executor.submit(run_case, case, str(shader_folder)).result())
+
+            result = min(runs, key=lambda r: r["seconds"])
+            result["peak_host_memory_bytes"] = max(r["peak_host_memory_bytes"] for r in runs)
+            result["parameters"] = {k: v for k, v in case.items()}
+
+            name = case_name(case)
+            self.results["cases"][name] = result
+            print(f'{name}: {result["steps_per_second"]:.1f} steps/s, {result["mcells_per_second"]:.2f} Mcells/s, '
+                  f'{result["host_device_bytes"] / 2 ** 20:.1f} MiB moved, {result["peak_host_memory_bytes"] / 2 ** 20:.0f} MiB peak')
+
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        self.output.write_text(json.dumps(self.results, indent=2), encoding='utf-8')
+
+        self.regressions = []
+        if kwargs.get("baseline") is not None:
+            self.regressions = self.compare(json.loads(Path(kwargs["baseline"]).read_text(encoding='utf-8')))
+
+        print('Benchmark finished.')
+
+    def compare(self, baseline):
+        regressions = []
+
+        for name, result in self.results["cases"].items():
+            if name not in baseline["cases"]:
+                print(f'{name}: not in the baseline')
+                continue
+
+            for metric, direction in COMPARED_METRICS.items():
+                reference = baseline["cases"][name][metric]
+                if reference == 0:
+                    continue
+
+                change = (result[metric] - reference) / reference
+                if (direction == "lower" and change < -self.tolerance) or (direction == "higher" and change > self.tolerance):
+                    regressions.append((name, metric, reference, result[metric]))
+                    print(f'REGRESSION {name} {metric}: {reference:.6g} -> {result[metric]:.6g} ({change:+.1%})')
+
+        if not regressions:
+            print(f'No regressions against the baseline (tolerance {self.tolerance:.0%})')
+
+        return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the propagation engines")
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "webgpu"])
+    parser.add_argument("--fallback-adapter", action="store_true", help="software (CPU) WebGPU adapter")
+    parser.add_argument("--kernel-mode", default="split", choices=["split", "fused"])
+    parser.add_argument("--workloads", nargs="+", default=WORKLOADS, choices=WORKLOADS)
+    parser.add_argument("--grid-sizes", nargs="+", type=int, default=[128, 256], help="square grids")
+    parser.add_argument("--transducers", nargs="+", type=int, default=[16, 64])
+    parser.add_argument("--steps", nargs="+", type=int, default=[200])
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--output", default="./benchmark.json")
+    parser.add_argument("--baseline", default=None, help="JSON of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    benchmark = Benchmark(
+        backend=args.backend,
+        fallback_adapter=args.fallback_adapter,
+        kernel_mode=args.kernel_mode,
+        workloads=args.workloads,
+        grid_sizes=[(n, n) for n in args.grid_sizes],
+        transducer_counts=args.transducers,
+        step_counts=args.steps,
+        repetitions=args.repetitions,
+        output=args.output,
+        baseline=args.baseline,
+        tolerance=args.tolerance,
+    )
+
+    # Non-zero exit status on regressions, for CI
+    sys.exit(1 if benchmark.regressions else 0)
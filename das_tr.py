@@ -1,9 +1,8 @@
 import numpy as np
-from webgpu_handler import WebGpuHandler
-import matplotlib.pyplot as plt
+from backends import create_handler, create_step_pipelines, batch_steps, active_region_box, active_region_pipelines, read_wavefield, pack_injection_points, IMAGING_CONDITIONS
 from das_simulation_handler import DAS_SimulationHandler
+from snapshot_renderer import SnapshotRenderer
 from pathlib import Path
-import re
 
 
 class DAS_TimeReversal(DAS_SimulationHandler):
@@ -11,10 +10,11 @@ class DAS_TimeReversal(DAS_SimulationHandler):
         super().__init__(**kwargs)
 
         self.plots_folder = Path("./plots_tr")
-        self.plots_folder.mkdir(parents=True, exist_ok=True)
+        if not self.headless:
+            self.plots_folder.mkdir(parents=True, exist_ok=True)
 
-        for item in self.plots_folder.iterdir():
-            item.unlink()
+            for item in self.plots_folder.iterdir():
+                item.unlink()
 
         self.folder = Path("./TimeReversalSim")
         self.folder.mkdir(parents=True, exist_ok=True)
@@ -22,50 +22,74 @@ class DAS_TimeReversal(DAS_SimulationHandler):
         for item in self.folder.iterdir():
             item.unlink()
 
+        # (channel x time), usually memory-mapped (np.load(..., mmap_mode='r')), it is only read in time windows
         self.bscan = kwargs['bscan']
+        self.num_samples = self.bscan.shape[1]
+
+        # Samples at the beginning of the acquisition that are zeroed before the injection
+        self.muted_samples = int(kwargs.get("muted_samples", 400))
 
-        self.bscan[:, :400] = np.float32(0)
+        # Samples per streamed window, the GPU keeps a ring of two windows that is refilled ahead of the simulation
+        self.stream_window = min(int(kwargs.get("stream_window", 4096)), self.num_samples)
+        self.num_windows = (self.num_samples + self.stream_window - 1) // self.stream_window
+        self.ring_length = min(2 * self.stream_window, self.num_samples)
 
-        # Flip bscan
-        self.flipped_bscan = self.bscan[:, ::-1]
-        # Normalize bscan
-        self.flipped_bscan = self.flipped_bscan / np.amax(np.abs(self.flipped_bscan))
+        # Normalization computed in a streaming pass over the file
+        self.bscan_scale = np.float32(0)
+        for start in range(self.muted_samples, self.num_samples, self.stream_window):
+            self.bscan_scale = max(self.bscan_scale, np.amax(np.abs(self.bscan[:, start:start + self.stream_window])))
 
         self.cmap_vmax = 2
         self.cmap_vmin = -self.cmap_vmax
 
+        # Imaging condition accumulated on the GPU: "l2_norm", "max_amplitude" or "windowed_energy"
+        self.imaging_condition = kwargs.get("imaging_condition", "l2_norm")
+        self.imaging_window = kwargs.get("imaging_window", (0, self.total_time))
+
+        # Half height (px) of the band around the transducers left out of the image, 0 keeps the whole grid
+        self.excluded_band = int(kwargs.get("excluded_band", 0))
+        if self.excluded_band > 0:
+            self.excluded_band_rows = (max(int(self.transducer_z[0]) - self.excluded_band, 0), int(self.transducer_z[0]) + self.excluded_band)
+        else:
+            self.excluded_band_rows = (0, 0)
+
+        # Flipped traces packed in a single (time x channel) buffer, injected at the receiver cells only
+        self.injection_z, self.injection_x, first_window = self.read_window(0)
+        self.packed_bscan = np.zeros((self.ring_length, self.injection_z.size), dtype=np.float32)
+        self.packed_bscan[:first_window.shape[0]] = first_window
+        if self.num_windows > 1:
+            second_window = self.read_window(1)[2]
+            self.packed_bscan[self.stream_window:self.stream_window + second_window.shape[0]] = second_window
+
         # WebGPU Buffer
         self.info_i32 = np.array(
             [
                 self.grid_size_z,
                 self.grid_size_x,
-                self.num_transducers,
+                self.injection_z.size,
+                self.absorption_layer_size,
+                IMAGING_CONDITIONS[self.imaging_condition],
+                self.imaging_window[0],
+                self.imaging_window[1],
+                self.excluded_band_rows[0],
+                self.excluded_band_rows[1],
+                self.num_samples,
+                self.ring_length,
             ],
             dtype=np.int32
         )
 
-        shader_string = Path("./time_reversal_sim.wgsl").read_text()
-        
-        # Inject flipped microphones code into shader string
-        matches = re.findall(r'@binding\((\d+)\)', shader_string)
-        aux_string = ''
-        for i in range(self.num_transducers):
-            aux_string += f'''@group(2) @binding({i})
-var<storage,read> flipped_recording_{i}: array<f32>;\n\n'''
-        shader_string = shader_string.replace('//FLIPPED_MICROPHONES_BINDINGS', aux_string)
-        aux_string = ''
-        for i in range(self.num_transducers):
-            aux_string += f'''if (transducer_index == {i})
-            {{
-                p_next[zx(z, x)] += flipped_recording_{i}[i];
-            }}\n'''
-        shader_string = shader_string.replace('//FLIPPED_MICROPHONES_SIM', aux_string)
-
-        with open("injected_tr.wgsl", 'w', encoding='utf-8') as file:
-            file.write(shader_string)
-
-        self.wgpu_handler = WebGpuHandler()
-        self.wgpu_handler.create_shader_module("injected_tr.wgsl", self.grid_size_shape, (8, 8))
+        shader_path = "./time_reversal_sim_fused.wgsl" if self.kernel_mode == "fused" else "./time_reversal_sim.wgsl"
+
+        self.renderer = SnapshotRenderer(headless=self.headless, num_workers=self.render_workers)
+        self.handler = create_handler(self.backend, self.device)
+        # The active region of the grid kernels grows from the box around the injection points
+        constants = {"stencil_radius": self.stencil_radius}
+        if self.active_region != "off":
+            self.active_box = active_region_box(self.injection_z, self.injection_x)
+            constants.update(self.active_box)
+        self.handler.create_shader_module(shader_path, self.grid_size_shape, self.workgroup_size, constants=constants,
+                                          wavefield_precision=self.wavefield_precision)
 
         # Data passed to gpu buffers
         wgsl_data = {
@@ -76,62 +100,105 @@ var<storage,read> flipped_recording_{i}: array<f32>;\n\n'''
             'dp_1_x': (self.roi_nbytes, True),
             'dp_2_z': (self.roi_nbytes, True),
             'dp_2_x': (self.roi_nbytes, True),
-            'phi_z': (self.roi_nbytes, True),
-            'phi_x': (self.roi_nbytes, True),
-            'psi_z': (self.roi_nbytes, True),
-            'psi_x': (self.roi_nbytes, True),
+            'phi_z': (self.z_strips_nbytes, True),
+            'phi_x': (self.x_strips_nbytes, True),
+            'psi_z': (self.z_strips_nbytes, True),
+            'psi_x': (self.x_strips_nbytes, True),
             'infoI32': (self.info_i32, False),
             'infoF32': (self.info_f32, False),
             'c': (self.c, False),
             'absorption_z': (self.absorption_z, False),
             'absorption_x': (self.absorption_x, False),
-            'is_z_absorption': (self.is_z_absorption_int, False),
-            'is_x_absorption': (self.is_x_absorption_int, False),
-            'transducer_z': (np.ascontiguousarray(self.transducer_z), False),
-            'transducer_x': (np.ascontiguousarray(self.transducer_x), False),
+            'transducer_z': (self.injection_z, False),
+            'transducer_x': (self.injection_x, False),
+            'flipped_bscan': (self.packed_bscan, False),
+            # Only read by the cross_correlation imaging condition of the RTM
+            'source_wavefield': (4, True),
             'i': (np.int32(0), False),
-            **{f"flipped_recording_{i}": (np.ascontiguousarray(self.flipped_bscan[i]), False) for i in range(self.num_transducers)},
+            'image': (self.roi_nbytes, True),
+            # Only written by the cross_correlation imaging condition of the RTM
+            'illumination': (4, True),
         }
 
-        self.wgpu_handler.set_buffers(wgsl_data, "p_next")
-        self.wgpu_handler.create_buffers(debug=False)
-        self.wgpu_handler.create_bind_group_layouts()
-        self.wgpu_handler.create_pipeline_layout()
-        self.wgpu_handler.create_bind_groups()
-
-        forward_diff = self.wgpu_handler.create_compute_pipeline("forward_diff")
-        apply_cpml_to_first_order_diff = self.wgpu_handler.create_compute_pipeline("apply_cpml_to_first_order_diff")
-        backward_diff = self.wgpu_handler.create_compute_pipeline("backward_diff")
-        apply_cpml_to_second_order_diff = self.wgpu_handler.create_compute_pipeline("apply_cpml_to_second_order_diff")
-        simulate = self.wgpu_handler.create_compute_pipeline("simulate")
-        increment_time = self.wgpu_handler.create_compute_pipeline("increment_time")
-
-        for i in range(self.total_time):
-            command_encoder = self.wgpu_handler.device.create_command_encoder()
-            compute_pass = command_encoder.begin_compute_pass()
-
-            for index, bind_group in enumerate(self.wgpu_handler.bind_groups):
-                compute_pass.set_bind_group(index, bind_group, [])
-
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, forward_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, apply_cpml_to_first_order_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, backward_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, apply_cpml_to_second_order_diff)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, simulate)
-            self.wgpu_handler.dispatch_workgroups_to_pipeline(compute_pass, increment_time, [1])
-
-            compute_pass.end()
-            self.wgpu_handler.device.queue.submit([command_encoder.finish()])
-            
-            if (i + 1) % 5 == 0:
-                print(f"Simulated {i + 1}/{self.total_time}")
-                self.p_next = self.wgpu_handler.read_buffer(group=0, binding=0)
-                self.p_next = np.frombuffer(self.p_next, dtype=np.float32).reshape(self.grid_size_shape)
-                plt.figure()
-                plt.scatter(self.transducer_x, self.transducer_z, s=0.1)
-                plt.imshow(self.p_next, cmap='coolwarm', aspect='auto', vmax=self.cmap_vmax, vmin=self.cmap_vmin)
-                plt.colorbar()
-                plt.savefig(f'{self.plots_folder}/pf_{i}.png', dpi=300)
-                plt.close()
+        self.handler.set_buffers(wgsl_data, "p_next", "image")
+        self.handler.create_buffers(debug=False)
+        self.handler.create_bind_group_layouts()
+        self.handler.create_pipeline_layout()
+        self.handler.create_bind_groups()
+
+        if self.profile:
+            self.handler.enable_profiling()
+
+        step_pipelines = create_step_pipelines(
+            self.handler, self.kernel_mode, self.grid_size_shape, self.absorption_layer_size,
+            after_step=[("inject_transducers", [(self.injection_z.size + 63) // 64]), ("accumulate_image", None)]
+        )
+        if self.active_region != "off":
+            step_pipelines = active_region_pipelines(
+                self.handler, step_pipelines, self.grid_size_shape, self.active_box, self.active_region_reach
+            )
+
+        snapshot_step = lambda i: not self.headless and (i + 1) % 5 == 0
+        window_step = lambda i: (i + 1) % self.stream_window == 0
+
+        # The host only needs the wavefield for the snapshots, the steps in between are batched.
+        # Batches also end with each streamed window, whose ring slot is then refilled two windows ahead
+        for start, end in batch_steps(self.total_time, self.batch_size, lambda i: snapshot_step(i) or window_step(i)):
+            self.handler.dispatch_pipelines(step_pipelines, end - start, start)
+            i = end - 1
+            print(f"Simulated {i + 1}/{self.total_time}")
+
+            if window_step(i) and (i + 1) // self.stream_window + 1 < self.num_windows:
+                window = (i + 1) // self.stream_window + 1
+                self.handler.write_buffer(
+                    "flipped_bscan", self.read_window(window)[2], (window % 2) * self.stream_window * self.packed_bscan.shape[1] * 4
+                )
+
+            if snapshot_step(i):
+                self.p_next = read_wavefield(self.handler, 0, 0, self.grid_size_shape)
+                self.renderer.submit(
+                    f'{self.plots_folder}/pf_{i}.png',
+                    self.p_next,
+                    scatters=[(self.transducer_x, self.transducer_z)],
+                    colorbar=True,
+                    cmap='coolwarm', aspect='auto', vmax=self.cmap_vmax, vmin=self.cmap_vmin,
+                )
+
+        self.renderer.close()
+
+        # Single readback of the accumulated image
+        self.image = self.handler.read_buffer(group=2, binding=0)
+        self.image = np.frombuffer(self.image, dtype=np.float32).reshape(self.grid_size_shape).copy()
+
+        if self.imaging_condition == "l2_norm":
+            self.image = np.sqrt(self.image)
+
+        np.save(f"{self.folder}/{self.imaging_condition}.npy", self.image)
+
+        if not self.headless:
+            import matplotlib.pyplot as plt
+
+            plt.figure()
+            plt.imshow(self.image, aspect='auto', vmax=np.percentile(self.image, 99), vmin=0)
+            plt.scatter(self.transducer_x, self.transducer_z, s=0.1)
+            plt.colorbar()
+            plt.title(f"{self.imaging_condition} - Time Reversal")
+            plt.savefig(f'{self.folder}/{self.imaging_condition}.png', dpi=300)
+            plt.close()
+
+        if self.profile:
+            self.handler.write_profile(f"{self.folder}/profile.json")
 
         print('Time Reversal Simulation finished.')
+
+    def read_window(self, window):
+        # Window `window` of the time reversed B-scan, read backwards from the end of the (memory-mapped) file,
+        # muted, normalized and packed. Returns the injection cells and the (time x channel) samples
+        end = self.num_samples - window * self.stream_window
+        start = max(end - self.stream_window, 0)
+
+        traces = np.array(self.bscan[:, start:end])
+        traces[:, :max(self.muted_samples - start, 0)] = 0
+        traces = traces / self.bscan_scale
+
+        return pack_injection_points(self.transducer_z, self.transducer_x, traces[:, ::-1])
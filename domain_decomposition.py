@@ -0,0 +1,425 @@
+import numpy as np
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import threading
+from multiprocessing import shared_memory
+from pathlib import Path
+from backends import create_handler, create_step_pipelines, active_region_box, active_region_pipelines, injection_cells, IMAGING_CONDITIONS
+from das_simulation_handler import DAS_SimulationHandler
+from shot_scheduler import attach_shared_array
+
+
+# Wavefields exchanged between neighbouring subdomains after every step, (group, binding) in the time reversal shaders.
+# Only p_next: the handler rotates the wavefields, the p_next received after a step is the p_current of the next one and
+# its p_previous after that, nothing else in the halo rows is read
+HALO_FIELDS = [(0, 0)]
+
+
+def subdomain_bounds(grid_size_z, num_subdomains, halo):
+    # Slabs of consecutive rows, (first owned row, end of the owned rows, first local row, end of the local rows).
+    # Each slab also holds halo rows of its neighbours, so its rows are contiguous in memory and so are the halos
+    edges = np.linspace(0, grid_size_z, num_subdomains + 1).astype(int)
+
+    return [
+        (int(start), int(end), int(max(start - halo, 0)), int(min(end + halo, grid_size_z)))
+        for start, end in zip(edges[:-1], edges[1:])
+    ]
+
+
+def memory_mapped_layout(array):
+    # (file, byte offset, shape, strides, dtype) of an array viewing a memory-mapped file, None for one in memory
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if not isinstance(root, np.memmap) or not isinstance(root.base, mmap.mmap) or root.filename is None:
+        return None
+
+    offset = root.offset + array.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+
+    return root.filename, int(offset), array.shape, array.strides, array.dtype.str
+
+
+def open_memory_mapped(layout):
+    filename, offset, shape, strides, dtype = layout
+
+    return np.ndarray(shape, dtype=dtype, buffer=np.memmap(filename, dtype=np.uint8, mode='r'), offset=offset, strides=strides)
+
+
+def read_bscan_window(bscan, channels, cell_index, num_cells, window, spec):
+    # Window `window` of the time reversed B-scan for the given channels, read backwards from the end of the
+    # (memory-mapped) file, muted, normalized and summed at the injection cells cell_index. (time x cell)
+    end = spec["num_samples"] - window * spec["stream_window"]
+    start = max(end - spec["stream_window"], 0)
+
+    traces = np.array(bscan[channels, start:end], dtype=np.float32)
+    traces[:, :max(spec["muted_samples"] - start, 0)] = 0
+    traces = traces / spec["bscan_scale"]
+
+    packed = np.zeros((end - start, num_cells), dtype=np.float32)
+    np.add.at(packed.T, cell_index, traces[:, ::-1])
+
+    return packed
+
+
+def run_subdomain(index, spec, inputs, descriptors, barrier, progress):
+    # Runs in the worker processes. Propagates the slab with its own handler (a separate device for the WebGPU backend)
+    # and swaps the halo rows with the neighbouring slabs through shared memory after every step. inputs holds the
+    # model of the slab, the B-scan is streamed from its file
+    try:
+        blocks = {}
+        shared = {}
+        for key, (name, shape, dtype) in descriptors.items():
+            blocks[key], shared[key] = attach_shared_array(name, shape, dtype)
+
+        num_subdomains = len(spec["bounds"])
+        owned_start, owned_end, local_start, local_end = spec["bounds"][index]
+        halo = spec["halo"]
+        grid_size_x = spec["grid_size_x"]
+        grid_size_shape = (local_end - local_start, grid_size_x)
+        row_nbytes = grid_size_x * np.dtype(shared["halos"].dtype).itemsize
+        layer_size = spec["absorption_layer_size"]
+
+        # Injection points inside the slab, halo rows included, the halo ones are overwritten by the exchange. Only the
+        # channels injected there are read, a ring of two stream windows refilled ahead of the simulation
+        num_injection_points = inputs["injection_z"].size
+        if num_injection_points > 0:
+            local_injection_z, local_injection_x = inputs["injection_z"], inputs["injection_x"]
+            bscan = open_memory_mapped(spec["bscan"])
+            read_window = lambda window: read_bscan_window(
+                bscan, inputs["channels"], inputs["cell_index"], num_injection_points, window, spec
+            )
+
+            packed_bscan = np.zeros((spec["ring_length"], num_injection_points), dtype=np.float32)
+            first_window = read_window(0)
+            packed_bscan[:first_window.shape[0]] = first_window
+            if spec["num_windows"] > 1:
+                second_window = read_window(1)
+                packed_bscan[spec["stream_window"]:spec["stream_window"] + second_window.shape[0]] = second_window
+        else:
+            local_injection_z = np.zeros(1, dtype=np.int32)
+            local_injection_x = np.zeros(1, dtype=np.int32)
+            packed_bscan = np.zeros(1, dtype=np.float32)
+
+        excluded_band_rows = [int(np.clip(row - local_start, 0, grid_size_shape[0])) for row in spec["excluded_band_rows"]]
+
+        info_i32 = np.array(
+            [
+                grid_size_shape[0],
+                grid_size_x,
+                num_injection_points,
+                layer_size,
+                IMAGING_CONDITIONS[spec["imaging_condition"]],
+                spec["imaging_window"][0],
+                spec["imaging_window"][1],
+                excluded_band_rows[0],
+                excluded_band_rows[1],
+                spec["num_samples"],
+                spec["ring_length"],
+            ],
+            dtype=np.int32
+        )
+
+        roi_nbytes = int(grid_size_shape[0] * grid_size_x * np.dtype(np.float32).itemsize)
+        z_strips_nbytes = int(2 * layer_size * grid_size_x * np.dtype(np.float32).itemsize)
+        x_strips_nbytes = int(2 * layer_size * grid_size_shape[0] * np.dtype(np.float32).itemsize)
+
+        shader_path = "./time_reversal_sim_fused.wgsl" if spec["kernel_mode"] == "fused" else "./time_reversal_sim.wgsl"
+
+        handler = create_handler(spec["backend"])
+        # The active region grows from the box around all the injection points, in the rows of the slab. Outside of
+        # the slab it is clamped to the rows facing the box, which the wavefield reaches through the halos
+        constants = {"stencil_radius": spec["stencil_radius"]}
+        if spec["active_region"] != "off":
+            active_box = dict(spec["active_box"])
+            active_box["active_box_z"] -= local_start
+            constants.update(active_box)
+        handler.create_shader_module(
+            shader_path, grid_size_shape, spec["workgroup_size"], constants=constants, wavefield_precision=spec["wavefield_precision"]
+        )
+
+        # The z absorbing strips of the shaders are the first and last rows of the slab, the damping profile of the
+        # full grid leaves them inactive (absorption 1) away from the top and bottom of the grid
+        wgsl_data = {
+            'p_next': (roi_nbytes, True),
+            'p_current': (roi_nbytes, True),
+            'p_previous': (roi_nbytes, True),
+            'dp_1_z': (roi_nbytes, True),
+            'dp_1_x': (roi_nbytes, True),
+            'dp_2_z': (roi_nbytes, True),
+            'dp_2_x': (roi_nbytes, True),
+            'phi_z': (z_strips_nbytes, True),
+            'phi_x': (x_strips_nbytes, True),
+            'psi_z': (z_strips_nbytes, True),
+            'psi_x': (x_strips_nbytes, True),
+            'infoI32': (info_i32, False),
+            'infoF32': (spec["info_f32"], False),
+            'c': (inputs["c"], False),
+            'absorption_z': (inputs["absorption_z"], False),
+            'absorption_x': (inputs["absorption_x"], False),
+            'transducer_z': (local_injection_z, False),
+            'transducer_x': (local_injection_x, False),
+            'flipped_bscan': (packed_bscan, False),
+            'source_wavefield': (4, True),
+            'i': (np.int32(0), False),
+            'image': (roi_nbytes, True),
+            'illumination': (4, True),
+        }
+
+        handler.set_buffers(wgsl_data, "p_next", "image")
+        handler.create_buffers(debug=False)
+        handler.create_bind_group_layouts()
+        handler.create_pipeline_layout()
+        handler.create_bind_groups()
+
+        after_step = [("accumulate_image", None)]
+        if num_injection_points > 0:
+            after_step.insert(0, ("inject_transducers", [(num_injection_points + 63) // 64]))
+
+        step_pipelines = create_step_pipelines(handler, spec["kernel_mode"], grid_size_shape, layer_size, after_step=after_step)
+        if spec["active_region"] != "off":
+            speed, margin = spec["active_region_speed"], spec["active_region_margin"]
+            step_pipelines = active_region_pipelines(
+                handler, step_pipelines, grid_size_shape, active_box, lambda step: int(np.ceil(speed * (step + 1))) + margin
+            )
+
+        # (interface, side, local rows) sent to the neighbours and received from them. Side 0 is the last owned rows of
+        # the slab above the interface, side 1 the first owned rows of the slab below
+        sent, received = [], []
+        if index > 0:
+            sent.append((index - 1, 1, owned_start - local_start))
+            received.append((index - 1, 0, 0))
+        if index < num_subdomains - 1:
+            sent.append((index, 0, owned_end - local_start - halo))
+            received.append((index, 1, owned_end - local_start))
+
+        halos = shared["halos"]
+        for i in range(spec["total_time"]):
+            handler.dispatch_pipelines(step_pipelines, 1, i)
+
+            # Two sets of halo buffers, a slab still reading the previous step can't be overwritten by a neighbour
+            # that is already one step ahead
+            parity = i % 2
+            for interface, side, row in sent:
+                for field, (group, binding) in enumerate(HALO_FIELDS):
+                    rows = handler.read_buffer(group, binding, row * row_nbytes, halo * row_nbytes)
+                    halos[parity, interface, side, field] = np.frombuffer(rows, dtype=halos.dtype).reshape(halo, grid_size_x)
+
+            # A neighbour that died (or hangs) breaks the barrier instead of blocking this worker forever
+            try:
+                barrier.wait(spec["exchange_timeout"])
+            except threading.BrokenBarrierError:
+                raise RuntimeError(f"Subdomain {index}: halo exchange of step {i} broken, a neighbouring subdomain failed") from None
+            progress[index] = i + 1
+
+            for interface, side, row in received:
+                for field, (group, binding) in enumerate(HALO_FIELDS):
+                    name = next(v["name"] for v in handler.buffers_info if v["group"] == group and v["binding"] == binding)
+                    handler.write_buffer(name, halos[parity, interface, side, field], row * row_nbytes)
+
+            # The window that just ended is refilled with the one two windows ahead
+            window = (i + 1) // spec["stream_window"] + 1
+            if num_injection_points > 0 and (i + 1) % spec["stream_window"] == 0 and window < spec["num_windows"]:
+                handler.write_buffer(
+                    "flipped_bscan", read_window(window), (window % 2) * spec["stream_window"] * num_injection_points * 4
+                )
+
+            if index == 0 and (i + 1) % 100 == 0:
+                print(f"Simulated {i + 1}/{spec['total_time']}")
+
+        image = np.frombuffer(handler.read_buffer(group=2, binding=0), dtype=np.float32).reshape(grid_size_shape)
+        shared["image"][owned_start:owned_end] = image[owned_start - local_start:owned_end - local_start]
+    except BaseException:
+        # Releases the other workers waiting on the exchange
+        barrier.abort()
+        raise
+
+
+class DecomposedTimeReversal(DAS_SimulationHandler):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.folder = Path("./TimeReversalSim")
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        for item in self.folder.iterdir():
+            item.unlink()
+
+        # (channel x time), usually memory-mapped. Each worker maps the file and streams the channels it injects in time
+        # windows, a B-scan in memory is written to the output folder for them first
+        self.bscan = kwargs['bscan']
+        self.num_samples = self.bscan.shape[1]
+        self.muted_samples = int(kwargs.get("muted_samples", 400))
+
+        # Samples per streamed window, the workers keep a ring of two windows refilled ahead of the simulation
+        self.stream_window = min(int(kwargs.get("stream_window", 4096)), self.num_samples)
+        self.num_windows = (self.num_samples + self.stream_window - 1) // self.stream_window
+        self.ring_length = min(2 * self.stream_window, self.num_samples)
+
+        self.imaging_condition = kwargs.get("imaging_condition", "l2_norm")
+        self.imaging_window = kwargs.get("imaging_window", (0, self.total_time))
+
+        self.excluded_band = int(kwargs.get("excluded_band", 0))
+        if self.excluded_band > 0:
+            self.excluded_band_rows = (max(int(self.transducer_z[0]) - self.excluded_band, 0), int(self.transducer_z[0]) + self.excluded_band)
+        else:
+            self.excluded_band_rows = (0, 0)
+
+        # The grid is split along z in num_subdomains slabs, each propagated by a worker process with its own handler
+        # (and WebGPU device). The slabs swap halo_rows rows of the wavefields with their neighbours after every step:
+        # the rows a step reads from the next slab, 2 * stencil_radius with the CPML memory of the halo cells
+        self.num_subdomains = int(kwargs.get("num_subdomains", 2))
+        self.halo_rows = 2 * self.stencil_radius
+        self.bounds = subdomain_bounds(int(self.grid_size_z), self.num_subdomains, self.halo_rows)
+
+        # The halo rows are copied as stored, float16 ones need an even row length (copies are made of 4 byte words)
+        wavefield_dtype = np.float16 if self.wavefield_precision == "f16" else np.float32
+        if self.backend == "webgpu" and (self.grid_size_x * np.dtype(wavefield_dtype).itemsize) % 4 != 0:
+            raise ValueError(f"The f16 wavefields of the subdomains need an even grid_size_x, got {self.grid_size_x}")
+
+        for owned_start, owned_end, local_start, local_end in self.bounds:
+            if owned_end - owned_start < self.halo_rows or local_end - local_start < 2 * self.absorption_layer_size:
+                raise ValueError(
+                    f"Too many subdomains ({self.num_subdomains}) for {self.grid_size_z} rows, each one needs at least "
+                    f"{self.halo_rows} rows and {2 * self.absorption_layer_size} with its halos"
+                )
+
+        # Seconds a worker waits for its neighbours at the halo exchange of a step before giving up
+        self.exchange_timeout = float(kwargs.get("exchange_timeout", 600))
+
+        # Normalization computed in a streaming pass over the file, a block of channels (about 64 MiB) at a time
+        channel_block = max(1, 2 ** 24 // self.num_samples)
+        self.bscan_scale = np.float32(0)
+        for start in range(0, self.bscan.shape[0], channel_block):
+            self.bscan_scale = max(self.bscan_scale, np.amax(np.abs(self.bscan[start:start + channel_block, self.muted_samples:])))
+
+        self.injection_z, self.injection_x, self.injection_index = injection_cells(self.transducer_z, self.transducer_x)
+
+        shared_arrays = {
+            # Written by the workers
+            "image": np.zeros(self.grid_size_shape, dtype=np.float32),
+            # (step parity, interface, side, wavefield, row, column)
+            "halos": np.zeros((2, max(self.num_subdomains - 1, 1), 2, len(HALO_FIELDS), self.halo_rows, self.grid_size_x), dtype=wavefield_dtype),
+        }
+
+        spec = {
+            "bounds": self.bounds,
+            "halo": self.halo_rows,
+            "grid_size_x": int(self.grid_size_x),
+            "absorption_layer_size": int(self.absorption_layer_size),
+            "info_f32": self.info_f32,
+            "total_time": int(self.total_time),
+            "num_samples": int(self.num_samples),
+            "imaging_condition": self.imaging_condition,
+            "imaging_window": tuple(int(t) for t in self.imaging_window),
+            "excluded_band_rows": self.excluded_band_rows,
+            "backend": self.backend,
+            "kernel_mode": self.kernel_mode,
+            "workgroup_size": tuple(self.workgroup_size),
+            "stencil_radius": self.stencil_radius,
+            "wavefield_precision": self.wavefield_precision,
+            "active_region": self.active_region,
+            "active_region_speed": getattr(self, "active_region_speed", 0),
+            "active_region_margin": getattr(self, "active_region_margin", 0),
+            "exchange_timeout": self.exchange_timeout,
+            "muted_samples": self.muted_samples,
+            "bscan_scale": self.bscan_scale,
+            "stream_window": self.stream_window,
+            "num_windows": self.num_windows,
+            "ring_length": self.ring_length,
+            "active_box": active_region_box(self.injection_z, self.injection_x),
+        }
+
+        blocks = {}
+        descriptors = {}
+        bscan_path = None
+        try:
+            spec["bscan"] = memory_mapped_layout(self.bscan)
+            if spec["bscan"] is None:
+                bscan_path = self.folder / "bscan.npy"
+                np.save(bscan_path, self.bscan)
+                spec["bscan"] = memory_mapped_layout(np.load(bscan_path, mmap_mode='r'))
+
+            for key, array in shared_arrays.items():
+                blocks[key] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=blocks[key].buf)[...] = array
+                descriptors[key] = (blocks[key].name, array.shape, array.dtype.str)
+
+            # spawn, the workers must not inherit a GPU device
+            context = multiprocessing.get_context("spawn")
+            barrier = context.Barrier(self.num_subdomains)
+            # Steps completed by each worker
+            progress = context.RawArray("q", self.num_subdomains)
+            workers = [
+                context.Process(target=run_subdomain, args=(index, spec, self.subdomain_inputs(index), descriptors, barrier, progress))
+                for index in range(self.num_subdomains)
+            ]
+            for worker in workers:
+                worker.start()
+
+            # As soon as a worker fails the others are killed, one that died without reaching the barrier would
+            # otherwise keep them waiting until the exchange timeout. A worker that hangs inside the barrier also
+            # blocks the timeouts of the others (the barrier's condition waits for every waiter to wake up), so the
+            # pool is killed as well when no worker completes a step during the exchange timeout
+            running = list(workers)
+            last_progress = progress[:]
+            stalled = False
+            while running:
+                ready = multiprocessing.connection.wait([worker.sentinel for worker in running], self.exchange_timeout)
+                running = [worker for worker in running if worker.exitcode is None]
+                if not ready:
+                    stalled = progress[:] == last_progress
+                    last_progress = progress[:]
+                if stalled or any(worker.exitcode not in [None, 0] for worker in workers):
+                    for worker in running:
+                        worker.kill()
+            for worker in workers:
+                worker.join()
+
+            if stalled:
+                raise RuntimeError(f"Subdomain workers stalled for {self.exchange_timeout} s at steps {progress[:]}")
+            if any(worker.exitcode != 0 for worker in workers):
+                raise RuntimeError(f"Subdomain workers failed, exit codes {[worker.exitcode for worker in workers]}")
+
+            self.image = np.ndarray(self.grid_size_shape, dtype=np.float32, buffer=blocks["image"].buf).copy()
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+            if bscan_path is not None:
+                bscan_path.unlink()
+
+        if self.imaging_condition == "l2_norm":
+            self.image = np.sqrt(self.image)
+
+        np.save(f"{self.folder}/{self.imaging_condition}.npy", self.image)
+
+        if not self.headless:
+            import matplotlib.pyplot as plt
+
+            plt.figure()
+            plt.imshow(self.image, aspect='auto', vmax=np.percentile(self.image, 99), vmin=0)
+            plt.scatter(self.transducer_x, self.transducer_z, s=0.1)
+            plt.colorbar()
+            plt.title(f"{self.imaging_condition} - Time Reversal ({self.num_subdomains} subdomains)")
+            plt.savefig(f'{self.folder}/{self.imaging_condition}.png', dpi=300)
+            plt.close()
+
+        print('Decomposed Time Reversal Simulation finished.')
+
+    def subdomain_inputs(self, index):
+        # Model of the slab (halo rows included) and the injection cells in it, with the channels injected there and
+        # the local cell of each channel
+        local_start, local_end = self.bounds[index][2:]
+        inside = (self.injection_z >= local_start) & (self.injection_z < local_end)
+        channels = np.nonzero(inside[self.injection_index])[0]
+
+        return {
+            "c": np.ascontiguousarray(self.c[local_start:local_end], dtype=np.float32),
+            "absorption_z": np.ascontiguousarray(self.absorption_z[local_start:local_end]),
+            "absorption_x": np.ascontiguousarray(self.absorption_x),
+            "injection_z": np.ascontiguousarray(self.injection_z[inside] - local_start, dtype=np.int32),
+            "injection_x": np.ascontiguousarray(self.injection_x[inside], dtype=np.int32),
+            "channels": channels,
+            "cell_index": (np.cumsum(inside) - 1)[self.injection_index[channels]],
+        }
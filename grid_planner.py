@@ -0,0 +1,139 @@
+import numpy as np
+from scipy.signal import resample_poly
+from backends import STENCIL_COEFFICIENTS
+
+
+# Grid points per shortest wavelength that keep the numerical dispersion low, by stencil order
+POINTS_PER_WAVELENGTH = {2: 10, 4: 6, 8: 4}
+
+
+def stencil_factor(stencil_order):
+    # Growth of the highest (Nyquist) spatial frequency of the staggered stencils relative to the 2nd order one
+    return float(np.sum(np.abs(STENCIL_COEFFICIENTS[stencil_order // 2].astype(np.float64))))
+
+
+def courant_number(c_max, dt, dz, dx, stencil_order=2):
+    # Stability number of the leapfrog update with the staggered stencils, stable up to 1
+    return float(c_max * dt * stencil_factor(stencil_order) * np.sqrt(1 / float(dz) ** 2 + 1 / float(dx) ** 2))
+
+
+def max_stable_dt(c_max, dz, dx, stencil_order=2):
+    return 1 / (c_max * stencil_factor(stencil_order) * np.sqrt(1 / float(dz) ** 2 + 1 / float(dx) ** 2))
+
+
+def power_spectrum(segment):
+    # Power spectrum of a (..., time) segment, summed over the traces
+    segment = np.asarray(segment, dtype=np.float64)
+    segment = segment - segment.mean(axis=-1, keepdims=True)
+
+    spectrum = np.abs(np.fft.rfft(segment, axis=-1)) ** 2
+    return spectrum.reshape(-1, spectrum.shape[-1]).sum(axis=0)
+
+
+def max_frequency(signal, dt, energy_fraction=0.99, window=None, num_windows=8):
+    # Highest significant frequency of a signal (..., time): energy_fraction of the spectral energy lies below it.
+    # Several traces (a B-scan) share one spectrum. With a window, the spectrum is estimated from num_windows windows
+    # of that many samples spread over the signal, read one at a time, so a memory-mapped acquisition is never loaded
+    num_samples = signal.shape[-1]
+    if window is None or window >= num_samples:
+        spectrum = power_spectrum(signal)
+        frequencies = np.fft.rfftfreq(num_samples, dt)
+    else:
+        window = int(window)
+        spectrum = sum(power_spectrum(signal[..., start:start + window]) for start in np.unique(
+            np.linspace(0, num_samples - window, num_windows).astype(int)
+        ))
+        frequencies = np.fft.rfftfreq(window, dt)
+
+    energy = np.cumsum(spectrum)
+    if energy[-1] == 0:
+        raise ValueError("The signal is zero, there is no frequency content to plan the grid from")
+
+    return float(frequencies[min(np.searchsorted(energy, energy_fraction * energy[-1]), len(frequencies) - 1)])
+
+
+def resample_to_file(signal, up, down, path):
+    # Polyphase resampling of a (channel x time) signal into a .npy file, a block of channels at a time. The channels
+    # are resampled whole, the result is the same as resampling the signal at once
+    signal = signal.reshape(-1, signal.shape[-1])
+    num_samples = -(-signal.shape[1] * up // down)
+    resampled = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(signal.shape[0], num_samples))
+
+    # About 64 MiB of input per block
+    block = max(1, 2 ** 24 // signal.shape[1])
+    for start in range(0, signal.shape[0], block):
+        resampled[start:start + block] = resample_poly(np.asarray(signal[start:start + block], dtype=np.float32), up, down, axis=-1)
+    resampled.flush()
+    del resampled
+
+    return np.load(path, mmap_mode='r')
+
+
+def plan_grid(**kwargs):
+    # Coarsest grid spacing that keeps points_per_wavelength at the highest significant frequency of the signal
+    # (source wavelet or recordings) in the slowest medium, and the largest stable time step on it, a small rational
+    # multiple of the sampling interval of the signal. The signal is resampled to the time step.
+    # A memory-mapped B-scan is not loaded: spectrum_window plans from windows of it (see max_frequency) and
+    # resampled_path writes the resampled one to a .npy file, returned memory-mapped
+    signal = kwargs["signal"]
+    if not isinstance(signal, np.memmap):
+        signal = np.asarray(signal, dtype=np.float32)
+    signal_dt = float(kwargs["signal_dt"])
+
+    c_min = float(kwargs["c_min"])
+    c_max = float(kwargs["c_max"])
+
+    # Physical size of the grid (m)
+    size_z = float(kwargs["size_z"])
+    size_x = float(kwargs["size_x"])
+
+    # Simulated time (s), the whole signal by default
+    duration = float(kwargs.get("duration", signal.shape[-1] * signal_dt))
+
+    stencil_order = int(kwargs.get("stencil_order", 2))
+    points_per_wavelength = float(kwargs.get("points_per_wavelength", POINTS_PER_WAVELENGTH[stencil_order]))
+
+    # Fraction of the maximum stable time step used, margin for the float32 rounding of dt and the spacings
+    courant = float(kwargs.get("courant", 0.9))
+
+    f_max = max_frequency(
+        signal, signal_dt, float(kwargs.get("energy_fraction", 0.99)), kwargs.get("spectrum_window"), int(kwargs.get("spectrum_windows", 8))
+    )
+
+    # Upper bound of the spacing, e.g. the receiver spacing so that no two receivers fall on the same cell
+    spacing = c_min / (f_max * points_per_wavelength)
+    if kwargs.get("max_spacing") is not None:
+        spacing = min(spacing, float(kwargs["max_spacing"]))
+    spacing = np.float32(spacing)
+
+    target_dt = courant * max_stable_dt(c_max, spacing, spacing, stencil_order)
+
+    # dt = signal_dt * down / up, the largest one up to target_dt with a small resampling ratio
+    up, down = max(
+        ((int(np.ceil(down * signal_dt / target_dt)), down) for down in range(1, 17)),
+        key=lambda ratio: ratio[1] / ratio[0],
+    )
+    dt = np.float32(signal_dt * down / up)
+
+    # Polyphase resampling, low-pass filtered against aliasing when decimating
+    if up != down and kwargs.get("resampled_path") is not None:
+        signal = resample_to_file(signal, up, down, kwargs["resampled_path"])
+    elif up != down:
+        signal = resample_poly(np.asarray(signal, dtype=np.float32), up, down, axis=-1).astype(np.float32)
+
+    plan = {
+        'dt': dt,
+        'dz': spacing,
+        'dx': spacing,
+        'grid_size_z': np.int32(np.ceil(size_z / spacing)),
+        'grid_size_x': np.int32(np.ceil(size_x / spacing)),
+        'total_time': np.int32(np.ceil(duration / dt)),
+        'signal': signal,
+        'max_frequency': f_max,
+        'courant': courant_number(c_max, dt, spacing, spacing, stencil_order),
+    }
+
+    print(f'Grid plan: f_max = {f_max:.4g} Hz, dz = dx = {spacing:.4g} m, dt = {dt:.4g} s (x{down}/{up} of the signal sampling interval), '
+          f'{plan["grid_size_z"]} x {plan["grid_size_x"]} cells, {plan["total_time"]} steps, Courant {plan["courant"]:.3f}')
+
+    return plan
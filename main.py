@@ -1,27 +1,55 @@
 import numpy as np
 from acoustic_simulator import AcousticSimulator
 from time_reversal import TimeReversal
+from reverse_time_migration import SyntheticReverseTimeMigration
+from grid_planner import plan_grid
 
 num_transducers = np.int32(64)
 
-grid_size = (1500, 1500)
+medium_c = np.float32(1500)
 
-grid_center_x = int(grid_size[0] // 2)
+# Order of accuracy in space of the finite differences: 2, 4 or 8 (less numerical dispersion, more reads per cell)
+stencil_order = 2
 
-transducer_z = np.asarray([500 for _ in range(num_transducers)], dtype=np.int32)
+# The time step and the grid spacing are planned from the source spectrum: the coarsest spacing with enough points per
+# wavelength and the largest stable time step on it. The source is resampled to the time step
+source_dt = 5e-7
+plan = plan_grid(
+    signal=np.load('./source.npy'),
+    signal_dt=source_dt,
+    duration=5000 * source_dt,
+    c_min=medium_c,
+    c_max=medium_c,
+    # Physical size of the grid (m)
+    size_z=2.25,
+    size_x=2.25,
+    # At most the transducer spacing, every transducer on its own cell
+    max_spacing=12e-3,
+    stencil_order=stencil_order,
+)
 
-start_x = grid_center_x - (num_transducers // 2) * 8
-transducer_x = np.array([start_x + i * 8 for i in range(num_transducers)], dtype=np.int32)
+dz = plan['dz']
+dx = plan['dx']
 
-medium_c = np.float32(1500)
+grid_size = (plan['grid_size_z'], plan['grid_size_x'])
+
+
+def cell(meters):
+    return int(round(meters / dx))
+
+
+grid_center_x = int(grid_size[1] // 2)
+
+# Transducers 12 mm apart at a depth of 0.75 m
+transducer_z = np.full(num_transducers, cell(0.75), dtype=np.int32)
+
+start_x = grid_center_x - (num_transducers // 2) * cell(12e-3)
+transducer_x = np.array([start_x + i * cell(12e-3) for i in range(num_transducers)], dtype=np.int32)
 
 c = np.full(shape=(grid_size[0], grid_size[1]), fill_value=medium_c, dtype=np.float32)
 
 c_with_reflectors = c.copy()
-c_with_reflectors[1300, 1100] = np.float32(0)
-
-dz = 1.5e-3
-dx = 1.5e-3
+c_with_reflectors[cell(1.95), cell(1.65)] = np.float32(0)
 
 N = 2
 cpml_absorption_layer_size = 50
@@ -29,38 +57,72 @@ R_c = 0.001
 d0 = - ( (N+1) * medium_c ) / [ 2 * (cpml_absorption_layer_size * dx) ] * np.log(R_c)
 
 global_sim_params = {
-    'total_time': 5000,
+    'total_time': plan['total_time'],
     'grid_size_z': grid_size[0],
     'grid_size_x': grid_size[1],
     'num_transducers': num_transducers,
     'transducer_z': transducer_z,
     'transducer_x': transducer_x,
-    'dt': 5e-7,
+    'dt': plan['dt'],
     'dz': dz,
     'dx': dx,
     'cpml_absorption_layer_size': cpml_absorption_layer_size,
     'damping_coefficient': d0,
     "c_with_reflectors": c_with_reflectors,
-    "c": c
+    "c": c,
+    # Compute backend: "webgpu" (GPU) or "numpy" (CPU reference)
+    'backend': 'webgpu',
+    # Kernel mode: "split" or "fused" (fewer dispatches, no derivative grids)
+    'kernel_mode': 'split',
+    # Maximum amount of timesteps submitted to the GPU at once
+    'batch_size': 128,
+    # Workgroup size of the grid kernels, "auto" benchmarks the candidates once and keeps the result in workgroup_tuning.json
+    'workgroup_size': (8, 8),
+    'stencil_order': stencil_order,
+    # Grid kernels only dispatched where the wave can have arrived: "exact" (bit-identical), "wavefront" (smaller,
+    # drops the numerical precursor ahead of the front) or "off"
+    'active_region': 'exact',
 }
 
 # Modes:
 # 0 -> Acoustic Simulation
 # 1 -> Time Reversal
+# 2 -> Reverse Time Migration
 
 acoustic_sim_params = {
     'mode': 0,
-    'source_z': 300,
-    'source_x': 500,
+    'source_z': cell(0.45),
+    'source_x': cell(0.75),
+    'source': plan['signal'],
+    # Several shots propagated at once, replaces source_z/source_x and writes AcousticSim/recordings_{shot}.npy
+    # 'shots': [(cell(0.45), cell(0.75)), (cell(0.45), cell(1.125)), (cell(0.45), cell(1.5))],
 }
 
 time_reversal_params = {
     'mode': 1,
     "recordings_folder": "./AcousticSim",
+    # Shot whose recordings are time reversed when several were simulated
+    # 'shot': 0,
+}
+
+rtm_params = {
+    'mode': 2,
+    'source_z': cell(0.45),
+    'source_x': cell(0.75),
+    'source': plan['signal'],
+    "recordings_folder": "./AcousticSim",
+    # Forward states stored at once, the forward wavefield is recomputed from them
+    'checkpoints': 10,
+    # Or reconstruct it backwards in time from the wavefield saved on a band inside the CPML layer
+    # 'wavefield_reconstruction': 'boundary_saving',
 }
 
 acoustic_sim_params.update(global_sim_params)
 time_reversal_params.update(global_sim_params)
+rtm_params.update(global_sim_params)
 
-sh = AcousticSimulator(**acoustic_sim_params)
-tr = TimeReversal(**time_reversal_params)
+# The snapshot render workers are spawned, they import this file again
+if __name__ == "__main__":
+    sh = AcousticSimulator(**acoustic_sim_params)
+    tr = TimeReversal(**time_reversal_params)
+    # rtm = SyntheticReverseTimeMigration(**rtm_params)
@@ -1,78 +1,113 @@
 import numpy as np
 from das_tr import DAS_TimeReversal
+from domain_decomposition import DecomposedTimeReversal
+from grid_planner import plan_grid
 
-bscan = np.load('./aquisicao_40km_50ns_21_10_2024_ds19_17500m_24000m_40705s_40715s_fs900Hz.npy')
-
-spatial_start = 17500
-spatial_end = 24000
-
-acquisition_step = np.float32(1. / 400e6)
-nu = 3e8 / 1.4682
-dx_original = np.float32((acquisition_step * (nu / 2.)))
-
-offset_idx = 300
-apex_idx = 696
-
-fs = 900
-dx = np.float32((spatial_end - spatial_start) / bscan.shape[0])
-dz = dx
-dt = np.float32(1 / fs)
-
-num_transducers = int(offset_idx * 2)
-total_time = bscan.shape[1]
-
-# Grid em metros
-size_meters_z = np.float32((spatial_end - spatial_start) + 10000)
-size_meters_x = np.float32((spatial_end - spatial_start) + 10000)
-
-grid_size_z = np.int32(size_meters_z / dz)
-grid_size_x = np.int32(size_meters_x / dx)
-grid_size_shape = (grid_size_z, grid_size_x)
-
-print(f'{grid_size_shape = }')
-
-# Microphones' position
-transducer_x = []
-for rp in range(num_transducers):
-    transducer_x.append((dx * rp) / dx)
-transducer_x = (np.int32(np.asarray(transducer_x))
-                    + np.int32((grid_size_x - transducer_x[-1]) / 2))
-
-transducer_z = np.full(num_transducers, 100, dtype=np.int32)  # Não colocar microfones no índice 0.
-
-# Speed (m/s)
-c_water = np.float32(1500)
-c = np.full(grid_size_shape, fill_value=c_water, dtype=np.float32)
-
-N = 2
-cpml_absorption_layer_size = 50
-R_c = 0.001
-d0 = - ( (N+1) * c_water ) / [ 2 * (cpml_absorption_layer_size * dx) ] * np.log(R_c)
-
-global_sim_params = {
-    'dt': dt,
-    'c': c,
-    'dz': dz,
-    'dx': dx,
-    'grid_size_z': grid_size_z,
-    'grid_size_x': grid_size_x,
-    'total_time': total_time,
-
-    'cpml_absorption_layer_size': cpml_absorption_layer_size,
-    'damping_coefficient': d0,
-
-    'num_transducers': num_transducers,
-
-    'transducer_z': transducer_z,
-    'transducer_x': transducer_x,
-}
-
-bscan = bscan[apex_idx-offset_idx:apex_idx+offset_idx, :]
-
-tr_config = {
-    'bscan': bscan
-}
-
-global_sim_params.update(tr_config)
-
-tr_sim = DAS_TimeReversal(**global_sim_params)
+# The workers of DecomposedTimeReversal are spawned and import this file again, the B-scan is loaded, planned and
+# resampled only in the main process
+if __name__ == "__main__":
+    # Memory-mapped, DAS_TimeReversal streams it to the GPU in time windows
+    bscan = np.load('./aquisicao_40km_50ns_21_10_2024_ds19_17500m_24000m_40705s_40715s_fs900Hz.npy', mmap_mode='r')
+
+    spatial_start = 17500
+    spatial_end = 24000
+
+    acquisition_step = np.float32(1. / 400e6)
+    nu = 3e8 / 1.4682
+    dx_original = np.float32((acquisition_step * (nu / 2.)))
+
+    offset_idx = 300
+    apex_idx = 696
+
+    fs = 900
+    channel_spacing = np.float32((spatial_end - spatial_start) / bscan.shape[0])
+
+    num_transducers = int(offset_idx * 2)
+
+    bscan = bscan[apex_idx-offset_idx:apex_idx+offset_idx, :]
+
+    # Grid em metros
+    size_meters_z = np.float32((spatial_end - spatial_start) + 10000)
+    size_meters_x = np.float32((spatial_end - spatial_start) + 10000)
+
+    # Speed (m/s)
+    c_water = np.float32(1500)
+
+    # dt and the grid spacing are planned from the B-scan spectrum: the coarsest spacing (at most the channel spacing) with
+    # enough points per wavelength and the largest stable time step on it. The spectrum is estimated from a few windows of
+    # the memory-mapped B-scan, which is resampled to the time step channel by channel into a file, memory-mapped as well
+    plan = plan_grid(
+        signal=bscan,
+        signal_dt=1. / fs,
+        c_min=c_water,
+        c_max=c_water,
+        size_z=size_meters_z,
+        size_x=size_meters_x,
+        max_spacing=channel_spacing,
+        spectrum_window=4096,
+        resampled_path='./bscan_resampled.npy',
+    )
+    bscan = plan['signal']
+
+    dx = plan['dx']
+    dz = plan['dz']
+    dt = plan['dt']
+
+    total_time = plan['total_time']
+
+    grid_size_z = plan['grid_size_z']
+    grid_size_x = plan['grid_size_x']
+    grid_size_shape = (grid_size_z, grid_size_x)
+
+    print(f'{grid_size_shape = }')
+
+    # Microphones' position
+    transducer_x = []
+    for rp in range(num_transducers):
+        transducer_x.append(np.round((channel_spacing * rp) / dx))
+    transducer_x = (np.int32(np.asarray(transducer_x))
+                        + np.int32((grid_size_x - transducer_x[-1]) / 2))
+
+    transducer_z = np.full(num_transducers, 100, dtype=np.int32)  # Não colocar microfones no índice 0.
+
+    c = np.full(grid_size_shape, fill_value=c_water, dtype=np.float32)
+
+    N = 2
+    cpml_absorption_layer_size = 50
+    R_c = 0.001
+    d0 = - ( (N+1) * c_water ) / [ 2 * (cpml_absorption_layer_size * dx) ] * np.log(R_c)
+
+    global_sim_params = {
+        'dt': dt,
+        'c': c,
+        'dz': dz,
+        'dx': dx,
+        'grid_size_z': grid_size_z,
+        'grid_size_x': grid_size_x,
+        'total_time': total_time,
+
+        'cpml_absorption_layer_size': cpml_absorption_layer_size,
+        'damping_coefficient': d0,
+
+        'num_transducers': num_transducers,
+
+        'transducer_z': transducer_z,
+        'transducer_x': transducer_x,
+    }
+
+    tr_config = {
+        'bscan': bscan,
+        # The first 400 samples of the acquisition, at the resampled rate
+        'muted_samples': int(round(400 / (fs * dt))),
+    }
+
+    global_sim_params.update(tr_config)
+
+    # Slabs of the grid propagated by separate worker processes (each with its own device) that swap halo rows every step,
+    # for grids that don't fit one device. 1 runs the whole grid in this process
+    num_subdomains = 1
+
+    if num_subdomains > 1:
+        tr_sim = DecomposedTimeReversal(num_subdomains=num_subdomains, **global_sim_params)
+    else:
+        tr_sim = DAS_TimeReversal(**global_sim_params)
@@ -0,0 +1,405 @@
+import numpy as np
+import re
+import time
+from pathlib import Path
+from profiling import write_trace
+from backends import step_dispatches, WAVEFIELD_ROLES, STENCIL_COEFFICIENTS
+
+
+WGSL_DTYPES = {
+    "f32": np.float32,
+    "i32": np.int32,
+    "u32": np.uint32,
+}
+
+
+class NumpyHandler:
+    def __init__(self):
+        self.shader_string = None
+        self.roi_size = None
+        self.num_shots = 1
+        self.shots_shape = ()
+        self.stencil_radius = 1
+        self.wavefield_dtype = np.float32
+        self.buffers = {}
+        self.buffers_info = []
+        self.uniforms = {}
+        # Host-device traffic and allocated buffer memory, as counted by WebGpuHandler
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.allocated_bytes = 0
+        # Profiling mode, every kernel call is timed on the host
+        self.profiling = False
+        self.profile_events = []
+
+    def create_shader_module(self, shader_path, roi_size, workgroup_size: tuple, constants=None, wavefield_precision="f32"):
+        # The shader is only parsed for its bindings, the entry points are implemented below with NumPy
+        # A third roi dimension is the amount of shots, stored as a leading axis of the wavefield buffers
+        self.roi_size = tuple(int(s) for s in roi_size[:2])
+        self.num_shots = int(roi_size[2]) if len(roi_size) > 2 else 1
+        self.shots_shape = (self.num_shots,) if self.num_shots > 1 else ()
+        self.shader_string = Path(shader_path).read_text(encoding='utf-8')
+        self.stencil_radius = int((constants or {}).get("stencil_radius", 1))
+
+        # The array<wavefield> buffers are float16 in the half precision mode, the kernels compute in float32 and round
+        # once when storing, as the shaders do
+        self.wavefield_dtype = np.float16 if wavefield_precision == "f16" else np.float32
+
+        # Box the active region of the grid kernels is centred on, see active_region_z/active_region_x in the shaders
+        self.active_box = {
+            axis: (int((constants or {}).get(f"active_box_{axis}", 0)), int((constants or {}).get(f"active_box_size_{axis}", 0)))
+            for axis in ["z", "x"]
+        }
+        self.workgroups = None
+
+    def set_buffers(self, data, *copy_src_buffers):
+        re_pattern = r"@group\((\d+)\)\s+@binding\((\d+)\)\s+var<([^>]+)>\s+(\w+)\s*:\s*([^;]+);"
+        matches = re.findall(re_pattern, self.shader_string)
+
+        for m in matches:
+            self.buffers_info.append({
+                "group": int(m[0]),
+                "binding": int(m[1]),
+                "name": m[3],
+                "type": m[4].strip(),
+                "data": data[m[3]][0],
+                "zero_initialized": data[m[3]][1],
+            })
+
+    def create_buffers(self, debug=False):
+        structs = self.parse_structs()
+
+        for v in self.buffers_info:
+            element_type = re.sub(r"array<(\w+)>", r"\1", v["type"])
+
+            if v["zero_initialized"] and element_type == "wavefield":
+                # Sized as float32 by the simulations
+                buffer = np.zeros(v["data"] // np.dtype(np.float32).itemsize, dtype=self.wavefield_dtype)
+            elif v["zero_initialized"]:
+                dtype = WGSL_DTYPES[element_type]
+                buffer = np.zeros(v["data"] // np.dtype(dtype).itemsize, dtype=dtype)
+            else:
+                buffer = np.array(v["data"])
+
+            # Grid sized buffers are kept 2D (3D with a leading shot axis) so the kernels can work with slices
+            if buffer.ndim <= 1 and buffer.size == np.prod(self.roi_size):
+                buffer = buffer.reshape(self.roi_size)
+            elif buffer.ndim <= 1 and buffer.size == self.num_shots * np.prod(self.roi_size):
+                buffer = buffer.reshape(self.shots_shape + self.roi_size)
+
+            self.buffers[v["name"]] = buffer
+            self.allocated_bytes += buffer.nbytes
+            if not v["zero_initialized"]:
+                self.bytes_uploaded += buffer.nbytes
+
+            if element_type in structs:
+                self.uniforms.update(zip(structs[element_type], buffer.ravel()))
+
+            if debug:
+                print(f"\nCreated buffer:\nName: {v["name"]}\nSize: {buffer.nbytes}\nGroup: {v["group"]}\nBinding: {v["binding"]}")
+
+        if "recordings" in self.buffers:
+            self.buffers["recordings"] = self.buffers["recordings"].reshape(self.shots_shape + (-1, self.uniforms["num_transducers"]))
+
+        # CPML memory variables only cover the absorbing strips, see z_strip/x_strip in the shaders
+        layer_size = int(self.uniforms["absorption_layer_size"])
+        grid_size_z, grid_size_x = self.roi_size
+        for name in ["phi_z", "psi_z"]:
+            self.buffers[name] = self.buffers[name].reshape(self.shots_shape + (2 * layer_size, grid_size_x))
+        for name in ["phi_x", "psi_x"]:
+            self.buffers[name] = self.buffers[name].reshape(self.shots_shape + (grid_size_z, 2 * layer_size))
+
+        # (grid slice, strip slice, scratch) for the two strips of each axis
+        self.strips = {"z": [], "x": []}
+        for axis, grid_size in [("z", grid_size_z), ("x", grid_size_x)]:
+            for grid_slice, strip_slice in [
+                (slice(0, layer_size), slice(0, layer_size)),
+                (slice(grid_size - layer_size + 1, grid_size), slice(layer_size + 1, 2 * layer_size)),
+            ]:
+                shape = (grid_slice.stop - grid_slice.start, grid_size_x) if axis == "z" else (grid_size_z, grid_slice.stop - grid_slice.start)
+                self.strips[axis].append((grid_slice, strip_slice, np.zeros(self.shots_shape + shape, dtype=np.float32)))
+
+        # Damping profiles shaped to broadcast against the grid
+        self.absorption = {
+            "z": self.buffers["absorption_z"][:, np.newaxis],
+            "x": self.buffers["absorption_x"][np.newaxis, :],
+        }
+        self.absorption_minus_one = {k: v - np.float32(1) for k, v in self.absorption.items()}
+
+        self.c_squared = np.square(self.buffers["c"])
+        self.dt_squared = self.uniforms["dt"] * self.uniforms["dt"]
+        self.scratch = np.zeros(self.shots_shape + self.roi_size, dtype=np.float32)
+        if self.wavefield_dtype != np.float32:
+            self.wavefield_scratch = np.zeros(self.shots_shape + self.roi_size, dtype=np.float32)
+        self.derivatives = {
+            k: self.buffers.get(k, np.zeros(self.shots_shape + self.roi_size, dtype=np.float32)) for k in ["dp_1_z", "dp_1_x", "dp_2_z", "dp_2_x"]
+        }
+
+    def parse_structs(self):
+        structs = {}
+        for name, body in re.findall(r"struct\s+(\w+)\s*\{([^}]*)\}", self.shader_string):
+            structs[name] = re.findall(r"(\w+)\s*:", body)
+        return structs
+
+    def create_bind_group_layouts(self):
+        pass
+
+    def create_pipeline_layout(self):
+        pass
+
+    def create_bind_groups(self):
+        pass
+
+    def get_num_workgroups(self, roi_size):
+        # One cell per invocation, only the grid kernels of an active region dispatch look at it
+        return [int(s) for s in roi_size]
+
+    def create_compute_pipeline(self, entry_point):
+        return getattr(self, entry_point)
+
+    def dispatch_pipelines(self, pipelines, steps=1, first_step=0):
+        for step in range(first_step, first_step + steps):
+            self.rotate_wavefields()
+
+            for compute_pipeline, workgroups in step_dispatches(pipelines, step):
+                self.workgroups = workgroups
+
+                if self.profiling:
+                    start = time.perf_counter_ns()
+                    compute_pipeline()
+                    self.profile_events.append((compute_pipeline.__name__, "host", start, time.perf_counter_ns()))
+                else:
+                    compute_pipeline()
+
+    def active_window(self):
+        # (z, x) slices of the cells a grid kernel is dispatched over, the whole grid unless it is an active region
+        # dispatch. Same origin as active_region_z/active_region_x in the shaders
+        if self.workgroups is None:
+            return slice(None), slice(None)
+
+        window = []
+        for axis, threads, grid_size in zip(["z", "x"], self.workgroups, self.roi_size):
+            start, size = self.active_box[axis]
+            origin = max(min(start - (threads - size) // 2, grid_size - threads), 0)
+            window.append(slice(origin, origin + threads))
+
+        return tuple(window)
+
+    def rotate_wavefields(self):
+        # Same roles as the bind groups of WebGpuHandler at the start of a step, the arrays are swapped, not copied
+        if all(name in self.buffers for name in WAVEFIELD_ROLES):
+            p_next, p_current, p_previous = (self.buffers[name] for name in WAVEFIELD_ROLES)
+            self.buffers["p_next"], self.buffers["p_current"], self.buffers["p_previous"] = p_previous, p_next, p_current
+
+    def enable_profiling(self):
+        self.profiling = True
+        self.profile_events = []
+
+    def write_profile(self, path):
+        write_trace(path, self.profile_events, backend="numpy", timestamp_queries=False)
+
+    def read_buffer(self, group, binding, offset=0, size=None):
+        # The whole buffer, or size bytes from offset
+        for v in self.buffers_info:
+            if v["group"] == group and v["binding"] == binding:
+                data = np.ravel(self.buffers[v["name"]]).view(np.uint8)
+                size = data.size - offset if size is None else size
+                self.bytes_downloaded += size
+                start = time.perf_counter_ns()
+                data = memoryview(data[offset:offset + size].tobytes())
+                if self.profiling:
+                    self.profile_events.append((f"read_buffer {v['name']}", "host", start, time.perf_counter_ns()))
+                return data
+        return None
+
+    def write_buffer(self, name, data, offset=0):
+        buffer = self.buffers[name].reshape(-1)
+        start = offset // buffer.itemsize
+        buffer[start:start + np.size(data)] = np.ravel(data)
+        self.bytes_uploaded += np.size(data) * buffer.itemsize
+
+    def copy_buffer(self, name, handler, handler_name):
+        np.copyto(handler.buffers[handler_name], self.buffers[name].reshape(handler.buffers[handler_name].shape))
+
+    def staggered_diff(self, p, diff, axis, shift):
+        # diff[n] = sum_k a_k * (p[n + k + shift] - p[n - k - 1 + shift]) / d, shift 1 is the forward difference (staggered
+        # half a cell forward) and 0 the backward one. Cells whose stencil leaves the grid are left untouched as in the shader
+        radius = self.stencil_radius
+        window_z, window_x = self.active_window()
+        size = p.shape[-2] if axis == "z" else p.shape[-1]
+
+        first, last, _ = (window_z if axis == "z" else window_x).indices(size)
+        first, last = max(first, radius - shift), min(last, size - radius + 1 - shift)
+        if last <= first:
+            return
+
+        def along(array, start):
+            # The cells n + start of every n computed
+            cells = slice(first + start, last + start)
+            return array[..., cells, window_x] if axis == "z" else array[..., window_z, cells]
+
+        out = along(diff, 0)
+        np.subtract(along(p, shift), along(p, shift - 1), out=out, dtype=np.float32)
+
+        if radius > 1:
+            scratch = along(self.scratch, 0)
+            np.multiply(out, STENCIL_COEFFICIENTS[radius][0], out=out)
+            for k, coefficient in enumerate(STENCIL_COEFFICIENTS[radius][1:], start=1):
+                np.subtract(along(p, k + shift), along(p, shift - 1 - k), out=scratch, dtype=np.float32)
+                np.multiply(scratch, coefficient, out=scratch)
+                np.add(out, scratch, out=out)
+
+        np.divide(out, self.uniforms["dz"] if axis == "z" else self.uniforms["dx"], out=out)
+
+    def first_order_diff(self, p, dp_1_z, dp_1_x):
+        self.staggered_diff(p, dp_1_z, "z", 1)
+        self.staggered_diff(p, dp_1_x, "x", 1)
+
+    def second_order_diff(self, dp_1_z, dp_1_x, dp_2_z, dp_2_x):
+        self.staggered_diff(dp_1_z, dp_2_z, "z", 0)
+        self.staggered_diff(dp_1_x, dp_2_x, "x", 0)
+
+    def cpml_strips(self, memory, diff, axis):
+        # Yields (memory, diff, absorption, absorption - 1, scratch) views over each absorbing strip
+        for grid_slice, strip_slice, scratch in self.strips[axis]:
+            if axis == "z":
+                yield (memory[..., strip_slice, :], diff[..., grid_slice, :], self.absorption["z"][grid_slice, :],
+                       self.absorption_minus_one["z"][grid_slice, :], scratch)
+            else:
+                yield (memory[..., strip_slice], diff[..., grid_slice], self.absorption["x"][:, grid_slice],
+                       self.absorption_minus_one["x"][:, grid_slice], scratch)
+
+    def update_cpml_memory(self, memory, diff, axis):
+        # memory = absorption * memory + (absorption - 1) * diff
+        for memory_strip, diff_strip, absorption, absorption_minus_one, scratch in self.cpml_strips(memory, diff, axis):
+            if memory_strip.dtype == np.float32:
+                np.multiply(absorption, memory_strip, out=memory_strip)
+                np.multiply(absorption_minus_one, diff_strip, out=scratch)
+                np.add(memory_strip, scratch, out=memory_strip)
+            else:
+                np.multiply(absorption_minus_one, diff_strip, out=scratch)
+                np.add(scratch, absorption * memory_strip, out=memory_strip)
+
+    def add_cpml_memory(self, memory, diff, axis):
+        for memory_strip, diff_strip, _, _, _ in self.cpml_strips(memory, diff, axis):
+            np.add(diff_strip, memory_strip, out=diff_strip)
+
+    def apply_cpml(self, memory, diff, axis):
+        self.update_cpml_memory(memory, diff, axis)
+        self.add_cpml_memory(memory, diff, axis)
+
+    def leapfrog(self, dp_2_z, dp_2_x):
+        z, x = self.active_window()
+        p_next = self.buffers["p_next"][..., z, x]
+        scratch = self.scratch[..., z, x]
+        i = self.buffers["i"]
+
+        # A float16 p_next is only rounded once, the update is computed in float32 aside
+        update = p_next if p_next.dtype == np.float32 else self.wavefield_scratch[..., z, x]
+
+        np.add(dp_2_z[..., z, x], dp_2_x[..., z, x], out=update)
+        np.multiply(self.c_squared[z, x], update, out=update)
+        np.multiply(update, self.dt_squared, out=update)
+
+        np.multiply(self.buffers["p_current"][..., z, x], np.float32(2), out=scratch)
+        np.subtract(scratch, self.buffers["p_previous"][..., z, x], out=scratch)
+        np.add(update, scratch, out=p_next)
+
+        # The sources always lie inside the active region
+        if "source" in self.buffers:
+            source_zx = self.buffers["source_zx"].reshape(-1, 2)
+            shots = np.arange(source_zx.shape[0])
+            self.buffers["p_next"].reshape((-1,) + self.roi_size)[shots, source_zx[:, 0], source_zx[:, 1]] += self.buffers["source"][i]
+
+    def forward_diff(self):
+        self.first_order_diff(self.buffers["p_current"], self.buffers["dp_1_z"], self.buffers["dp_1_x"])
+
+    def backward_diff(self):
+        self.second_order_diff(self.buffers["dp_1_z"], self.buffers["dp_1_x"], self.buffers["dp_2_z"], self.buffers["dp_2_x"])
+
+    def apply_cpml_to_first_order_diff_z(self):
+        self.apply_cpml(self.buffers["phi_z"], self.buffers["dp_1_z"], "z")
+
+    def apply_cpml_to_first_order_diff_x(self):
+        self.apply_cpml(self.buffers["phi_x"], self.buffers["dp_1_x"], "x")
+
+    def apply_cpml_to_second_order_diff_z(self):
+        self.apply_cpml(self.buffers["psi_z"], self.buffers["dp_2_z"], "z")
+
+    def apply_cpml_to_second_order_diff_x(self):
+        self.apply_cpml(self.buffers["psi_x"], self.buffers["dp_2_x"], "x")
+
+    def simulate(self):
+        self.leapfrog(self.buffers["dp_2_z"], self.buffers["dp_2_x"])
+
+    def fused_first_order_diff(self):
+        # The fused shader has no derivative buffers, NumPy still needs scratch grids for the intermediate results
+        dp_1_z, dp_1_x = self.derivatives["dp_1_z"], self.derivatives["dp_1_x"]
+
+        self.first_order_diff(self.buffers["p_current"], dp_1_z, dp_1_x)
+        self.update_cpml_memory(self.buffers["phi_z"], dp_1_z, "z")
+        self.update_cpml_memory(self.buffers["phi_x"], dp_1_x, "x")
+
+    def fused_simulate(self):
+        dp_1_z, dp_1_x = self.derivatives["dp_1_z"], self.derivatives["dp_1_x"]
+        dp_2_z, dp_2_x = self.derivatives["dp_2_z"], self.derivatives["dp_2_x"]
+
+        self.first_order_diff(self.buffers["p_current"], dp_1_z, dp_1_x)
+        self.add_cpml_memory(self.buffers["phi_z"], dp_1_z, "z")
+        self.add_cpml_memory(self.buffers["phi_x"], dp_1_x, "x")
+        self.second_order_diff(dp_1_z, dp_1_x, dp_2_z, dp_2_x)
+        self.apply_cpml(self.buffers["psi_z"], dp_2_z, "z")
+        self.apply_cpml(self.buffers["psi_x"], dp_2_x, "x")
+        self.leapfrog(dp_2_z, dp_2_x)
+
+    def record_transducers(self):
+        ring_index = self.buffers["i"] % self.uniforms["ring_length"]
+        recordings = self.buffers["recordings"].reshape(self.num_shots, -1, self.uniforms["num_transducers"])
+        p_next = self.buffers["p_next"].reshape((self.num_shots,) + self.roi_size)
+        recordings[:, ring_index] = p_next[:, self.buffers["transducer_z"], self.buffers["transducer_x"]]
+
+    def restore_transducers(self):
+        ring_index = self.buffers["i"] % self.uniforms["ring_length"]
+        recordings = self.buffers["recordings"].reshape(self.num_shots, -1, self.uniforms["num_transducers"])
+        cells = (self.buffers["transducer_z"], self.buffers["transducer_x"])
+
+        for shot, p_next in enumerate(self.buffers["p_next"].reshape((self.num_shots,) + self.roi_size)):
+            p_next[cells] = recordings[shot, ring_index]
+
+    def inject_transducers(self):
+        i = self.buffers["i"]
+        if i >= self.uniforms["num_samples"]:
+            return
+
+        sample = self.buffers["flipped_bscan"].reshape(-1, self.uniforms["num_transducers"])[i % self.uniforms["ring_length"]]
+        cells = (self.buffers["transducer_z"], self.buffers["transducer_x"])
+        self.buffers["p_next"][cells] += sample
+
+    def accumulate_image(self):
+        z, x = self.active_window()
+        p_next = self.buffers["p_next"][z, x]
+        image = self.buffers["image"][z, x]
+        scratch = self.scratch[z, x]
+        i = self.buffers["i"]
+
+        rows = np.ones((self.roi_size[0], 1), dtype=bool)
+        rows[self.uniforms["excluded_band_start"]:self.uniforms["excluded_band_end"]] = False
+        rows = rows[z]
+
+        if self.uniforms["imaging_condition"] == 0 or (
+            self.uniforms["imaging_condition"] == 2 and self.uniforms["window_start"] <= i < self.uniforms["window_end"]
+        ):
+            np.square(p_next, out=scratch, dtype=np.float32)
+            np.add(image, scratch, out=image, where=rows)
+        elif self.uniforms["imaging_condition"] == 1:
+            np.abs(p_next, out=scratch, dtype=np.float32)
+            np.maximum(image, scratch, out=image, where=rows)
+        elif self.uniforms["imaging_condition"] == 3:
+            illumination = self.buffers["illumination"][z, x]
+            np.multiply(p_next, self.buffers["source_wavefield"][z, x], out=scratch, dtype=np.float32)
+            np.add(image, scratch, out=image, where=rows)
+            np.square(self.buffers["source_wavefield"][z, x], out=scratch)
+            np.add(illumination, scratch, out=illumination, where=rows)
+
+    def increment_time(self):
+        self.buffers["i"] += 1
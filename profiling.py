@@ -0,0 +1,50 @@
+import numpy as np
+import json
+from pathlib import Path
+
+
+def profile_statistics(events):
+    # Per-kernel count, total, mean, min and max duration (ms) and share of the profiled time. Events are
+    # (name, track, start, end) in nanoseconds
+    durations = {}
+    for name, _, start, end in events:
+        durations.setdefault(name, []).append((end - start) * 1e-6)
+
+    total = sum(sum(d) for d in durations.values())
+
+    return {
+        name: {
+            "count": len(d),
+            "total_ms": float(np.sum(d)),
+            "mean_ms": float(np.mean(d)),
+            "min_ms": float(np.min(d)),
+            "max_ms": float(np.max(d)),
+            "share": float(np.sum(d) / total) if total > 0 else 0.0,
+        }
+        for name, d in sorted(durations.items(), key=lambda item: -sum(item[1]))
+    }
+
+
+def write_trace(path, events, **other_data):
+    # Chrome trace event format (chrome://tracing, Perfetto), the statistics are kept under "otherData". The clocks
+    # of the tracks (GPU, host) aren't related, each track starts at 0
+    origins = {}
+    for _, track, start, _ in events:
+        origins[track] = min(origins.get(track, start), start)
+
+    statistics = profile_statistics(events)
+
+    trace = {
+        "traceEvents": [
+            {"name": name, "ph": "X", "pid": 0, "tid": track, "ts": (start - origins[track]) * 1e-3, "dur": (end - start) * 1e-3}
+            for name, track, start, end in events
+        ],
+        "displayTimeUnit": "ms",
+        "otherData": dict(other_data, kernels=statistics),
+    }
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text(json.dumps(trace), encoding='utf-8')
+
+    for name, stats in statistics.items():
+        print(f'{name:>34}: {stats["count"]:>7} x {stats["mean_ms"]:.4f} ms = {stats["total_ms"]:.2f} ms ({stats["share"]:.1%})')
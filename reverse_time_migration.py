@@ -1,227 +1,406 @@
-import os
 import numpy as np
-from SimulationConfig import SimulationConfig
-from WebGpuHandler import WebGpuHandler
-from functions import save_rtm_image, create_video
-import matplotlib.pyplot as plt
+from math import comb
+from backends import create_handler, create_step_pipelines, batch_steps, pack_injection_points, IMAGING_CONDITIONS
+from simulation_handler import SimulationHandler
+from pathlib import Path
 
 
-class SyntheticReverseTimeMigration(SimulationConfig):
-    def __init__(self, **simulation_config):
-        super().__init__(**simulation_config)
+def binomial_checkpointing(num_steps, num_checkpoints):
+    # Revolve-style schedule to visit the forward states num_steps - 1, ..., 0 in reverse order keeping at most
+    # num_checkpoints stored states (the state of step 0 included). Yields ("advance", steps), ("store", step),
+    # ("restore", step), ("discard", step) and ("reverse", step) actions. "reverse" runs forward step `step` from
+    # its state, so the forward wavefield of that step is available to the imaging condition
+    def beta(snapshots, repetitions):
+        # Steps reversible with `snapshots` stored states when no step is advanced more than `repetitions` times
+        return comb(snapshots + repetitions, snapshots)
 
-        self.reflector_z, self.reflector_x = np.int32(np.where(self.c == 0))
-        self.reflectors_amount = np.int32(len(self.reflector_z))
+    # ("reverse", start, length, snapshots) tasks and pending actions, kept on an explicit stack since there can be
+    # as many nested tasks as checkpoints. A task starts with the state of `start` stored (taking one of the
+    # snapshots) and the forward simulation at `start`
+    tasks = [("reverse", 0, num_steps, max(num_checkpoints, 1))]
 
-        self.c = self.c.copy()
+    yield ("store", 0)
 
-        self.c[self.c == np.float32(0)] = simulation_config['medium_c']
+    while tasks:
+        task = tasks.pop()
+        if len(task) == 2:
+            yield task
+            continue
 
-        self.emitter_index = simulation_config['emitter_index']
+        _, start, length, snapshots = task
 
-        # Create folders
-        self.folder = './SyntheticRTM'
-        self.frames_folder = f'{self.folder}/frames'
-        os.makedirs(self.frames_folder, exist_ok=True)
-        self.tr_folder = './SyntheticTR'
+        if length > 1 and snapshots > 1:
+            repetitions = 0
+            while beta(snapshots, repetitions) < length:
+                repetitions += 1
 
-        # Source
-        self.source = np.load('./source.npy').astype(np.float32)
-        if len(self.source) < self.total_time:
-            self.source = np.pad(self.source, (0, self.total_time - len(self.source)), 'constant').astype(np.float32)
-        elif len(self.source) > self.total_time:
-            self.source = self.source[:self.total_time]
+            # Both halves stay within `repetitions` since beta(s, r) = beta(s, r - 1) + beta(s - 1, r)
+            split = min(beta(snapshots, repetitions - 1), length - 1)
 
-        # Source's position
-        self.source_z = simulation_config['source_z']
-        self.source_x = simulation_config['source_x']
-
-        # Up-going pressure fields (Flipped Time Reversal)
-        self.p_future_flipped_tr = np.zeros(self.grid_size_shape, dtype=np.float32)
-        self.p_present_flipped_tr = np.load(f'{self.tr_folder}/second_to_last_frame.npy')
-        self.p_past_flipped_tr = np.load(f'{self.tr_folder}/last_frame.npy')
-
-        # Partial derivatives (Flipped Time Reversal)
-        self.dp_1_z_flipped_tr = np.zeros(self.grid_size_shape, dtype=np.float32)
-        self.dp_1_x_flipped_tr = np.zeros(self.grid_size_shape, dtype=np.float32)
-        self.dp_2_z_flipped_tr = np.zeros(self.grid_size_shape, dtype=np.float32)
-        self.dp_2_x_flipped_tr = np.zeros(self.grid_size_shape, dtype=np.float32)
-
-        # CPML (Flipped Time Reversal)
-        self.psi_z_flipped_tr = self.psi_z.copy()
-        self.psi_x_flipped_tr = self.psi_x.copy()
-        self.phi_z_flipped_tr = self.phi_z.copy()
-        self.phi_x_flipped_tr = self.phi_x.copy()
-        self.absorption_z_flipped_tr = self.absorption_z.copy()
-        self.absorption_x_flipped_tr = self.absorption_x.copy()
-        self.is_z_absorption_int_flipped_tr = self.is_z_absorption_int.copy()
-        self.is_x_absorption_int_flipped_tr = self.is_x_absorption_int.copy()
-
-        # WebGPU buffer
-        self.info_i32 = np.array(
-            [
-                self.grid_size_z,
-                self.grid_size_x,
-                self.source_z,
-                self.source_x,
-                0,
-            ],
-            dtype=np.int32
-        )
+            yield ("advance", split)
+            yield ("store", start + split)
 
-        # WebGPU buffer
-        self.info_f32 = np.array(
-            [
-                self.dz,
-                self.dx,
-                self.dt,
-            ],
-            dtype=np.float32
-        )
+            # Right part first with one snapshot less, then the left part from `start` again
+            tasks.append(("reverse", start, split, snapshots))
+            tasks.append(("restore", start))
+            tasks.append(("discard", start + split))
+            tasks.append(("reverse", start + split, length - split, snapshots - 1))
+            continue
 
-        self.wgpu_handler = None
-        self.setup_gpu()
+        # A single snapshot left, every step is recomputed from `start`
+        for step in range(start + length - 1, start - 1, -1):
+            if step != start + length - 1:
+                yield ("restore", start)
+            if step > start:
+                yield ("advance", step - start)
+            yield ("reverse", step)
 
-    def setup_gpu(self):
-        self.wgpu_handler = WebGpuHandler(shader_file='./reverse_time_migration.wgsl', wsz=self.grid_size_z, wsx=self.grid_size_x)
 
-        self.wgpu_handler.create_shader_module()
+class SyntheticReverseTimeMigration(SimulationHandler):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
 
-        # Data passed to gpu buffers
-        wgsl_data = {
-            'infoI32': self.info_i32,
-            'infoF32': self.info_f32,
-            'source': self.source,
-            'c': self.c,
-            'p_future': self.p_future,
-            'p_present': self.p_present,
-            'p_past': self.p_past,
-            'dp_1_z': self.dp_1_z,
-            'dp_1_x': self.dp_1_x,
-            'dp_2_z': self.dp_2_z,
-            'dp_2_x': self.dp_2_x,
-            'psi_z': self.psi_z,
-            'psi_x': self.psi_x,
-            'phi_z': self.phi_z,
-            'phi_x': self.phi_x,
-            'absorption_z': self.absorption_z,
-            'absorption_x': self.absorption_x,
-            'is_z_absorption': self.is_z_absorption_int,
-            'is_x_absorption': self.is_x_absorption_int,
-            'p_future_flipped_tr': self.p_future_flipped_tr,
-            'p_present_flipped_tr': self.p_present_flipped_tr,
-            'p_past_flipped_tr': self.p_past_flipped_tr,
-            'dp_1_z_flipped_tr': self.dp_1_z_flipped_tr,
-            'dp_1_x_flipped_tr': self.dp_1_x_flipped_tr,
-            'dp_2_z_flipped_tr': self.dp_2_z_flipped_tr,
-            'dp_2_x_flipped_tr': self.dp_2_x_flipped_tr,
-            'psi_z_flipped_tr': self.psi_z_flipped_tr,
-            'psi_x_flipped_tr': self.psi_x_flipped_tr,
-            'phi_z_flipped_tr': self.phi_z_flipped_tr,
-            'phi_x_flipped_tr': self.phi_x_flipped_tr,
-            'absorption_z_flipped_tr': self.absorption_z_flipped_tr,
-            'absorption_x_flipped_tr': self.absorption_x_flipped_tr,
-            'is_z_absorption_flipped_tr': self.is_z_absorption_int_flipped_tr,
-            'is_x_absorption_flipped_tr': self.is_x_absorption_int_flipped_tr,
-        }
+        # The forward wavefield is copied as is into the float32 source_wavefield buffer of the receiver simulation
+        if self.wavefield_precision != "f32":
+            raise ValueError("The reverse time migration only supports the f32 wavefield precision")
+
+        self.folder = Path(kwargs.get("output_folder", "./SyntheticRTM"))
+        self.folder.mkdir(parents=True, exist_ok=True)
 
-        self.wgpu_handler.create_buffers(wgsl_data)
+        self.emitter_index = kwargs.get("emitter_index", 0)
 
-    def run(self, generate_video: bool, animation_step: int):
-        compute_forward_diff = self.wgpu_handler.create_compute_pipeline("forward_diff")
-        compute_after_forward = self.wgpu_handler.create_compute_pipeline("after_forward")
-        compute_backward_diff = self.wgpu_handler.create_compute_pipeline("backward_diff")
-        compute_after_backward = self.wgpu_handler.create_compute_pipeline("after_backward")
-        compute_sim_flipped_tr = self.wgpu_handler.create_compute_pipeline("sim_flipped_tr")
-        compute_sim = self.wgpu_handler.create_compute_pipeline("sim")
-        compute_incr_time = self.wgpu_handler.create_compute_pipeline("incr_time")
+        self.source_z = kwargs["source_z"]
+        self.source_x = kwargs["source_x"]
 
-        accumulated_product = np.zeros(self.grid_size_shape, dtype=np.float32)
+        self.source = np.asarray(kwargs["source"] if "source" in kwargs else np.load('./source.npy')).astype(np.float32)
+        if len(self.source) < self.total_time:
+            self.source = np.pad(self.source, (0, self.total_time - len(self.source)), 'constant').astype(np.float32)
+        elif len(self.source) > self.total_time:
+            self.source = self.source[:self.total_time]
 
-        for i in range(self.total_time):
-            command_encoder = self.wgpu_handler.device.create_command_encoder()
-            compute_pass = command_encoder.begin_compute_pass()
+        # Recordings of the shot, (channel x time)
+        if "recordings" in kwargs:
+            self.bscan = kwargs["recordings"]
+        else:
+            self.bscan = np.load(f"{kwargs['recordings_folder']}/recordings.npy", mmap_mode='r')
+
+        # How the forward wavefield is brought back in reverse order, "checkpointing" recomputes it from stored states,
+        # "boundary_saving" reconstructs it backwards in time from the saved boundary band
+        self.wavefield_reconstruction = kwargs.get("wavefield_reconstruction", "checkpointing")
+        if self.wavefield_reconstruction not in ["checkpointing", "boundary_saving"]:
+            raise ValueError(f"Unknown wavefield reconstruction: {self.wavefield_reconstruction}")
+
+        # Forward states kept in host memory at the same time, the forward wavefield is recomputed from them. Or the host
+        # memory for them in bytes, as many states as fit are kept
+        self.num_checkpoints = int(kwargs.get("checkpoints", 10))
+        self.checkpoint_memory = kwargs.get("checkpoint_memory")
+
+        # Boundary saving reconstructs the region strictly inside the band, the band is as wide as the stencil reach
+        # (forward then backward differences, 2 * stencil_radius - 1 cells) and lies just inside the CPML layer, where
+        # the propagation doesn't depend on the absorption
+        self.band_width = 2 * self.stencil_radius - 1
+        self.reconstructed_region = (
+            slice(self.absorption_layer_size + self.band_width, self.grid_size_z - self.absorption_layer_size - self.band_width + 1),
+            slice(self.absorption_layer_size + self.band_width, self.grid_size_x - self.absorption_layer_size - self.band_width + 1),
+        )
+        if self.wavefield_reconstruction == "boundary_saving":
+            self.band_z, self.band_x = self.boundary_band()
+            # Timesteps of the band kept in the GPU ring, it is drained to host memory every time it fills up during
+            # the forward pass and refilled with the time reversed band during the backward one
+            self.recorded_steps = int(min(kwargs.get("band_chunk", 1024), self.total_time))
+        else:
+            self.band_z, self.band_x = np.asarray(self.transducer_z), np.asarray(self.transducer_x)
+            self.recorded_steps = 1
+
+        # Both wavefields are propagated in the smooth model (c), without the reflectors
+        self.forward_handler = self.create_forward_handler()
+        self.receiver_handler = self.create_receiver_handler()
+
+        receiver_pipelines = create_step_pipelines(
+            self.receiver_handler, self.kernel_mode, self.grid_size_shape, self.absorption_layer_size,
+            after_step=[("inject_transducers", [(self.injection_z.size + 63) // 64]), ("accumulate_image", None)]
+        )
 
-            for index, bind_group in enumerate(self.wgpu_handler.bind_groups):
-                compute_pass.set_bind_group(index, bind_group, [], 0, 999999)
+        if self.wavefield_reconstruction == "boundary_saving":
+            self.migrate_with_boundary_saving(receiver_pipelines)
+        else:
+            self.migrate_with_checkpointing(receiver_pipelines)
 
-            compute_pass.set_pipeline(compute_forward_diff)
-            compute_pass.dispatch_workgroups(self.grid_size_z // self.wgpu_handler.ws[0],
-                                             self.grid_size_x // self.wgpu_handler.ws[1])
+        self.image = self.receiver_handler.read_buffer(group=2, binding=0)
+        self.image = np.frombuffer(self.image, dtype=np.float32).reshape(self.grid_size_shape).copy()
+        self.illumination = self.receiver_handler.read_buffer(group=2, binding=1)
+        self.illumination = np.frombuffer(self.illumination, dtype=np.float32).reshape(self.grid_size_shape).copy()
 
-            compute_pass.set_pipeline(compute_after_forward)
-            compute_pass.dispatch_workgroups(self.grid_size_z // self.wgpu_handler.ws[0],
-                                             self.grid_size_x // self.wgpu_handler.ws[1])
+        # Outside the band the reconstructed forward wavefield is meaningless, only the region inside is imaged
+        if self.wavefield_reconstruction == "boundary_saving":
+            image = np.zeros_like(self.image)
+            image[self.reconstructed_region] = self.image[self.reconstructed_region]
+            self.image = image
 
-            compute_pass.set_pipeline(compute_backward_diff)
-            compute_pass.dispatch_workgroups(self.grid_size_z // self.wgpu_handler.ws[0],
-                                             self.grid_size_x // self.wgpu_handler.ws[1])
+            illumination = np.zeros_like(self.illumination)
+            illumination[self.reconstructed_region] = self.illumination[self.reconstructed_region]
+            self.illumination = illumination
 
-            compute_pass.set_pipeline(compute_after_backward)
-            compute_pass.dispatch_workgroups(self.grid_size_z // self.wgpu_handler.ws[0],
-                                             self.grid_size_x // self.wgpu_handler.ws[1])
+        np.save(f'{self.folder}/accumulated_product_{self.emitter_index}.npy', self.image)
+        np.save(f'{self.folder}/source_illumination_{self.emitter_index}.npy', self.illumination)
 
-            compute_pass.set_pipeline(compute_sim_flipped_tr)
-            compute_pass.dispatch_workgroups(self.grid_size_z // self.wgpu_handler.ws[0],
-                                             self.grid_size_x // self.wgpu_handler.ws[1])
+        if not self.headless:
+            import matplotlib.pyplot as plt
 
-            compute_pass.set_pipeline(compute_sim)
-            compute_pass.dispatch_workgroups(self.grid_size_z // self.wgpu_handler.ws[0],
-                                             self.grid_size_x // self.wgpu_handler.ws[1])
+            plt.figure()
+            plt.imshow(self.image, aspect='auto', cmap='viridis', interpolation='none')
+            plt.scatter(self.reflector_x, self.reflector_z, s=0.05, color='red')
+            plt.colorbar()
+            plt.title("Reverse Time Migration")
+            plt.savefig(f'{self.folder}/accumulated_product_{self.emitter_index}.png', dpi=300)
+            plt.close()
 
-            compute_pass.set_pipeline(compute_incr_time)
-            compute_pass.dispatch_workgroups(1)
+        print('Reverse Time Migration finished.')
 
-            compute_pass.end()
-            self.wgpu_handler.device.queue.submit([command_encoder.finish()])
+    def migrate_with_checkpointing(self, receiver_pipelines):
+        forward_pipelines = create_step_pipelines(self.forward_handler, self.kernel_mode, self.grid_size_shape, self.absorption_layer_size)
+
+        # State of the forward simulation: what the next step reads, the time counter, the CPML memory variables and
+        # the two newest wavefields (the rotation binds them as p_current and p_previous, the oldest one is overwritten).
+        # The dp_* grids are scratch, recomputed every step
+        state_names = ["p_next", "p_current", "phi_z", "phi_x", "psi_z", "psi_x", "i"]
+        self.state_buffers = [
+            (v["name"], v["group"], v["binding"], np.int32 if v["name"] == "i" else np.float32)
+            for v in self.forward_handler.buffers_info if v["name"] in state_names
+        ]
+
+        state_nbytes = 2 * self.roi_nbytes + 2 * self.z_strips_nbytes + 2 * self.x_strips_nbytes + np.dtype(np.int32).itemsize
+        if self.checkpoint_memory is not None:
+            self.num_checkpoints = max(int(self.checkpoint_memory) // state_nbytes, 1)
+
+        checkpoints = {}
+        recomputed_steps = 0
+        reversed_steps = 0
+
+        for action, value in binomial_checkpointing(int(self.total_time), self.num_checkpoints):
+            if action == "advance":
+                self.forward_handler.dispatch_pipelines(forward_pipelines, value)
+                recomputed_steps += value
+            elif action == "store":
+                checkpoints[value] = self.read_state()
+            elif action == "restore":
+                self.write_state(checkpoints[value])
+            elif action == "discard":
+                del checkpoints[value]
+            elif action == "reverse":
+                # Forward step `value`, whose wavefield is cross-correlated with the receiver wavefield of the
+                # time reversed step total_time - 1 - value
+                self.forward_handler.dispatch_pipelines(forward_pipelines, 1)
+                self.forward_handler.copy_buffer("p_next", self.receiver_handler, "source_wavefield")
+                self.receiver_handler.dispatch_pipelines(receiver_pipelines, 1)
+                reversed_steps += 1
+
+                if reversed_steps % 300 == 0:
+                    print(f'Reverse Time Migration - {reversed_steps}/{self.total_time}')
+
+        print(f'Forward steps recomputed: {recomputed_steps} ({self.num_checkpoints} checkpoints of {state_nbytes / 2**20:.1f} MiB)')
+
+    def migrate_with_boundary_saving(self, receiver_pipelines):
+        total_time = int(self.total_time)
+        num_band_cells = self.band_z.size
+
+        ring_length = self.recorded_steps
+
+        # Forward pass, the band is recorded at every step into the ring, drained to host memory when it fills up
+        forward_pipelines = create_step_pipelines(
+            self.forward_handler, self.kernel_mode, self.grid_size_shape, self.absorption_layer_size,
+            after_step=[("record_transducers", [(num_band_cells + 63) // 64])]
+        )
+        record_step = lambda i: (i + 1) % ring_length == 0 or i == total_time - 1
+
+        band = np.empty((total_time, num_band_cells), dtype=np.float32)
+        for start, end in batch_steps(total_time, self.batch_size, record_step):
+            self.forward_handler.dispatch_pipelines(forward_pipelines, end - start, start)
+            i = end - 1
+
+            if record_step(i):
+                chunk_start = i - i % ring_length
+                chunk = np.frombuffer(self.forward_handler.read_buffer(group=2, binding=0), dtype=np.float32)
+                band[chunk_start:i + 1] = chunk.reshape(ring_length, num_band_cells)[:i + 1 - chunk_start]
+
+        # The two last states, p_next is the newest one and p_current the one before it in both kernel modes
+        last = np.frombuffer(self.read_forward_buffer("p_next"), dtype=np.float32).copy()
+        second_last = np.frombuffer(self.read_forward_buffer("p_current"), dtype=np.float32).copy()
+
+        # The leapfrog update is symmetric in time: with p_current = P(n - 1) and p_previous = P(n) the forward step
+        # gives P(n - 2). The rotation at the start of the step binds the p_next and p_current written here as
+        # p_current and p_previous, adding the source sample n. Reverse step k (from 0) gives P(total_time - 3 - k), with the
+        # time reversed source and band. The reversed band is uploaded into the ring one chunk at a time
+        self.forward_handler.write_buffer("p_current", last)
+        self.forward_handler.write_buffer("p_next", second_last)
+        self.forward_handler.write_buffer("source", np.ascontiguousarray(self.source[::-1]))
+        self.forward_handler.write_buffer("i", np.int32(0))
+
+        reverse_pipelines = create_step_pipelines(
+            self.forward_handler, self.kernel_mode, self.grid_size_shape, self.absorption_layer_size,
+            after_step=[("restore_transducers", [(num_band_cells + 63) // 64])]
+        )
 
-            """ READ BUFFERS """
-            self.p_future = (np.asarray(self.wgpu_handler.device.queue.read_buffer(self.wgpu_handler.buffers['b4']).cast("f"))
-                             .reshape(self.grid_size_shape))
-            self.p_future_flipped_tr = (np.asarray(self.wgpu_handler.device.queue.read_buffer(self.wgpu_handler.buffers['b19']).cast("f"))
-                             .reshape(self.grid_size_shape))
+        for step in range(total_time):
+            # Forward step total_time - 1 - step, cross-correlated with the receiver wavefield of the time reversed step
+            if step == 0:
+                self.receiver_handler.write_buffer("source_wavefield", last)
+            elif step == 1:
+                self.receiver_handler.write_buffer("source_wavefield", second_last)
+            else:
+                # Reverse step k = step - 2 restores the ring slot k % ring_length with the band of step
+                # total_time - 3 - k. The ring is refilled before its first slot is used, the write is ordered with
+                # the queued dispatches so the previous chunk is no longer read by then
+                k = step - 2
+                if k % ring_length == 0:
+                    end = total_time - 2 - k
+                    chunk = band[max(end - ring_length, 0):end][::-1]
+                    self.forward_handler.write_buffer("recordings", np.ascontiguousarray(chunk))
+                self.forward_handler.dispatch_pipelines(reverse_pipelines, 1)
+                self.forward_handler.copy_buffer("p_next", self.receiver_handler, "source_wavefield")
+
+            self.receiver_handler.dispatch_pipelines(receiver_pipelines, 1)
+
+            if (step + 1) % 300 == 0:
+                print(f'Reverse Time Migration - {step + 1}/{self.total_time}')
+
+        print(f'Boundary band saved: {num_band_cells} cells x {total_time} steps ({ring_length} steps on the GPU)')
+
+    def boundary_band(self):
+        # Cells of the band around the reconstructed region, row by row
+        z_band, x_band = self.reconstructed_region
+        band = np.zeros(self.grid_size_shape, dtype=bool)
+        band[z_band.start - self.band_width:z_band.stop + self.band_width, x_band.start - self.band_width:x_band.stop + self.band_width] = True
+        band[self.reconstructed_region] = False
+
+        band_z, band_x = np.nonzero(band)
+
+        return band_z.astype(np.int32), band_x.astype(np.int32)
+
+    def read_forward_buffer(self, name):
+        info = next(v for v in self.forward_handler.buffers_info if v["name"] == name)
+        return self.forward_handler.read_buffer(group=info["group"], binding=info["binding"])
+
+    def create_forward_handler(self):
+        info_i32 = np.array(
+            [
+                self.grid_size_z,
+                self.grid_size_x,
+                self.absorption_layer_size,
+                self.band_z.size,
+                self.recorded_steps,
+                1,
+            ],
+            dtype=np.int32
+        )
 
-            current_product = self.p_future * self.p_future_flipped_tr
-            accumulated_product += current_product
+        handler = create_handler(self.backend, self.device)
+        shader_path = "./synthetic_acou_sim_fused.wgsl" if self.kernel_mode == "fused" else "./synthetic_acou_sim.wgsl"
+        handler.create_shader_module(shader_path, (*self.grid_size_shape, 1), self.workgroup_size, constants={"stencil_radius": self.stencil_radius})
 
-            if generate_video and i % animation_step == 0:
-                fig, axs = plt.subplots(2, 2, figsize=(10, 10))
+        wgsl_data = {
+            'p_next': (self.roi_nbytes, True),
+            'p_current': (self.roi_nbytes, True),
+            'p_previous': (self.roi_nbytes, True),
+            'dp_1_z': (self.roi_nbytes, True),
+            'dp_1_x': (self.roi_nbytes, True),
+            'dp_2_z': (self.roi_nbytes, True),
+            'dp_2_x': (self.roi_nbytes, True),
+            'phi_z': (self.z_strips_nbytes, True),
+            'phi_x': (self.x_strips_nbytes, True),
+            'psi_z': (self.z_strips_nbytes, True),
+            'psi_x': (self.x_strips_nbytes, True),
+            'infoI32': (info_i32, False),
+            'infoF32': (self.info_f32, False),
+            'c': (self.c, False),
+            'source': (self.source, False),
+            'source_zx': (np.array([self.source_z, self.source_x], dtype=np.int32), False),
+            'absorption_z': (self.absorption_z, False),
+            'absorption_x': (self.absorption_x, False),
+            'transducer_z': (np.ascontiguousarray(self.band_z, dtype=np.int32), False),
+            'transducer_x': (np.ascontiguousarray(self.band_x, dtype=np.int32), False),
+            'i': (np.int32(0), False),
+            # Boundary saving records the band at every step. Otherwise nothing is recorded, the forward wavefield is
+            # copied to the receiver handler instead
+            'recordings': (int(self.band_z.size * self.recorded_steps * np.dtype(np.float32).itemsize), True),
+        }
 
-                # Upper left subplot
-                axs[0, 0].imshow(self.p_future_flipped_tr, cmap='viridis', interpolation='none')
-                axs[0, 0].set_title('Up-Going')
+        handler.set_buffers(wgsl_data, *[name for name in wgsl_data])
+        handler.create_buffers(debug=False)
+        handler.create_bind_group_layouts()
+        handler.create_pipeline_layout()
+        handler.create_bind_groups()
 
-                # Upper right subplot
-                axs[0, 1].imshow(current_product, cmap='viridis', interpolation='none')
-                axs[0, 1].set_title('Product')
+        return handler
 
-                # Bottom left subplot
-                axs[1, 0].imshow(self.p_future, cmap='viridis', interpolation='none')
-                axs[1, 0].set_title('Down-Going')
+    def create_receiver_handler(self):
+        # The recordings are injected time reversed, as in TimeReversal
+        self.injection_z, self.injection_x, self.packed_bscan = pack_injection_points(
+            self.transducer_z, self.transducer_x, self.bscan[:, ::-1]
+        )
 
-                # Bottom right subplot
-                axs[1, 1].imshow(accumulated_product, cmap='viridis', interpolation='none')
-                axs[1, 1].set_title('Accumulated Product')
-                axs[1, 1].scatter(self.reflector_x, self.reflector_z, s=0.05, color='red')
+        info_i32 = np.array(
+            [
+                self.grid_size_z,
+                self.grid_size_x,
+                self.injection_z.size,
+                self.absorption_layer_size,
+                IMAGING_CONDITIONS["cross_correlation"],
+                0,
+                self.total_time,
+                0,
+                0,
+                self.packed_bscan.shape[0],
+                self.packed_bscan.shape[0],
+            ],
+            dtype=np.int32
+        )
 
-                plt.savefig(f'{self.frames_folder}/frame_{i // animation_step}.png', bbox_inches='tight', pad_inches=0)
-                plt.close()
+        handler = create_handler(self.backend, self.device)
+        shader_path = "./time_reversal_sim_fused.wgsl" if self.kernel_mode == "fused" else "./time_reversal_sim.wgsl"
+        handler.create_shader_module(shader_path, self.grid_size_shape, self.workgroup_size, constants={"stencil_radius": self.stencil_radius})
 
-                # save_rtm_image(
-                #     upper_left=self.p_future_flipped_tr,
-                #     upper_right=current_product,
-                #     bottom_left=self.p_future,
-                #     bottom_right=accumulated_product,
-                #     path=f'{self.frames_folder}/frame_{i // animation_step}.png'
-                # )
+        wgsl_data = {
+            'p_next': (self.roi_nbytes, True),
+            'p_current': (self.roi_nbytes, True),
+            'p_previous': (self.roi_nbytes, True),
+            'dp_1_z': (self.roi_nbytes, True),
+            'dp_1_x': (self.roi_nbytes, True),
+            'dp_2_z': (self.roi_nbytes, True),
+            'dp_2_x': (self.roi_nbytes, True),
+            'phi_z': (self.z_strips_nbytes, True),
+            'phi_x': (self.x_strips_nbytes, True),
+            'psi_z': (self.z_strips_nbytes, True),
+            'psi_x': (self.x_strips_nbytes, True),
+            'infoI32': (info_i32, False),
+            'infoF32': (self.info_f32, False),
+            'c': (self.c, False),
+            'absorption_z': (self.absorption_z, False),
+            'absorption_x': (self.absorption_x, False),
+            'transducer_z': (self.injection_z, False),
+            'transducer_x': (self.injection_x, False),
+            'flipped_bscan': (self.packed_bscan, False),
+            'source_wavefield': (self.roi_nbytes, True),
+            'i': (np.int32(0), False),
+            'image': (self.roi_nbytes, True),
+            # Source illumination (sum of the squared forward wavefield), used to normalize the image when stacking
+            'illumination': (self.roi_nbytes, True),
+        }
 
-            if i % 300 == 0:
-                print(f'Reverse Time Migration - i={i}')
+        handler.set_buffers(wgsl_data, "p_next", "image", "illumination")
+        handler.create_buffers(debug=False)
+        handler.create_bind_group_layouts()
+        handler.create_pipeline_layout()
+        handler.create_bind_groups()
 
-        print('Reverse Time Migration finished.')
+        return handler
 
-        # Save last frame of accumulated_product
-        np.save(f'{self.folder}/accumulated_product_{self.emitter_index}.npy', accumulated_product)
+    def read_state(self):
+        return {
+            name: np.frombuffer(self.forward_handler.read_buffer(group=group, binding=binding), dtype=dtype).copy()
+            for name, group, binding, dtype in self.state_buffers
+        }
 
-        if generate_video:
-            create_video(path=self.frames_folder, output_path=f'{self.folder}/rtm.mp4')
+    def write_state(self, state):
+        for name, data in state.items():
+            self.forward_handler.write_buffer(name, data)
@@ -0,0 +1,89 @@
+import numpy as np
+import os
+from pathlib import Path
+from reverse_time_migration import SyntheticReverseTimeMigration
+
+
+class RTMStacking:
+    def __init__(self, **kwargs):
+        # Shot gathers written by ShotScheduler: shots.npy (source_z, source_x, model) and shot_gathers.npy (shot x transducer x time)
+        self.shots_folder = Path(kwargs.get("shots_folder", "./ShotGathers"))
+        self.shot_gathers = np.load(f"{self.shots_folder}/shot_gathers.npy", mmap_mode='r')
+        self.shots = np.asarray(kwargs["shots"] if "shots" in kwargs else np.load(f"{self.shots_folder}/shots.npy"), dtype=np.int32)[:, :2]
+        self.num_shots = len(self.shots)
+
+        if self.shot_gathers.shape[0] != self.num_shots:
+            raise ValueError(f"{self.num_shots} shots for {self.shot_gathers.shape[0]} shot gathers")
+
+        self.folder = Path(kwargs.get("output_folder", "./RTMStack"))
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # Stabilization of the illumination normalization, relative to the maximum illumination of each shot
+        self.illumination_epsilon = np.float32(kwargs.get("illumination_epsilon", 1e-3))
+
+        self.headless = kwargs.get("headless", False)
+
+        # Everything else is passed through to SyntheticReverseTimeMigration
+        reserved = ["shots_folder", "shots", "output_folder", "illumination_epsilon", "source_z", "source_x", "recordings", "recordings_folder", "emitter_index", "mode"]
+        self.rtm_params = {k: v for k, v in kwargs.items() if k not in reserved}
+
+        # The stack and the list of shots already in it are saved together after every shot, an interrupted run
+        # resumes from the last saved shot
+        self.stack_path = self.folder / "stack.npz"
+        self.load_stack(kwargs["grid_size_z"], kwargs["grid_size_x"])
+
+        for shot_index, (source_z, source_x) in enumerate(self.shots):
+            if self.completed[shot_index]:
+                continue
+
+            rtm = SyntheticReverseTimeMigration(
+                mode=2,
+                source_z=int(source_z),
+                source_x=int(source_x),
+                recordings=self.shot_gathers[shot_index],
+                emitter_index=shot_index,
+                output_folder=self.folder / "shots",
+                **self.rtm_params,
+            )
+
+            # Illumination normalization, compensates for the geometrical spreading of the source wavefield
+            self.stack += rtm.image / (rtm.illumination + self.illumination_epsilon * rtm.illumination.max() + np.finfo(np.float32).tiny)
+            self.completed[shot_index] = True
+            self.save_stack()
+
+            print(f"Shot {shot_index} stacked ({np.count_nonzero(self.completed)}/{self.num_shots})")
+
+        np.save(f"{self.folder}/stacked_image.npy", self.stack)
+
+        if not self.headless:
+            import matplotlib.pyplot as plt
+
+            plt.figure()
+            plt.imshow(self.stack, aspect='auto', cmap='viridis', interpolation='none')
+            plt.colorbar()
+            plt.title("Stacked Reverse Time Migration")
+            plt.savefig(f"{self.folder}/stacked_image.png", dpi=300)
+            plt.close()
+
+        print('RTM stacking finished.')
+
+    def load_stack(self, grid_size_z, grid_size_x):
+        if not self.stack_path.exists():
+            self.stack = np.zeros((grid_size_z, grid_size_x), dtype=np.float32)
+            self.completed = np.zeros(self.num_shots, dtype=bool)
+            return
+
+        with np.load(self.stack_path) as saved:
+            if not np.array_equal(saved["shots"], self.shots) or saved["stack"].shape != (grid_size_z, grid_size_x):
+                raise ValueError(f"{self.stack_path} was stacked from other shots, remove it or use another output folder")
+
+            self.stack = saved["stack"].copy()
+            self.completed = saved["completed"].copy()
+
+        print(f"Resuming RTM stacking, {np.count_nonzero(self.completed)}/{self.num_shots} shots already stacked")
+
+    def save_stack(self):
+        # Written next to the stack and renamed over it, the saved stack is never partially written
+        temporary_path = self.folder / "stack.tmp.npz"
+        np.savez(temporary_path, stack=self.stack, completed=self.completed, shots=self.shots)
+        os.replace(temporary_path, self.stack_path)
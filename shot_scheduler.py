@@ -0,0 +1,120 @@
+import numpy as np
+import os
+import tempfile
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from acoustic_simulator import AcousticSimulator
+
+
+# Static inputs of the worker processes, attached once per worker by attach_shared_inputs
+shared_inputs = {}
+
+
+def attach_shared_array(name, shape, dtype):
+    # The parent owns (and unlinks) the blocks, the workers must not track them
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with the resource tracker. A worker spawned by
+        # multiprocessing shares the parent's tracker (the parent unregisters the block when it unlinks it), any other
+        # starts its own, which would unlink the block when the worker exits
+        own_tracker = resource_tracker._resource_tracker._fd is None
+        block = shared_memory.SharedMemory(name=name)
+        if own_tracker:
+            resource_tracker.unregister(block._name, "shared_memory")
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def attach_shared_inputs(descriptors, sim_params):
+    shared_inputs["blocks"] = []
+    for key, (name, shape, dtype) in descriptors.items():
+        block, array = attach_shared_array(name, shape, dtype)
+        array.flags.writeable = False
+        shared_inputs["blocks"].append(block)
+        shared_inputs[key] = array
+    shared_inputs["sim_params"] = sim_params
+
+
+def run_shot(shot_index, source_z, source_x, model_index):
+    # Runs in the worker processes, each shot writes to its own temporary folder
+    with tempfile.TemporaryDirectory() as folder:
+        AcousticSimulator(
+            mode=0,
+            source_z=source_z,
+            source_x=source_x,
+            c=shared_inputs["c"],
+            c_with_reflectors=shared_inputs["velocity_models"][model_index],
+            source=shared_inputs["source"],
+            output_folder=folder,
+            headless=True,
+            **shared_inputs["sim_params"],
+        )
+        recordings = np.load(f"{folder}/recordings.npy")
+
+    return shot_index, recordings
+
+
+class ShotScheduler:
+    def __init__(self, **kwargs):
+        # (source_z, source_x) or (source_z, source_x, velocity model index) per shot
+        self.shots = [tuple(shot) + (0,) * (3 - len(shot)) for shot in kwargs["shots"]]
+        self.num_shots = len(self.shots)
+
+        # Velocity models the shots are propagated in (the c_with_reflectors of AcousticSimulator)
+        self.velocity_models = np.ascontiguousarray(kwargs["velocity_models"], dtype=np.float32)
+        if self.velocity_models.ndim == 2:
+            self.velocity_models = self.velocity_models[np.newaxis]
+
+        self.c = np.ascontiguousarray(kwargs["c"], dtype=np.float32)
+        self.source = np.asarray(kwargs["source"] if "source" in kwargs else np.load('./source.npy'), dtype=np.float32)
+
+        # One worker per core by default, each runs the NumPy step (or its own software WebGPU adapter)
+        self.num_workers = int(kwargs.get("num_workers", os.cpu_count()))
+
+        # Everything else is passed through to AcousticSimulator
+        reserved = ["shots", "velocity_models", "c", "c_with_reflectors", "source", "num_workers", "output_folder", "source_z", "source_x", "mode", "headless"]
+        self.sim_params = {k: v for k, v in kwargs.items() if k not in reserved}
+        self.sim_params.setdefault("backend", "numpy")
+
+        self.folder = Path(kwargs.get("output_folder", "./ShotGathers"))
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # Shot-gather store, (shot x transducer x time), filled as the shots finish
+        self.shot_gathers = np.lib.format.open_memmap(
+            f"{self.folder}/shot_gathers.npy", mode='w+', dtype=np.float32,
+            shape=(self.num_shots, int(kwargs["num_transducers"]), int(kwargs["total_time"]))
+        )
+        np.save(f"{self.folder}/shots.npy", np.array(self.shots, dtype=np.int32))
+
+        # The static inputs are copied once into shared memory instead of being pickled for every task
+        blocks = []
+        descriptors = {}
+        try:
+            for key in ["c", "velocity_models", "source"]:
+                array = getattr(self, key)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                descriptors[key] = (block.name, array.shape, array.dtype.str)
+
+            with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=attach_shared_inputs,
+                initargs=(descriptors, self.sim_params),
+            ) as executor:
+                futures = [executor.submit(run_shot, k, *shot) for k, shot in enumerate(self.shots)]
+
+                for finished, future in enumerate(as_completed(futures)):
+                    shot_index, recordings = future.result()
+                    self.shot_gathers[shot_index] = recordings
+                    self.shot_gathers.flush()
+                    print(f"Shot {shot_index} finished ({finished + 1}/{self.num_shots})")
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        print('Shot scheduling finished.')
@@ -1,4 +1,6 @@
 import numpy as np
+from workgroup_tuning import tuned_workgroup_size
+from grid_planner import courant_number, max_stable_dt
 
 
 class SimulationHandler:
@@ -30,11 +32,24 @@ class SimulationHandler:
         self.transducer_x = kwargs["transducer_x"]
         self.num_transducers = kwargs["num_transducers"]
 
-        # Courant
-        if self.mode == 0:
-            self.CFL = np.amax(self.c_with_reflectors) * self.dt * ((1 / self.dz) + (1 / self.dx))
-        elif self.mode == 1:
-            self.CFL = np.amax(self.c) * self.dt * ((1 / self.dz) + (1 / self.dx))
+        # Compute backend: "webgpu" or "numpy"
+        self.backend = kwargs.get("backend", "webgpu")
+
+        # WebGPU device the handlers run on, the shared one of the process (webgpu_handler.request_device) by default
+        self.device = kwargs.get("device")
+
+        # Kernel mode: "split" (one dispatch per stage) or "fused" (two dispatches, no derivative grids)
+        self.kernel_mode = kwargs.get("kernel_mode", "split")
+
+        # Maximum amount of timesteps recorded into a single command buffer
+        self.batch_size = int(kwargs.get("batch_size", 128))
+
+        # Snapshots are rendered by a pool of worker processes, headless skips them (and matplotlib) entirely
+        self.headless = kwargs.get("headless", False)
+        self.render_workers = int(kwargs.get("render_workers", 2))
+
+        # Per-kernel timing of the run (slows it down), written as a Chrome trace to profile.json in the output folder
+        self.profile = kwargs.get("profile", False)
 
         # Pressure field
         self.p_next = np.zeros(self.grid_size_shape, dtype=np.float32)
@@ -42,27 +57,24 @@ class SimulationHandler:
         """ CPML """
         self.absorption_layer_size = np.int32(kwargs["cpml_absorption_layer_size"])
         self.damping_coefficient = np.float32(kwargs["damping_coefficient"])
-        x, z = np.meshgrid(np.arange(self.grid_size_x, dtype=np.float32), np.arange(self.grid_size_z, dtype=np.float32))
-
-        # Choose absorbing boundaries
-        self.is_z_absorption = (z > self.grid_size_z - self.absorption_layer_size) | (z < self.absorption_layer_size)
-        self.is_x_absorption = (x > self.grid_size_x - self.absorption_layer_size) | (x < self.absorption_layer_size)
 
         self.absorption_coefficient = np.exp(
             -(self.damping_coefficient * (np.arange(self.absorption_layer_size) / self.absorption_layer_size) ** 2) * self.dt
         ).astype(np.float32)
 
-        self.absorption_z = np.ones(self.grid_size_shape, dtype=np.float32)
-        self.absorption_x = np.ones(self.grid_size_shape, dtype=np.float32)
+        # 1D damping profiles, the absorbing layer is z < layer_size or z > (size_z - layer_size) (same for x)
+        self.absorption_z = np.ones(self.grid_size_z, dtype=np.float32)
+        self.absorption_x = np.ones(self.grid_size_x, dtype=np.float32)
 
-        self.absorption_z[:self.absorption_layer_size, :] = self.absorption_coefficient[:, np.newaxis][::-1]  # z < layer_size
-        self.absorption_z[-self.absorption_layer_size:, :] = self.absorption_coefficient[:, np.newaxis]  # z > (size_z - layer_size)
-        self.absorption_x[:, :self.absorption_layer_size] = self.absorption_coefficient[::-1]  # x < layer_size
-        self.absorption_x[:, -self.absorption_layer_size:] = self.absorption_coefficient  # x > (size_x - layer_size)
+        self.absorption_z[:self.absorption_layer_size] = self.absorption_coefficient[::-1]
+        self.absorption_z[-self.absorption_layer_size:] = self.absorption_coefficient
+        self.absorption_x[:self.absorption_layer_size] = self.absorption_coefficient[::-1]
+        self.absorption_x[-self.absorption_layer_size:] = self.absorption_coefficient
 
-        # Converts boolean array to int array to pass to GPU
-        self.is_z_absorption_int = self.is_z_absorption.astype(np.int32)
-        self.is_x_absorption_int = self.is_x_absorption.astype(np.int32)
+        # CPML memory variables (phi, psi) are only stored over the absorbing strips:
+        # z strips are (2 * layer_size, size_x), x strips are (size_z, 2 * layer_size)
+        self.z_strips_nbytes = int(2 * self.absorption_layer_size * self.grid_size_x * np.dtype(np.float32).itemsize)
+        self.x_strips_nbytes = int(2 * self.absorption_layer_size * self.grid_size_z * np.dtype(np.float32).itemsize)
 
         self.reflector_z, self.reflector_x = np.where(self.c_with_reflectors == 0)
         # self.reflectors_amount = len(self.reflector_z)
@@ -76,3 +88,61 @@ class SimulationHandler:
             ],
             dtype=np.float32
         )
+
+        # Order of accuracy in space of the staggered finite differences, 2, 4 or 8. The stencils reach stencil_order / 2
+        # cells on each side
+        self.stencil_order = int(kwargs.get("stencil_order", 2))
+        if self.stencil_order not in [2, 4, 8]:
+            raise ValueError(f"Unsupported stencil order: {self.stencil_order}")
+        self.stencil_radius = self.stencil_order // 2
+
+        # Storage of the wavefields and the CPML memory variables, "f32" or "f16" (half the memory and bandwidth of the
+        # stencil kernels, the arithmetic stays f32). See precision_check.py for the error against f32
+        self.wavefield_precision = kwargs.get("wavefield_precision", "f32")
+        if self.wavefield_precision not in ["f32", "f16"]:
+            raise ValueError(f"Unsupported wavefield precision: {self.wavefield_precision}")
+
+        # Stability of the time step, the wider stencils lower the largest stable one (see grid_planner.plan_grid to
+        # pick dt and the spacings from the source spectrum or the B-scan)
+        c_max = max(np.amax(self.c), np.amax(self.c_with_reflectors))
+        self.courant_number = courant_number(c_max, self.dt, self.dz, self.dx, self.stencil_order)
+        if self.courant_number > 1:
+            raise ValueError(
+                f"Unstable time step: Courant number {self.courant_number:.3f} > 1, "
+                f"dt must be at most {max_stable_dt(c_max, self.dz, self.dx, self.stencil_order):.4g} s"
+            )
+
+        # The grid kernels are only dispatched over the region the wavefield can have reached, around the sources or the
+        # injection points. "exact" grows it by the reach of a step of the stencils (2 * stencil_radius - 1 cells),
+        # bit-identical to the full grid. "wavefront" grows it by the distance the fastest wave travels plus
+        # active_region_margin cells, smaller but it drops the (tiny) numerical precursor ahead of the wavefront.
+        # "off" always dispatches the full grid
+        self.active_region = kwargs.get("active_region", "exact")
+        if self.active_region == "exact":
+            self.active_region_speed = 2 * self.stencil_radius - 1
+            self.active_region_margin = 0
+        elif self.active_region == "wavefront":
+            self.active_region_speed = float(c_max * self.dt / min(self.dz, self.dx))
+            self.active_region_margin = int(kwargs.get("active_region_margin", 4 * self.stencil_radius))
+        elif self.active_region != "off":
+            raise ValueError(f"Unknown active region: {self.active_region}")
+
+        # Workgroup size of the grid kernels, "auto" picks the fastest one for the adapter and grid size, benchmarked
+        # on the first run and read from the tuning database afterwards
+        self.workgroup_size = kwargs.get("workgroup_size", (8, 8))
+        if self.workgroup_size == "auto":
+            self.workgroup_size = tuned_workgroup_size(
+                backend=self.backend,
+                kernel_mode=self.kernel_mode,
+                grid_size_shape=self.grid_size_shape,
+                absorption_layer_size=self.absorption_layer_size,
+                info_f32=self.info_f32,
+                stencil_radius=self.stencil_radius,
+                wavefield_precision=self.wavefield_precision,
+                device=self.device,
+                database=kwargs.get("tuning_database", "./workgroup_tuning.json"),
+            )
+
+    def active_region_reach(self, step):
+        # Cells the active region extends past the sources (or injection points) on each side during the step
+        return int(np.ceil(self.active_region_speed * (step + 1))) + self.active_region_margin
@@ -0,0 +1,77 @@
+import numpy as np
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+def render_snapshot(path, frame, scatters, colorbar, imshow_kwargs):
+    # Runs in the worker processes, matplotlib is only imported there
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    for x, z in scatters:
+        plt.scatter(x, z, s=0.1)
+    plt.imshow(frame, **imshow_kwargs)
+    if colorbar:
+        plt.colorbar()
+    plt.savefig(path, dpi=300)
+    plt.close()
+
+
+class SnapshotRenderer:
+    def __init__(self, **kwargs):
+        # Headless: snapshots are dropped and matplotlib is never imported
+        self.headless = kwargs.get("headless", False)
+
+        # 0 workers renders on the calling thread
+        self.num_workers = int(kwargs.get("num_workers", 2))
+
+        # Frames waiting to be rendered, submit blocks once this many are queued (backpressure)
+        self.max_pending = int(kwargs.get("max_pending", 2 * max(self.num_workers, 1)))
+
+        self.pending = threading.BoundedSemaphore(self.max_pending)
+        self.futures = []
+        self.executor = None
+
+        if not self.headless and self.num_workers > 0:
+            # spawn, a forked worker could inherit the GPU device (or a lock held by another thread). The workers only
+            # receive arrays and plain options, the calling script must guard its simulations with __main__ since
+            # they import it again
+            self.executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, path, frame, scatters=(), colorbar=False, **imshow_kwargs):
+        if self.headless:
+            return
+
+        # The frame is copied, the caller is free to reuse its buffer right away
+        frame = np.array(frame, dtype=np.float32, copy=True)
+        scatters = [(np.asarray(x), np.asarray(z)) for x, z in scatters]
+
+        if self.executor is None:
+            render_snapshot(str(path), frame, scatters, colorbar, imshow_kwargs)
+            return
+
+        self.pending.acquire()
+        future = self.executor.submit(render_snapshot, str(path), frame, scatters, colorbar, imshow_kwargs)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+        # Surface rendering errors early instead of keeping every finished future around
+        futures, self.futures = self.futures, []
+        for f in futures:
+            if f.done():
+                f.result()
+            else:
+                self.futures.append(f)
+
+    def close(self):
+        # Waits for the queued frames
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
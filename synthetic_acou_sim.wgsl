@@ -1,8 +1,10 @@
 struct InfoInt {
     grid_size_z: i32,
     grid_size_x: i32,
-    source_z: i32,
-    source_x: i32,
+    absorption_layer_size: i32,
+    num_transducers: i32,
+    ring_length: i32,
+    num_shots: i32,
 };
 
 struct InfoFloat {
@@ -11,14 +13,16 @@ struct InfoFloat {
     dt: f32,
 };
 
+// The wavefields and the CPML memory variables are stored as wavefield (f32 or f16) and only accessed through the
+// load_/store_ functions the handler generates for the storage precision, which convert to and from f32
 @group(0) @binding(0)
-var<storage,read_write> p_next: array<f32>;
+var<storage,read_write> p_next: array<wavefield>;
 
 @group(0) @binding(1)
-var<storage,read_write> p_current: array<f32>;
+var<storage,read_write> p_current: array<wavefield>;
 
 @group(0) @binding(2)
-var<storage,read_write> p_previous: array<f32>;
+var<storage,read_write> p_previous: array<wavefield>;
 
 @group(0) @binding(3)
 var<storage,read_write> dp_1_z: array<f32>;
@@ -33,16 +37,16 @@ var<storage,read_write> dp_2_z: array<f32>;
 var<storage,read_write> dp_2_x: array<f32>;
 
 @group(0) @binding(7)
-var<storage,read_write> phi_z: array<f32>;
+var<storage,read_write> phi_z: array<wavefield>;
 
 @group(0) @binding(8)
-var<storage,read_write> phi_x: array<f32>;
+var<storage,read_write> phi_x: array<wavefield>;
 
 @group(0) @binding(9)
-var<storage,read_write> psi_z: array<f32>;
+var<storage,read_write> psi_z: array<wavefield>;
 
 @group(0) @binding(10)
-var<storage,read_write> psi_x: array<f32>;
+var<storage,read_write> psi_x: array<wavefield>;
 
 @group(1) @binding(0)
 var<uniform> infoI32: InfoInt;
@@ -57,20 +61,64 @@ var<storage,read> c: array<f32>;
 var<storage,read> source: array<f32>;
 
 @group(1) @binding(4)
-var<storage,read> absorption_z: array<f32>;
+var<storage,read> source_zx: array<i32>;
 
 @group(1) @binding(5)
-var<storage,read> absorption_x: array<f32>;
+var<storage,read> absorption_z: array<f32>;
 
 @group(1) @binding(6)
-var<storage,read> is_z_absorption: array<i32>;
+var<storage,read> absorption_x: array<f32>;
 
 @group(1) @binding(7)
-var<storage,read> is_x_absorption: array<i32>;
+var<storage,read> transducer_z: array<i32>;
 
 @group(1) @binding(8)
+var<storage,read> transducer_x: array<i32>;
+
+@group(1) @binding(9)
 var<storage,read_write> i: i32;
 
+@group(2) @binding(0)
+var<storage,read_write> recordings: array<f32>;
+
+// Shot of the invocation (global_invocation_id.z). The wavefields, CPML memory variables and recordings hold
+// num_shots independent slabs one after the other, c, absorption and the transducers are shared by all shots
+var<private> shot: i32;
+
+// Half width of the staggered stencils: 1, 2 or 4 for the 2nd, 4th and 8th order. Pipeline-overridable constant, set
+// from the stencil_order of the simulation when the pipelines are created
+override stencil_radius: i32 = 1;
+
+// Staggered-grid coefficients of the first derivative, the first stencil_radius ones are used
+fn stencil_coefficients() -> array<f32, 4> {
+    if (stencil_radius == 4) {
+        return array<f32, 4>(1225. / 1024., -245. / 3072., 49. / 5120., -5. / 7168.);
+    }
+    if (stencil_radius == 2) {
+        return array<f32, 4>(9. / 8., -1. / 24., 0., 0.);
+    }
+    return array<f32, 4>(1., 0., 0., 0.);
+}
+
+// Box around the cells the wavefield starts from (sources or injection points). The grid kernels may be dispatched
+// over a region around it only, grown with the wavefront every step, instead of the whole grid. The region is centred
+// on the box and kept inside the grid, the defaults (and any dispatch covering the grid) start it at the first cell
+override active_box_z: i32 = 0;
+override active_box_x: i32 = 0;
+override active_box_size_z: i32 = 0;
+override active_box_size_x: i32 = 0;
+
+// Grid cell of an invocation of a grid kernel
+fn active_region_z(index: u32, num_workgroups: u32) -> i32 {
+    let threads: i32 = i32(num_workgroups) * wsx;
+    return i32(index) + max(min(active_box_z - (threads - active_box_size_z) / 2, infoI32.grid_size_z - threads), 0);
+}
+
+fn active_region_x(index: u32, num_workgroups: u32) -> i32 {
+    let threads: i32 = i32(num_workgroups) * wsy;
+    return i32(index) + max(min(active_box_x - (threads - active_box_size_x) / 2, infoI32.grid_size_x - threads), 0);
+}
+
 // 2D index to 1D index
 fn zx(z: i32, x: i32) -> i32 {
     let index = x + z * infoI32.grid_size_x;
@@ -79,91 +127,231 @@ fn zx(z: i32, x: i32) -> i32 {
     return select(-1, index, x >= 0 && x < infoI32.grid_size_x && z >= 0 && z < infoI32.grid_size_z);
 }
 
+// 2D index to 1D index inside the slab of the current shot, -1 outside of the grid
+fn zxs(z: i32, x: i32) -> i32 {
+    let index = zx(z, x);
+
+    return select(-1, index + shot * infoI32.grid_size_z * infoI32.grid_size_x, index != -1);
+}
+
+// Row of the z absorbing strips (top strip followed by bottom strip), -1 outside of them
+fn z_strip(z: i32) -> i32 {
+    if (z < infoI32.absorption_layer_size) {
+        return z;
+    }
+    if (z > infoI32.grid_size_z - infoI32.absorption_layer_size) {
+        return z - infoI32.grid_size_z + 2 * infoI32.absorption_layer_size;
+    }
+    return -1;
+}
+
+// Column of the x absorbing strips (left strip followed by right strip), -1 outside of them
+fn x_strip(x: i32) -> i32 {
+    if (x < infoI32.absorption_layer_size) {
+        return x;
+    }
+    if (x > infoI32.grid_size_x - infoI32.absorption_layer_size) {
+        return x - infoI32.grid_size_x + 2 * infoI32.absorption_layer_size;
+    }
+    return -1;
+}
+
+// 2D index to 1D index inside the z strips buffers (2 * absorption_layer_size, grid_size_x)
+fn z_strip_index(z: i32, x: i32) -> i32 {
+    return x + z_strip(z) * infoI32.grid_size_x + shot * 2 * infoI32.absorption_layer_size * infoI32.grid_size_x;
+}
+
+// 2D index to 1D index inside the x strips buffers (grid_size_z, 2 * absorption_layer_size)
+fn x_strip_index(z: i32, x: i32) -> i32 {
+    return x_strip(x) + z * 2 * infoI32.absorption_layer_size + shot * infoI32.grid_size_z * 2 * infoI32.absorption_layer_size;
+}
+
+// Inverse of z_strip/x_strip, used by the kernels dispatched over the absorbing strips only
+fn strip_to_z(row: i32) -> i32 {
+    return select(row + infoI32.grid_size_z - 2 * infoI32.absorption_layer_size, row, row < infoI32.absorption_layer_size);
+}
+
+fn strip_to_x(column: i32) -> i32 {
+    return select(column + infoI32.grid_size_x - 2 * infoI32.absorption_layer_size, column, column < infoI32.absorption_layer_size);
+}
+
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn forward_diff(@builtin(global_invocation_id) index: vec3<u32>) {
-    let z: i32 = i32(index.x);
-    let x: i32 = i32(index.y);
-
-    // This function is calculating forward finite differences, resulting in first-order partial derivatives
+fn forward_diff(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    shot = i32(index.z);
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
+
+    // This function is calculating forward finite differences, resulting in first-order partial derivatives.
+    // They are staggered half a cell forward, cells whose stencil leaves the grid are left untouched
+
+    var a = stencil_coefficients();
+
+    if (zx(z - stencil_radius + 1, x) != -1 && zx(z + stencil_radius, x) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (load_p_current(zxs(z + k + 1, x)) - load_p_current(zxs(z - k, x)));
+        }
+        dp_1_z[zxs(z, x)] = diff / infoF32.dz;
+    }
+    if (zx(z, x - stencil_radius + 1) != -1 && zx(z, x + stencil_radius) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (load_p_current(zxs(z, x + k + 1)) - load_p_current(zxs(z, x - k)));
+        }
+        dp_1_x[zxs(z, x)] = diff / infoF32.dx;
+    }
+}
 
-    if (zx(z + 1, x) != -1) {
-        dp_1_z[zx(z, x)] = (p_current[zx(z + 1, x)] - p_current[zx(z, x)]) / infoF32.dz;
+@compute
+@workgroup_size(wsx, wsy, wsz)
+fn backward_diff(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    shot = i32(index.z);
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
+
+    // This function is calculating backward finite differences over dp_1, resulting in second-order partial derivatives.
+    // Staggered half a cell backward, back onto the grid cells
+
+    var a = stencil_coefficients();
+
+    if (zx(z - stencil_radius, x) != -1 && zx(z + stencil_radius - 1, x) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (dp_1_z[zxs(z + k, x)] - dp_1_z[zxs(z - k - 1, x)]);
+        }
+        dp_2_z[zxs(z, x)] = diff / infoF32.dz;
     }
-    if (zx(z, x + 1) != -1) {
-        dp_1_x[zx(z, x)] = (p_current[zx(z, x + 1)] - p_current[zx(z, x)]) / infoF32.dx;
+    if (zx(z, x - stencil_radius) != -1 && zx(z, x + stencil_radius - 1) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (dp_1_x[zxs(z, x + k)] - dp_1_x[zxs(z, x - k - 1)]);
+        }
+        dp_2_x[zxs(z, x)] = diff / infoF32.dx;
     }
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn backward_diff(@builtin(global_invocation_id) index: vec3<u32>) {
-    let z: i32 = i32(index.x);
+fn apply_cpml_to_first_order_diff_z(@builtin(global_invocation_id) index: vec3<u32>) {
+    shot = i32(index.z);
+    let z: i32 = strip_to_z(i32(index.x));
     let x: i32 = i32(index.y);
 
-    // This function is calculating backward finite differences over dp_1, resulting in second-order partial derivatives
+    // This function is called after forward_diff, to apply absorbing boundary conditions (CPML).
+    // It is only dispatched over the z absorbing strips, so index.x is a row of the strips
 
-    if (zx(z - 1, x) != -1) {
-        dp_2_z[zx(z, x)] = (dp_1_z[zx(z, x)] - dp_1_z[zx(z - 1, x)]) / infoF32.dz;
-    }
-    if (zx(z, x - 1) != -1) {
-        dp_2_x[zx(z, x)] = (dp_1_x[zx(z, x)] - dp_1_x[zx(z, x - 1)]) / infoF32.dx;
+    if (zx(z, x) == -1 || z_strip(z) == -1) {
+        return;
     }
+
+    store_phi_z(z_strip_index(z, x), absorption_z[z] * load_phi_z(z_strip_index(z, x)) + (absorption_z[z] - 1) * dp_1_z[zxs(z, x)]);
+    dp_1_z[zxs(z, x)] += load_phi_z(z_strip_index(z, x));
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn apply_cpml_to_first_order_diff(@builtin(global_invocation_id) index: vec3<u32>) {
+fn apply_cpml_to_first_order_diff_x(@builtin(global_invocation_id) index: vec3<u32>) {
+    shot = i32(index.z);
     let z: i32 = i32(index.x);
-    let x: i32 = i32(index.y);
-    
-    // This function is called after forward_diff, to apply absorbing boundary conditions (CPML)
+    let x: i32 = strip_to_x(i32(index.y));
 
-    if (is_z_absorption[zx(z, x)] == 1) {
-        phi_z[zx(z, x)] = absorption_z[zx(z, x)] * phi_z[zx(z, x)] + (absorption_z[zx(z, x)] - 1) * dp_1_z[zx(z, x)];
-        dp_1_z[zx(z, x)] += phi_z[zx(z, x)];
-    }
-    if (is_x_absorption[zx(z, x)] == 1) {
-        phi_x[zx(z, x)] = absorption_x[zx(z, x)] * phi_x[zx(z, x)] + (absorption_x[zx(z, x)] - 1) * dp_1_x[zx(z, x)];
-        dp_1_x[zx(z, x)] += phi_x[zx(z, x)];
+    // Same as above over the x absorbing strips, index.y is a column of the strips
+
+    if (zx(z, x) == -1 || x_strip(x) == -1) {
+        return;
     }
+
+    store_phi_x(x_strip_index(z, x), absorption_x[x] * load_phi_x(x_strip_index(z, x)) + (absorption_x[x] - 1) * dp_1_x[zxs(z, x)]);
+    dp_1_x[zxs(z, x)] += load_phi_x(x_strip_index(z, x));
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn apply_cpml_to_second_order_diff(@builtin(global_invocation_id) index: vec3<u32>) {
-    let z: i32 = i32(index.x);
+fn apply_cpml_to_second_order_diff_z(@builtin(global_invocation_id) index: vec3<u32>) {
+    shot = i32(index.z);
+    let z: i32 = strip_to_z(i32(index.x));
     let x: i32 = i32(index.y);
 
     // This function is called after backward_diff, to apply absorbing boundary conditions (CPML)
 
-    if (is_z_absorption[zx(z, x)] == 1) {
-        psi_z[zx(z, x)] = absorption_z[zx(z, x)] * psi_z[zx(z, x)] + (absorption_z[zx(z, x)] - 1) * dp_2_z[zx(z, x)];
-        dp_2_z[zx(z, x)] += psi_z[zx(z, x)];
-    }
-    if (is_x_absorption[zx(z, x)] == 1) {
-        psi_x[zx(z, x)] = absorption_x[zx(z, x)] * psi_x[zx(z, x)] + (absorption_x[zx(z, x)] - 1) * dp_2_x[zx(z, x)];
-        dp_2_x[zx(z, x)] += psi_x[zx(z, x)];
+    if (zx(z, x) == -1 || z_strip(z) == -1) {
+        return;
     }
+
+    store_psi_z(z_strip_index(z, x), absorption_z[z] * load_psi_z(z_strip_index(z, x)) + (absorption_z[z] - 1) * dp_2_z[zxs(z, x)]);
+    dp_2_z[zxs(z, x)] += load_psi_z(z_strip_index(z, x));
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn simulate(@builtin(global_invocation_id) index: vec3<u32>) {
+fn apply_cpml_to_second_order_diff_x(@builtin(global_invocation_id) index: vec3<u32>) {
+    shot = i32(index.z);
     let z: i32 = i32(index.x);
-    let x: i32 = i32(index.y);
+    let x: i32 = strip_to_x(i32(index.y));
 
-    p_next[zx(z, x)] = (c[zx(z, x)] * c[zx(z, x)]) * (dp_2_z[zx(z, x)] + dp_2_x[zx(z, x)]) * (infoF32.dt * infoF32.dt);
+    if (zx(z, x) == -1 || x_strip(x) == -1) {
+        return;
+    }
 
-    p_next[zx(z, x)] += ((2. * p_current[zx(z, x)]) - p_previous[zx(z, x)]);
+    store_psi_x(x_strip_index(z, x), absorption_x[x] * load_psi_x(x_strip_index(z, x)) + (absorption_x[x] - 1) * dp_2_x[zxs(z, x)]);
+    dp_2_x[zxs(z, x)] += load_psi_x(x_strip_index(z, x));
+}
 
-    if (z == infoI32.source_z && x == infoI32.source_x)
+@compute
+@workgroup_size(wsx, wsy, wsz)
+fn simulate(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    shot = i32(index.z);
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
+
+    // Invocations past the grid would otherwise write into the slab of the next shot
+    if (zx(z, x) == -1) {
+        return;
+    }
+
+    // Computed in f32 and stored once, a single rounding with the half precision storage
+    var p_next_value: f32 = (c[zx(z, x)] * c[zx(z, x)]) * (dp_2_z[zxs(z, x)] + dp_2_x[zxs(z, x)]) * (infoF32.dt * infoF32.dt);
+
+    p_next_value += ((2. * load_p_current(zxs(z, x))) - load_p_previous(zxs(z, x)));
+    store_p_next(zxs(z, x), p_next_value);
+
+    if (z == source_zx[2 * shot] && x == source_zx[2 * shot + 1])
     {
-        p_next[zx(z, x)] += source[i];
+        store_p_next(zxs(z, x), load_p_next(zxs(z, x)) + source[i]);
+    }
+}
+
+@compute
+@workgroup_size(64)
+fn record_transducers(@builtin(global_invocation_id) index: vec3<u32>) {
+    shot = i32(index.z);
+    let transducer_index: i32 = i32(index.x);
+
+    if (transducer_index >= infoI32.num_transducers) {
+        return;
     }
 
-    p_previous[zx(z, x)] = p_current[zx(z, x)];
-    p_current[zx(z, x)] = p_next[zx(z, x)];
+    // Gathers the newest sample of every transducer on the GPU, so the wavefield isn't read back every step.
+    // recordings holds a (time x channel) ring of ring_length samples per shot, the host drains it to disk
+    recordings[(shot * infoI32.ring_length + i % infoI32.ring_length) * infoI32.num_transducers + transducer_index] = load_p_next(zxs(transducer_z[transducer_index], transducer_x[transducer_index]));
+}
+
+@compute
+@workgroup_size(64)
+fn restore_transducers(@builtin(global_invocation_id) index: vec3<u32>) {
+    shot = i32(index.z);
+    let transducer_index: i32 = i32(index.x);
+
+    if (transducer_index >= infoI32.num_transducers) {
+        return;
+    }
+
+    // Inverse of record_transducers, writes the samples of the recordings ring back into the wavefield. Used by the
+    // RTM to impose the saved boundary band while the forward wavefield is reconstructed backwards in time
+    let cell: i32 = zxs(transducer_z[transducer_index], transducer_x[transducer_index]);
+
+    store_p_next(cell, recordings[(shot * infoI32.ring_length + i % infoI32.ring_length) * infoI32.num_transducers + transducer_index]);
 }
 
 @compute
@@ -2,6 +2,14 @@ struct InfoInt {
     grid_size_z: i32,
     grid_size_x: i32,
     num_transducers: i32,
+    absorption_layer_size: i32,
+    imaging_condition: i32,
+    window_start: i32,
+    window_end: i32,
+    excluded_band_start: i32,
+    excluded_band_end: i32,
+    num_samples: i32,
+    ring_length: i32,
 };
 
 struct InfoFloat {
@@ -10,14 +18,16 @@ struct InfoFloat {
     dt: f32,
 };
 
+// The wavefields and the CPML memory variables are stored as wavefield (f32 or f16) and only accessed through the
+// load_/store_ functions the handler generates for the storage precision, which convert to and from f32
 @group(0) @binding(0)
-var<storage,read_write> p_next: array<f32>;
+var<storage,read_write> p_next: array<wavefield>;
 
 @group(0) @binding(1)
-var<storage,read_write> p_current: array<f32>;
+var<storage,read_write> p_current: array<wavefield>;
 
 @group(0) @binding(2)
-var<storage,read_write> p_previous: array<f32>;
+var<storage,read_write> p_previous: array<wavefield>;
 
 @group(0) @binding(3)
 var<storage,read_write> dp_1_z: array<f32>;
@@ -32,16 +42,16 @@ var<storage,read_write> dp_2_z: array<f32>;
 var<storage,read_write> dp_2_x: array<f32>;
 
 @group(0) @binding(7)
-var<storage,read_write> phi_z: array<f32>;
+var<storage,read_write> phi_z: array<wavefield>;
 
 @group(0) @binding(8)
-var<storage,read_write> phi_x: array<f32>;
+var<storage,read_write> phi_x: array<wavefield>;
 
 @group(0) @binding(9)
-var<storage,read_write> psi_z: array<f32>;
+var<storage,read_write> psi_z: array<wavefield>;
 
 @group(0) @binding(10)
-var<storage,read_write> psi_x: array<f32>;
+var<storage,read_write> psi_x: array<wavefield>;
 
 @group(1) @binding(0)
 var<uniform> infoI32: InfoInt;
@@ -59,21 +69,59 @@ var<storage,read> absorption_z: array<f32>;
 var<storage,read> absorption_x: array<f32>;
 
 @group(1) @binding(5)
-var<storage,read> is_z_absorption: array<i32>;
+var<storage,read> transducer_z: array<i32>;
 
 @group(1) @binding(6)
-var<storage,read> is_x_absorption: array<i32>;
+var<storage,read> transducer_x: array<i32>;
 
 @group(1) @binding(7)
-var<storage,read> transducer_z: array<i32>;
+var<storage,read> flipped_bscan: array<f32>;
 
 @group(1) @binding(8)
-var<storage,read> transducer_x: array<i32>;
+var<storage,read> source_wavefield: array<f32>;
 
 @group(1) @binding(9)
 var<storage,read_write> i: i32;
 
-//FLIPPED_MICROPHONES_BINDINGS
+@group(2) @binding(0)
+var<storage,read_write> image: array<f32>;
+
+@group(2) @binding(1)
+var<storage,read_write> illumination: array<f32>;
+
+// Half width of the staggered stencils: 1, 2 or 4 for the 2nd, 4th and 8th order. Pipeline-overridable constant, set
+// from the stencil_order of the simulation when the pipelines are created
+override stencil_radius: i32 = 1;
+
+// Staggered-grid coefficients of the first derivative, the first stencil_radius ones are used
+fn stencil_coefficients() -> array<f32, 4> {
+    if (stencil_radius == 4) {
+        return array<f32, 4>(1225. / 1024., -245. / 3072., 49. / 5120., -5. / 7168.);
+    }
+    if (stencil_radius == 2) {
+        return array<f32, 4>(9. / 8., -1. / 24., 0., 0.);
+    }
+    return array<f32, 4>(1., 0., 0., 0.);
+}
+
+// Box around the cells the wavefield starts from (sources or injection points). The grid kernels may be dispatched
+// over a region around it only, grown with the wavefront every step, instead of the whole grid. The region is centred
+// on the box and kept inside the grid, the defaults (and any dispatch covering the grid) start it at the first cell
+override active_box_z: i32 = 0;
+override active_box_x: i32 = 0;
+override active_box_size_z: i32 = 0;
+override active_box_size_x: i32 = 0;
+
+// Grid cell of an invocation of a grid kernel
+fn active_region_z(index: u32, num_workgroups: u32) -> i32 {
+    let threads: i32 = i32(num_workgroups) * wsx;
+    return i32(index) + max(min(active_box_z - (threads - active_box_size_z) / 2, infoI32.grid_size_z - threads), 0);
+}
+
+fn active_region_x(index: u32, num_workgroups: u32) -> i32 {
+    let threads: i32 = i32(num_workgroups) * wsy;
+    return i32(index) + max(min(active_box_x - (threads - active_box_size_x) / 2, infoI32.grid_size_x - threads), 0);
+}
 
 // 2D index to 1D index
 fn zx(z: i32, x: i32) -> i32 {
@@ -83,94 +131,233 @@ fn zx(z: i32, x: i32) -> i32 {
     return select(-1, index, x >= 0 && x < infoI32.grid_size_x && z >= 0 && z < infoI32.grid_size_z);
 }
 
+// Row of the z absorbing strips (top strip followed by bottom strip), -1 outside of them
+fn z_strip(z: i32) -> i32 {
+    if (z < infoI32.absorption_layer_size) {
+        return z;
+    }
+    if (z > infoI32.grid_size_z - infoI32.absorption_layer_size) {
+        return z - infoI32.grid_size_z + 2 * infoI32.absorption_layer_size;
+    }
+    return -1;
+}
+
+// Column of the x absorbing strips (left strip followed by right strip), -1 outside of them
+fn x_strip(x: i32) -> i32 {
+    if (x < infoI32.absorption_layer_size) {
+        return x;
+    }
+    if (x > infoI32.grid_size_x - infoI32.absorption_layer_size) {
+        return x - infoI32.grid_size_x + 2 * infoI32.absorption_layer_size;
+    }
+    return -1;
+}
+
+// 2D index to 1D index inside the z strips buffers (2 * absorption_layer_size, grid_size_x)
+fn z_strip_index(z: i32, x: i32) -> i32 {
+    return x + z_strip(z) * infoI32.grid_size_x;
+}
+
+// 2D index to 1D index inside the x strips buffers (grid_size_z, 2 * absorption_layer_size)
+fn x_strip_index(z: i32, x: i32) -> i32 {
+    return x_strip(x) + z * 2 * infoI32.absorption_layer_size;
+}
+
+// Inverse of z_strip/x_strip, used by the kernels dispatched over the absorbing strips only
+fn strip_to_z(row: i32) -> i32 {
+    return select(row + infoI32.grid_size_z - 2 * infoI32.absorption_layer_size, row, row < infoI32.absorption_layer_size);
+}
+
+fn strip_to_x(column: i32) -> i32 {
+    return select(column + infoI32.grid_size_x - 2 * infoI32.absorption_layer_size, column, column < infoI32.absorption_layer_size);
+}
+
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn forward_diff(@builtin(global_invocation_id) index: vec3<u32>) {
-    let z: i32 = i32(index.x);
-    let x: i32 = i32(index.y);
+fn forward_diff(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
+
+    // This function is calculating forward finite differences, resulting in first-order partial derivatives.
+    // They are staggered half a cell forward, cells whose stencil leaves the grid are left untouched
 
-    // This function is calculating forward finite differences, resulting in first-order partial derivatives
+    var a = stencil_coefficients();
 
-    if (zx(z + 1, x) != -1) {
-        dp_1_z[zx(z, x)] = (p_current[zx(z + 1, x)] - p_current[zx(z, x)]) / infoF32.dz;
+    if (zx(z - stencil_radius + 1, x) != -1 && zx(z + stencil_radius, x) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (load_p_current(zx(z + k + 1, x)) - load_p_current(zx(z - k, x)));
+        }
+        dp_1_z[zx(z, x)] = diff / infoF32.dz;
     }
-    if (zx(z, x + 1) != -1) {
-        dp_1_x[zx(z, x)] = (p_current[zx(z, x + 1)] - p_current[zx(z, x)]) / infoF32.dx;
+    if (zx(z, x - stencil_radius + 1) != -1 && zx(z, x + stencil_radius) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (load_p_current(zx(z, x + k + 1)) - load_p_current(zx(z, x - k)));
+        }
+        dp_1_x[zx(z, x)] = diff / infoF32.dx;
     }
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn backward_diff(@builtin(global_invocation_id) index: vec3<u32>) {
-    let z: i32 = i32(index.x);
-    let x: i32 = i32(index.y);
+fn backward_diff(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
+
+    // This function is calculating backward finite differences over dp_1, resulting in second-order partial derivatives.
+    // Staggered half a cell backward, back onto the grid cells
 
-    // This function is calculating backward finite differences over dp_1, resulting in second-order partial derivatives
+    var a = stencil_coefficients();
 
-    if (zx(z - 1, x) != -1) {
-        dp_2_z[zx(z, x)] = (dp_1_z[zx(z, x)] - dp_1_z[zx(z - 1, x)]) / infoF32.dz;
+    if (zx(z - stencil_radius, x) != -1 && zx(z + stencil_radius - 1, x) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (dp_1_z[zx(z + k, x)] - dp_1_z[zx(z - k - 1, x)]);
+        }
+        dp_2_z[zx(z, x)] = diff / infoF32.dz;
     }
-    if (zx(z, x - 1) != -1) {
-        dp_2_x[zx(z, x)] = (dp_1_x[zx(z, x)] - dp_1_x[zx(z, x - 1)]) / infoF32.dx;
+    if (zx(z, x - stencil_radius) != -1 && zx(z, x + stencil_radius - 1) != -1) {
+        var diff: f32 = 0.;
+        for (var k: i32 = 0; k < stencil_radius; k++) {
+            diff += a[k] * (dp_1_x[zx(z, x + k)] - dp_1_x[zx(z, x - k - 1)]);
+        }
+        dp_2_x[zx(z, x)] = diff / infoF32.dx;
     }
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn apply_cpml_to_first_order_diff(@builtin(global_invocation_id) index: vec3<u32>) {
-    let z: i32 = i32(index.x);
+fn apply_cpml_to_first_order_diff_z(@builtin(global_invocation_id) index: vec3<u32>) {
+    let z: i32 = strip_to_z(i32(index.x));
     let x: i32 = i32(index.y);
-    
-    // This function is called after forward_diff, to apply absorbing boundary conditions (CPML)
 
-    if (is_z_absorption[zx(z, x)] == 1) {
-        phi_z[zx(z, x)] = absorption_z[zx(z, x)] * phi_z[zx(z, x)] + (absorption_z[zx(z, x)] - 1) * dp_1_z[zx(z, x)];
-        dp_1_z[zx(z, x)] += phi_z[zx(z, x)];
-    }
-    if (is_x_absorption[zx(z, x)] == 1) {
-        phi_x[zx(z, x)] = absorption_x[zx(z, x)] * phi_x[zx(z, x)] + (absorption_x[zx(z, x)] - 1) * dp_1_x[zx(z, x)];
-        dp_1_x[zx(z, x)] += phi_x[zx(z, x)];
+    // This function is called after forward_diff, to apply absorbing boundary conditions (CPML).
+    // It is only dispatched over the z absorbing strips, so index.x is a row of the strips
+
+    if (zx(z, x) == -1 || z_strip(z) == -1) {
+        return;
     }
+
+    store_phi_z(z_strip_index(z, x), absorption_z[z] * load_phi_z(z_strip_index(z, x)) + (absorption_z[z] - 1) * dp_1_z[zx(z, x)]);
+    dp_1_z[zx(z, x)] += load_phi_z(z_strip_index(z, x));
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn apply_cpml_to_second_order_diff(@builtin(global_invocation_id) index: vec3<u32>) {
+fn apply_cpml_to_first_order_diff_x(@builtin(global_invocation_id) index: vec3<u32>) {
     let z: i32 = i32(index.x);
+    let x: i32 = strip_to_x(i32(index.y));
+
+    // Same as above over the x absorbing strips, index.y is a column of the strips
+
+    if (zx(z, x) == -1 || x_strip(x) == -1) {
+        return;
+    }
+
+    store_phi_x(x_strip_index(z, x), absorption_x[x] * load_phi_x(x_strip_index(z, x)) + (absorption_x[x] - 1) * dp_1_x[zx(z, x)]);
+    dp_1_x[zx(z, x)] += load_phi_x(x_strip_index(z, x));
+}
+
+@compute
+@workgroup_size(wsx, wsy, wsz)
+fn apply_cpml_to_second_order_diff_z(@builtin(global_invocation_id) index: vec3<u32>) {
+    let z: i32 = strip_to_z(i32(index.x));
     let x: i32 = i32(index.y);
 
     // This function is called after backward_diff, to apply absorbing boundary conditions (CPML)
 
-    if (is_z_absorption[zx(z, x)] == 1) {
-        psi_z[zx(z, x)] = absorption_z[zx(z, x)] * psi_z[zx(z, x)] + (absorption_z[zx(z, x)] - 1) * dp_2_z[zx(z, x)];
-        dp_2_z[zx(z, x)] += psi_z[zx(z, x)];
-    }
-    if (is_x_absorption[zx(z, x)] == 1) {
-        psi_x[zx(z, x)] = absorption_x[zx(z, x)] * psi_x[zx(z, x)] + (absorption_x[zx(z, x)] - 1) * dp_2_x[zx(z, x)];
-        dp_2_x[zx(z, x)] += psi_x[zx(z, x)];
+    if (zx(z, x) == -1 || z_strip(z) == -1) {
+        return;
     }
+
+    store_psi_z(z_strip_index(z, x), absorption_z[z] * load_psi_z(z_strip_index(z, x)) + (absorption_z[z] - 1) * dp_2_z[zx(z, x)]);
+    dp_2_z[zx(z, x)] += load_psi_z(z_strip_index(z, x));
 }
 
 @compute
 @workgroup_size(wsx, wsy, wsz)
-fn simulate(@builtin(global_invocation_id) index: vec3<u32>) {
+fn apply_cpml_to_second_order_diff_x(@builtin(global_invocation_id) index: vec3<u32>) {
     let z: i32 = i32(index.x);
-    let x: i32 = i32(index.y);
+    let x: i32 = strip_to_x(i32(index.y));
+
+    if (zx(z, x) == -1 || x_strip(x) == -1) {
+        return;
+    }
 
-    p_next[zx(z, x)] = (c[zx(z, x)] * c[zx(z, x)]) * (dp_2_z[zx(z, x)] + dp_2_x[zx(z, x)]) * (infoF32.dt * infoF32.dt);
+    store_psi_x(x_strip_index(z, x), absorption_x[x] * load_psi_x(x_strip_index(z, x)) + (absorption_x[x] - 1) * dp_2_x[zx(z, x)]);
+    dp_2_x[zx(z, x)] += load_psi_x(x_strip_index(z, x));
+}
 
-    p_next[zx(z, x)] += ((2. * p_current[zx(z, x)]) - p_previous[zx(z, x)]);
+@compute
+@workgroup_size(wsx, wsy, wsz)
+fn simulate(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
 
-    for (var transducer_index: i32 = 0; transducer_index < infoI32.num_transducers; transducer_index += 1)
-    {
-        if (z == transducer_z[transducer_index] && x == transducer_x[transducer_index])
-        {
-            //FLIPPED_MICROPHONES_SIM
-        }
+    // Invocations past the grid (workgroup sizes that don't divide it) would otherwise store out of bounds
+    if (zx(z, x) == -1) {
+        return;
     }
 
-    p_previous[zx(z, x)] = p_current[zx(z, x)];
-    p_current[zx(z, x)] = p_next[zx(z, x)];
+    // Computed in f32 and stored once, a single rounding with the half precision storage
+    var p_next_value: f32 = (c[zx(z, x)] * c[zx(z, x)]) * (dp_2_z[zx(z, x)] + dp_2_x[zx(z, x)]) * (infoF32.dt * infoF32.dt);
+
+    p_next_value += ((2. * load_p_current(zx(z, x))) - load_p_previous(zx(z, x)));
+    store_p_next(zx(z, x), p_next_value);
+}
+
+@compute
+@workgroup_size(64)
+fn inject_transducers(@builtin(global_invocation_id) index: vec3<u32>) {
+    let transducer_index: i32 = i32(index.x);
+
+    if (transducer_index >= infoI32.num_transducers || i >= infoI32.num_samples) {
+        return;
+    }
+
+    // Sparse injection over the receivers only, dispatched after simulate
+    let cell: i32 = zx(transducer_z[transducer_index], transducer_x[transducer_index]);
+    // flipped_bscan is (time x channel), a ring of ring_length samples refilled by the host when streaming
+    let sample: f32 = flipped_bscan[(i % infoI32.ring_length) * infoI32.num_transducers + transducer_index];
+
+    store_p_next(cell, load_p_next(cell) + sample);
+}
+
+@compute
+@workgroup_size(wsx, wsy, wsz)
+fn accumulate_image(@builtin(global_invocation_id) index: vec3<u32>, @builtin(num_workgroups) num_workgroups: vec3<u32>) {
+    let z: i32 = active_region_z(index.x, num_workgroups.x);
+    let x: i32 = active_region_x(index.y, num_workgroups.y);
+
+    // Imaging condition accumulated on the GPU, the image is only read back at the end of the simulation
+
+    if (zx(z, x) == -1 || (z >= infoI32.excluded_band_start && z < infoI32.excluded_band_end)) {
+        return;
+    }
+
+    switch infoI32.imaging_condition {
+        // L2-norm (the square root is taken on the host)
+        case 0: {
+            image[zx(z, x)] += load_p_next(zx(z, x)) * load_p_next(zx(z, x));
+        }
+        // Maximum amplitude
+        case 1: {
+            image[zx(z, x)] = max(image[zx(z, x)], abs(load_p_next(zx(z, x))));
+        }
+        // Energy inside a time window
+        case 2: {
+            if (i >= infoI32.window_start && i < infoI32.window_end) {
+                image[zx(z, x)] += load_p_next(zx(z, x)) * load_p_next(zx(z, x));
+            }
+        }
+        // Cross-correlation with the source wavefield copied in by the RTM, along with the source illumination
+        case 3: {
+            image[zx(z, x)] += load_p_next(zx(z, x)) * source_wavefield[zx(z, x)];
+            illumination[zx(z, x)] += source_wavefield[zx(z, x)] * source_wavefield[zx(z, x)];
+        }
+        default: {}
+    }
 }
 
 @compute
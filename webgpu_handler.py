@@ -1,11 +1,102 @@
 import wgpu
 from wgpu.backends import wgpu_native
+import numpy as np
 import re
+import hashlib
+import time
 from pathlib import Path
+from profiling import write_trace
+from backends import step_dispatches, WAVEFIELD_ROLES
+
+
+# Devices shared by the handlers of the process, by force_fallback_adapter, created on first use. The timestamp queries
+# of the profiling mode and the f16 wavefield storage need features of the device, requested if the adapter has them
+devices = {}
+
+
+def request_device(force_fallback_adapter=False):
+    if force_fallback_adapter not in devices:
+        adapter = wgpu.gpu.request_adapter_sync(power_preference="high-performance", force_fallback_adapter=force_fallback_adapter)
+        if adapter is None:
+            raise RuntimeError("No WebGPU adapter available" + (" (fallback adapter)" if force_fallback_adapter else ""))
+
+        devices[force_fallback_adapter] = adapter.request_device_sync(
+            required_features=[feature for feature in ("timestamp-query", "shader-f16") if feature in adapter.features]
+        )
+
+    return devices[force_fallback_adapter]
+
+
+# load_/store_ functions of the array<wavefield> buffers of the shaders, the arithmetic is always done in f32. Without
+# the shader-f16 feature the f16 values are packed in pairs in u32 words, written with a compare-exchange loop since
+# the two cells of a word belong to different invocations
+WAVEFIELD_ACCESSORS = {
+    "native": """
+fn load_{name}(index: i32) -> f32 {{
+    return f32({name}[index]);
+}}
+
+fn store_{name}(index: i32, value: f32) {{
+    {name}[index] = wavefield(value);
+}}
+""",
+    "packed": """
+fn load_{name}(index: i32) -> f32 {{
+    if (index < 0) {{
+        return 0.;
+    }}
+    return unpack2x16float(atomicLoad(&{name}[index / 2]))[index % 2];
+}}
+
+fn store_{name}(index: i32, value: f32) {{
+    if (index < 0) {{
+        return;
+    }}
+    var old: u32 = atomicLoad(&{name}[index / 2]);
+    loop {{
+        var pair: vec2<f32> = unpack2x16float(old);
+        pair[index % 2] = value;
+        let result = atomicCompareExchangeWeak(&{name}[index / 2], old, pack2x16float(pair));
+        if (result.exchanged) {{
+            break;
+        }}
+        old = result.old_value;
+    }}
+}}
+""",
+}
+
+
+def wavefield_storage(shader_string, wavefield_precision, shader_f16):
+    # Declares the wavefield type of the shader and appends the accessors of its buffers
+    names = re.findall(r"var<[^>]+>\s+(\w+)\s*:\s*array<wavefield>", shader_string)
+
+    if wavefield_precision == "f32":
+        shader_string += "\nalias wavefield = f32;\n"
+        accessors = WAVEFIELD_ACCESSORS["native"]
+    elif shader_f16:
+        # Enable directives come before any declaration
+        shader_string = "enable f16;\n\n" + shader_string + "\nalias wavefield = f16;\n"
+        accessors = WAVEFIELD_ACCESSORS["native"]
+    else:
+        shader_string = shader_string.replace("array<wavefield>", "array<atomic<u32>>")
+        accessors = WAVEFIELD_ACCESSORS["packed"]
+
+    return shader_string + "".join(accessors.format(name=name) for name in names)
+
+
+# Shared by every handler of the process, so short jobs and repeated simulator instances don't recompile anything.
+# Shader modules and pipelines are keyed by the hash of the final shader source (workgroup size substituted), the
+# layouts by their bindings
+shader_sources = {}
+shader_modules = {}
+bind_group_layouts = {}
+pipeline_layouts = {}
+compute_pipelines = {}
 
 
 class WebGpuHandler:
-    def __init__(self):
+    def __init__(self, device=None):
         self.shader_module = None
         self.pipeline_layout = None
         self.buffers = []
@@ -14,30 +105,72 @@ class WebGpuHandler:
         self.bind_group_entries = {}
         self.bind_groups = []
         self.buffers_info = []
-        self.device = wgpu.utils.get_default_device()
+        # Rotation of the wavefield buffers, see rotate_wavefields. buffers_info indices of the p_next, p_current and
+        # p_previous buffers, the group holding them and its bind group in each of the three phases
+        self.wavefield_indices = []
+        self.wavefield_group = None
+        self.rotation_bind_groups = []
+        # Phase of the last dispatched step, 0 (no rotation) before the first one
+        self.rotation = 0
+        # Host-device traffic and allocated buffer memory, reported by the benchmarks
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.allocated_bytes = 0
+        # Profiling mode, see enable_profiling. Events are (name, track, start, end) in nanoseconds
+        self.profiling = False
+        self.timestamp_queries = False
+        self.profile_events = []
+        self.pipeline_names = {}
+        # The shared device of the process unless given, see request_device
+        self.device = device if device is not None else request_device()
 
-    def create_shader_module(self, shader_path, roi_size, workgroup_size: tuple):
+    def create_shader_module(self, shader_path, roi_size, workgroup_size: tuple, constants=None, wavefield_precision="f32"):
         self.workgroup_size = list(workgroup_size)
-        roi_size = list(roi_size)
-        self.num_workgroups_to_dispatch = []
+
+        # Storage of the wavefields and CPML memory variables, "f32" or "f16" (native with the shader-f16 feature,
+        # packed in pairs otherwise). Both f16 layouts read back as consecutive float16 values
+        self.wavefield_precision = wavefield_precision
+        self.wavefield_dtype = np.float16 if wavefield_precision == "f16" else np.float32
+
+        # Values of the pipeline-overridable constants of the shader (e.g. stencil_radius)
+        self.constants = dict(constants or {})
 
         while len(self.workgroup_size) < 3:
             self.workgroup_size.append(1)
-        
-        while len(roi_size) < 3:
-            roi_size.append(1)
 
-        for i in range(3):
-            self.num_workgroups_to_dispatch.append((roi_size[i] + self.workgroup_size[i] - 1) // self.workgroup_size[i])
+        self.num_workgroups_to_dispatch = self.get_num_workgroups(roi_size)
 
-        self.shader_string = Path(shader_path).read_text(encoding='utf-8')
+        # Re-read only when the file changes
+        shader_path = Path(shader_path).resolve()
+        source_key = (shader_path, shader_path.stat().st_mtime_ns)
+        if source_key not in shader_sources:
+            shader_sources[source_key] = shader_path.read_text(encoding='utf-8')
+
+        self.shader_string = shader_sources[source_key]
         for idx, k in enumerate(["wsx", "wsy", "wsz"]):
             self.shader_string = self.shader_string.replace(k, f'{self.workgroup_size[idx]}')
+        self.shader_string = wavefield_storage(self.shader_string, wavefield_precision, "shader-f16" in self.device.features)
+
+        self.shader_key = (self.device, hashlib.sha256(self.shader_string.encode('utf-8')).hexdigest())
+        if self.shader_key not in shader_modules:
+            shader_modules[self.shader_key] = self.device.create_shader_module(code=self.shader_string)
+
+        self.shader_module = shader_modules[self.shader_key]
+
+    def get_num_workgroups(self, roi_size):
+        roi_size = list(roi_size)
+        num_workgroups = []
+
+        while len(roi_size) < 3:
+            roi_size.append(1)
+
+        for i in range(3):
+            num_workgroups.append((int(roi_size[i]) + self.workgroup_size[i] - 1) // self.workgroup_size[i])
 
-        self.shader_module = self.device.create_shader_module(code=self.shader_string)
+        return num_workgroups
 
     def set_buffers(self, data, *copy_src_buffers):
-        re_pattern = r"@group\((\d+)\)\s+@binding\((\d+)\)\s+var<([^>]+)>\s+(\w+)\s*:"
+        re_pattern = r"@group\((\d+)\)\s+@binding\((\d+)\)\s+var<([^>]+)>\s+(\w+)\s*:\s*([^;]+);"
         matches = re.findall(re_pattern, self.shader_string)
 
         for m in matches:
@@ -66,21 +199,40 @@ class WebGpuHandler:
                 "name": m[3],
                 "data": data[m[3]][0],
                 "zero_initialized": data[m[3]][1],
+                "wavefield": m[4].strip() in ["array<wavefield>", "array<atomic<u32>>"],
             })
 
+        names = [v["name"] for v in self.buffers_info]
+        if all(name in names for name in WAVEFIELD_ROLES):
+            self.wavefield_indices = [names.index(name) for name in WAVEFIELD_ROLES]
+            self.wavefield_group = self.buffers_info[self.wavefield_indices[0]]["group"]
+
+    def buffer_index(self, idx, phase=None):
+        # Index of the buffer holding the role of buffers_info[idx] in a rotation phase (the current one by default)
+        if idx not in self.wavefield_indices:
+            return idx
+
+        role = self.wavefield_indices.index(idx)
+        return self.wavefield_indices[(role - (self.rotation if phase is None else phase)) % 3]
+
     def create_buffers(self, debug=False):
         command_encoder = self.device.create_command_encoder()
         cleared_buffer = False
 
         for v in self.buffers_info:
             if v["zero_initialized"]:
+                size = v["data"]
+                if v["wavefield"] and self.wavefield_precision == "f16":
+                    # Sized as float32 by the simulations, a multiple of 4 bytes
+                    size = (size // 2 + 3) // 4 * 4
                 self.buffers.append(
                     self.device.create_buffer(
-                        size=v["data"],
+                        size=size,
                         usage=v["buffer_usage"]
                     )
                 )
                 command_encoder.clear_buffer(self.buffers[-1], 0, self.buffers[-1].size)
+                self.allocated_bytes += self.buffers[-1].size
                 cleared_buffer = True
                 if debug:
                     print(f"\nCreated buffer:\nName: {v["name"]}\nSize: {v["data"]}\nGroup: {v["group"]}\nBinding: {v["binding"]}")
@@ -91,6 +243,8 @@ class WebGpuHandler:
                         usage=v["buffer_usage"]
                     )
                 )
+                self.allocated_bytes += self.buffers[-1].size
+                self.bytes_uploaded += self.buffers[-1].size
                 if debug:
                     print(f"\nCreated buffer:\nName: {v["name"]}\nSize: {v["data"].nbytes}\nGroup: {v["group"]}\nBinding: {v["binding"]}")
         
@@ -112,13 +266,23 @@ class WebGpuHandler:
                 }
             )
         
-        for v in self.bind_group_layout_entries.values():
-            self.bind_group_layouts.append(
-                self.device.create_bind_group_layout(entries=v)
-            )
+        self.layout_key = (self.device, tuple(
+            (group, entry["binding"], entry["buffer"]["type"])
+            for group, entries in self.bind_group_layout_entries.items() for entry in entries
+        ))
+
+        if self.layout_key not in bind_group_layouts:
+            bind_group_layouts[self.layout_key] = [
+                self.device.create_bind_group_layout(entries=v) for v in self.bind_group_layout_entries.values()
+            ]
+
+        self.bind_group_layouts = bind_group_layouts[self.layout_key]
     
     def create_pipeline_layout(self):
-        self.pipeline_layout = self.device.create_pipeline_layout(bind_group_layouts=self.bind_group_layouts)
+        if self.layout_key not in pipeline_layouts:
+            pipeline_layouts[self.layout_key] = self.device.create_pipeline_layout(bind_group_layouts=self.bind_group_layouts)
+
+        self.pipeline_layout = pipeline_layouts[self.layout_key]
 
 
     def create_bind_groups(self):
@@ -142,14 +306,52 @@ class WebGpuHandler:
                 self.device.create_bind_group(layout=self.bind_group_layouts[k], entries=v)
             )
 
+        if not self.wavefield_indices:
+            return
+
+        # The wavefield group once per rotation phase, with the roles of the three buffers permuted. The other groups
+        # don't change
+        for phase in range(3):
+            entries = [
+                {
+                    "binding": v["binding"],
+                    "resource": {
+                        "buffer": self.buffers[self.buffer_index(idx, phase)],
+                        "offset": 0,
+                        "size": self.buffers[idx].size,
+                    },
+                }
+                for idx, v in enumerate(self.buffers_info) if v["group"] == self.wavefield_group
+            ]
+            self.rotation_bind_groups.append(
+                self.device.create_bind_group(layout=self.bind_group_layouts[self.wavefield_group], entries=entries)
+            )
+
+        self.bind_groups[self.wavefield_group] = self.rotation_bind_groups[self.rotation]
+
+    def rotate_wavefields(self):
+        # Start of a step: the buffer written as p_next by the previous step is bound as p_current, p_current as
+        # p_previous and the oldest one is overwritten as p_next. Only the bind group changes, nothing is copied
+        if self.rotation_bind_groups:
+            self.rotation = (self.rotation + 1) % 3
+            self.bind_groups[self.wavefield_group] = self.rotation_bind_groups[self.rotation]
+
     def create_compute_pipeline(self, entry_point):
-        return self.device.create_compute_pipeline(
-            layout=self.pipeline_layout,
-            compute={
-                "module": self.shader_module,
-                "entry_point": entry_point,
-            }
-        )
+        key = (self.shader_key, self.layout_key, entry_point, tuple(sorted(self.constants.items())))
+
+        if key not in compute_pipelines:
+            compute_pipelines[key] = self.device.create_compute_pipeline(
+                layout=self.pipeline_layout,
+                compute={
+                    "module": self.shader_module,
+                    "entry_point": entry_point,
+                    "constants": self.constants,
+                }
+            )
+
+        self.pipeline_names[compute_pipelines[key]] = entry_point
+
+        return compute_pipelines[key]
     
     def dispatch_workgroups_to_pipeline(self, compute_pass: wgpu_native._api.GPUComputePassEncoder, compute_pipeline: wgpu_native._api.GPUComputePipeline, workgroups_to_dispatch=None):
         compute_pass.set_pipeline(compute_pipeline)
@@ -160,8 +362,121 @@ class WebGpuHandler:
                 workgroups_to_dispatch.append(1)
             compute_pass.dispatch_workgroups(workgroups_to_dispatch[0], workgroups_to_dispatch[1], workgroups_to_dispatch[2])
 
-    def read_buffer(self, group, binding):
+    def dispatch_pipelines(self, pipelines, steps=1, first_step=0):
+        # pipelines is a (pipeline, workgroups) list or a function of the timestep returning it, see step_dispatches
+        if self.profiling:
+            self.dispatch_pipelines_profiled(pipelines, steps, first_step)
+            return
+
+        # Records `steps` timesteps into a single command buffer, the host only waits on it when reading a buffer
+        command_encoder = self.device.create_command_encoder()
+        compute_pass = command_encoder.begin_compute_pass()
+
+        for step in range(first_step, first_step + steps):
+            self.rotate_wavefields()
+            for index, bind_group in enumerate(self.bind_groups):
+                compute_pass.set_bind_group(index, bind_group, [])
+
+            for compute_pipeline, workgroups_to_dispatch in step_dispatches(pipelines, step):
+                self.dispatch_workgroups_to_pipeline(compute_pass, compute_pipeline, workgroups_to_dispatch)
+
+        compute_pass.end()
+        self.device.queue.submit([command_encoder.finish()])
+
+    def enable_profiling(self):
+        # Every dispatch is timed, with GPU timestamp queries when the device has them and on the host otherwise
+        # (each dispatch then waits for the previous one). Buffer transfers are timed on the host. Slows the run down
+        self.profiling = True
+        self.timestamp_queries = "timestamp-query" in self.device.features
+        self.profile_events = []
+
+    def dispatch_pipelines_profiled(self, pipelines, steps, first_step):
+        if not self.timestamp_queries:
+            for step in range(first_step, first_step + steps):
+                self.rotate_wavefields()
+                for compute_pipeline, workgroups_to_dispatch in step_dispatches(pipelines, step):
+                    command_encoder = self.device.create_command_encoder()
+                    compute_pass = command_encoder.begin_compute_pass()
+                    for index, bind_group in enumerate(self.bind_groups):
+                        compute_pass.set_bind_group(index, bind_group, [])
+                    self.dispatch_workgroups_to_pipeline(compute_pass, compute_pipeline, workgroups_to_dispatch)
+                    compute_pass.end()
+
+                    start = time.perf_counter_ns()
+                    self.device.queue.submit([command_encoder.finish()])
+                    self.device.queue.on_submitted_work_done_sync()
+                    self.profile_events.append((self.pipeline_names[compute_pipeline], "host", start, time.perf_counter_ns()))
+            return
+
+        # One compute pass per dispatch, timestamped at its beginning and end. A query set holds at most 4096 queries
+        steps_per_submit = max(1, 4096 // (2 * len(step_dispatches(pipelines, first_step))))
+        for submit_step in range(first_step, first_step + steps, steps_per_submit):
+            # Each dispatch with the bind groups of the rotation phase of its step
+            dispatches = []
+            for step in range(submit_step, min(submit_step + steps_per_submit, first_step + steps)):
+                self.rotate_wavefields()
+                dispatches += [(*p, list(self.bind_groups)) for p in step_dispatches(pipelines, step)]
+            query_set = self.device.create_query_set(type=wgpu.QueryType.timestamp, count=2 * len(dispatches))
+            resolve_buffer = self.device.create_buffer(
+                size=2 * len(dispatches) * np.dtype(np.uint64).itemsize,
+                usage=wgpu.BufferUsage.QUERY_RESOLVE | wgpu.BufferUsage.COPY_SRC
+            )
+
+            command_encoder = self.device.create_command_encoder()
+            for k, (compute_pipeline, workgroups_to_dispatch, bind_groups) in enumerate(dispatches):
+                compute_pass = command_encoder.begin_compute_pass(
+                    timestamp_writes={"query_set": query_set, "beginning_of_pass_write_index": 2 * k, "end_of_pass_write_index": 2 * k + 1}
+                )
+                for index, bind_group in enumerate(bind_groups):
+                    compute_pass.set_bind_group(index, bind_group, [])
+                self.dispatch_workgroups_to_pipeline(compute_pass, compute_pipeline, workgroups_to_dispatch)
+                compute_pass.end()
+            command_encoder.resolve_query_set(query_set, 0, 2 * len(dispatches), resolve_buffer, 0)
+            self.device.queue.submit([command_encoder.finish()])
+
+            # Nanoseconds on the GPU clock, placed on their own track
+            timestamps = np.frombuffer(self.device.queue.read_buffer(resolve_buffer), dtype=np.uint64).reshape(-1, 2)
+            for (compute_pipeline, _, _), (start, end) in zip(dispatches, timestamps):
+                self.profile_events.append((self.pipeline_names[compute_pipeline], "gpu", int(start), int(end)))
+
+            query_set.destroy()
+            resolve_buffer.destroy()
+
+    def write_profile(self, path):
+        write_trace(path, self.profile_events, backend="webgpu", timestamp_queries=self.timestamp_queries)
+
+    def write_buffer(self, name, data, offset=0):
+        # Ordered with the submitted command buffers, so it is safe to refill data the queued steps don't use anymore.
+        # The wavefields are addressed by role, in the rotation phase of the last dispatched step
+        for idx, v in enumerate(self.buffers_info):
+            if v["name"] == name:
+                start = time.perf_counter_ns()
+                self.device.queue.write_buffer(self.buffers[self.buffer_index(idx)], offset, data)
+                self.bytes_uploaded += memoryview(data).nbytes
+                if self.profiling:
+                    self.profile_events.append((f"write_buffer {name}", "host", start, time.perf_counter_ns()))
+                return
+
+    def copy_buffer(self, name, handler, handler_name):
+        # Copies a buffer into a buffer of another handler on the same device
+        src = self.buffers[self.buffer_index([v["name"] for v in self.buffers_info].index(name))]
+        dst = handler.buffers[handler.buffer_index([v["name"] for v in handler.buffers_info].index(handler_name))]
+
+        command_encoder = self.device.create_command_encoder()
+        command_encoder.copy_buffer_to_buffer(src, 0, dst, 0, src.size)
+        self.device.queue.submit([command_encoder.finish()])
+
+    def read_buffer(self, group, binding, offset=0, size=None):
+        # The whole buffer, or size bytes from offset. A wavefield binding reads the buffer holding its role after the
+        # last dispatched step, p_next (0, 0) is the newest field whatever the rotation phase
         for idx, v in enumerate(self.buffers_info):
             if v["group"] == group and v["binding"] == binding:
-                return self.device.queue.read_buffer(self.buffers[idx])
+                idx = self.buffer_index(idx)
+                self.bytes_downloaded += self.buffers[idx].size - offset if size is None else size
+                # Includes the wait for the queued steps
+                start = time.perf_counter_ns()
+                data = self.device.queue.read_buffer(self.buffers[idx], offset, size)
+                if self.profiling:
+                    self.profile_events.append((f"read_buffer {v['name']}", "host", start, time.perf_counter_ns()))
+                return data
         return None
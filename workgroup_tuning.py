@@ -0,0 +1,146 @@
+import numpy as np
+import json
+import os
+import time
+from pathlib import Path
+from backends import create_handler, create_step_pipelines
+
+
+# Candidate workgroup shapes (z threads, x threads). Consecutive x cells are contiguous in memory, the shapes wide
+# along x coalesce better while the square ones reuse the stencil neighbours across the workgroup
+CANDIDATE_WORKGROUP_SIZES = [
+    (8, 8), (16, 16), (16, 8), (8, 16), (4, 16), (16, 4), (4, 32), (32, 4), (8, 32), (32, 8),
+    (2, 64), (4, 64), (1, 64), (1, 128), (1, 256), (64, 1), (256, 1),
+]
+
+
+def adapter_name(device):
+    info = device.adapter.info
+    return f"{info['device']} ({info['adapter_type']}, {info['backend_type']})"
+
+
+def benchmark_workgroup_size(workgroup_size, kernel_mode, grid_size_shape, absorption_layer_size, info_f32, steps, repetitions, stencil_radius=1, device=None,
+                             wavefield_precision="f32"):
+    # Times the wavefield update of the synthetic shader, whose stencil kernels are shared with the time reversal one.
+    # The wavefield stays zero, the kernels don't branch on the values. The buffers are sized for f32 as in the
+    # simulations, the handler allocates the f16 wavefield and strip ones at half that size
+    grid_size_z, grid_size_x = grid_size_shape
+    roi_nbytes = int(grid_size_z * grid_size_x * np.dtype(np.float32).itemsize)
+    z_strips_nbytes = int(2 * absorption_layer_size * grid_size_x * np.dtype(np.float32).itemsize)
+    x_strips_nbytes = int(2 * absorption_layer_size * grid_size_z * np.dtype(np.float32).itemsize)
+
+    handler = create_handler("webgpu", device)
+    shader_path = "./synthetic_acou_sim_fused.wgsl" if kernel_mode == "fused" else "./synthetic_acou_sim.wgsl"
+    handler.create_shader_module(shader_path, (*grid_size_shape, 1), workgroup_size, constants={"stencil_radius": stencil_radius},
+                                 wavefield_precision=wavefield_precision)
+
+    wgsl_data = {
+        'p_next': (roi_nbytes, True),
+        'p_current': (roi_nbytes, True),
+        'p_previous': (roi_nbytes, True),
+        'dp_1_z': (roi_nbytes, True),
+        'dp_1_x': (roi_nbytes, True),
+        'dp_2_z': (roi_nbytes, True),
+        'dp_2_x': (roi_nbytes, True),
+        'phi_z': (z_strips_nbytes, True),
+        'phi_x': (x_strips_nbytes, True),
+        'psi_z': (z_strips_nbytes, True),
+        'psi_x': (x_strips_nbytes, True),
+        'infoI32': (np.array([grid_size_z, grid_size_x, absorption_layer_size, 1, 1, 1], dtype=np.int32), False),
+        'infoF32': (info_f32, False),
+        'c': (np.full(grid_size_shape, 1500, dtype=np.float32), False),
+        'source': (np.zeros(2 + steps * repetitions, dtype=np.float32), False),
+        'source_zx': (np.array([grid_size_z // 2, grid_size_x // 2], dtype=np.int32), False),
+        'absorption_z': (np.ones(grid_size_z, dtype=np.float32), False),
+        'absorption_x': (np.ones(grid_size_x, dtype=np.float32), False),
+        'transducer_z': (np.zeros(1, dtype=np.int32), False),
+        'transducer_x': (np.zeros(1, dtype=np.int32), False),
+        'i': (np.int32(0), False),
+        'recordings': (int(np.dtype(np.float32).itemsize), True),
+    }
+
+    handler.set_buffers(wgsl_data)
+    handler.create_buffers(debug=False)
+    handler.create_bind_group_layouts()
+    handler.create_pipeline_layout()
+    handler.create_bind_groups()
+
+    step_pipelines = create_step_pipelines(handler, kernel_mode, grid_size_shape, absorption_layer_size)
+
+    # Reading the time counter back waits for the submitted steps
+    i_info = next(v for v in handler.buffers_info if v["name"] == "i")
+
+    handler.dispatch_pipelines(step_pipelines, 2)
+    handler.read_buffer(group=i_info["group"], binding=i_info["binding"])
+
+    timings = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        handler.dispatch_pipelines(step_pipelines, steps)
+        handler.read_buffer(group=i_info["group"], binding=i_info["binding"])
+        timings.append((time.perf_counter() - start) / steps)
+
+    return min(timings)
+
+
+def tuned_workgroup_size(**kwargs):
+    # Fastest workgroup size for the adapter, kernel mode, wavefield precision and grid size, benchmarked once and kept
+    # in the tuning database. The NumPy backend has no workgroups
+    if kwargs["backend"] != "webgpu":
+        return (8, 8)
+
+    kernel_mode = kwargs["kernel_mode"]
+    grid_size_shape = tuple(int(n) for n in kwargs["grid_size_shape"])
+    absorption_layer_size = int(kwargs["absorption_layer_size"])
+    database_path = Path(kwargs.get("database", "./workgroup_tuning.json"))
+    steps = int(kwargs.get("steps", 20))
+    repetitions = int(kwargs.get("repetitions", 3))
+    stencil_radius = int(kwargs.get("stencil_radius", 1))
+    wavefield_precision = kwargs.get("wavefield_precision", "f32")
+    device = kwargs.get("device")
+
+    database = json.loads(database_path.read_text(encoding='utf-8')) if database_path.exists() else {}
+
+    # The handlers share the device of the process, see webgpu_handler.request_device
+    device = create_handler("webgpu", device).device
+    key = f"{adapter_name(device)}|{kernel_mode}|{grid_size_shape[0]}x{grid_size_shape[1]}"
+    if stencil_radius != 1:
+        # The wider stencils read more neighbours per cell, the 2nd order keys predate them
+        key += f"|order{2 * stencil_radius}"
+    if wavefield_precision != "f32":
+        # Half the bytes moved per cell, the f32 keys predate the precision
+        key += f"|{wavefield_precision}"
+
+    if key in database:
+        return tuple(database[key]["workgroup_size"])
+
+    limits = device.limits
+    max_invocations = limits.get("max-compute-invocations-per-workgroup", 256)
+    max_size_z = limits.get("max-compute-workgroup-size-x", 256)
+    max_size_x = limits.get("max-compute-workgroup-size-y", 256)
+
+    timings = {}
+    for workgroup_size in CANDIDATE_WORKGROUP_SIZES:
+        if workgroup_size[0] * workgroup_size[1] > max_invocations or workgroup_size[0] > max_size_z or workgroup_size[1] > max_size_x:
+            continue
+
+        timings[workgroup_size] = benchmark_workgroup_size(
+            workgroup_size, kernel_mode, grid_size_shape, absorption_layer_size, kwargs["info_f32"], steps, repetitions, stencil_radius, device,
+            wavefield_precision
+        )
+        print(f'Workgroup size {workgroup_size}: {timings[workgroup_size] * 1e3:.3f} ms/step')
+
+    best = min(timings, key=timings.get)
+    print(f'Tuned workgroup size for {key}: {best}')
+
+    database[key] = {
+        "workgroup_size": list(best),
+        "seconds_per_step": {f"{z}x{x}": t for (z, x), t in timings.items()},
+    }
+
+    # Written next to the database and renamed over it, concurrent jobs never read a partial file
+    temporary_path = database_path.with_suffix(f".{os.getpid()}.tmp")
+    temporary_path.write_text(json.dumps(database, indent=2), encoding='utf-8')
+    os.replace(temporary_path, database_path)
+
+    return best